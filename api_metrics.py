@@ -0,0 +1,348 @@
+'''
+ Instrumentation of Galaxy API calls and local work, for finding where a run spends its time.
+
+ instrumentClient() wraps every public method of the bioblend clients of a Galaxy instance
+ object (gi.libraries, gi.folders, gi.histories, ...), so each call is counted, timed into a
+ latency histogram and charged with the bytes sent and received for it, under names like
+ 'libraries.show_library'. Requests made directly on the instance, rather than through a bioblend
+ client, are recorded as 'http.get', 'http.post' and so on. Only the outermost call is recorded
+ when one of them calls another. Local work such as walking directories is timed with phase()
+ or timeIterator().
+
+ The metrics are written as a JSON report, and optionally as a Prometheus textfile (for the node
+ exporter's textfile collector), either once at the end of a run or periodically.
+'''
+
+import json
+import os
+import threading
+import time
+
+from bioblend.galaxy.client import Client
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class RunMetrics(object):
+    '''
+     Call counts, latency histograms, payload sizes and phase times for a run. Safe to share between threads.
+
+    :param script: The name of the script, used to label the metrics (e.g. 'refseq_to_library')
+    '''
+
+    def __init__(self, script):
+        self.script = script
+        self.started = time.time()
+        self.calls = {}
+        self.phases = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._reporter = None
+
+    def observeCall(self, name, seconds, failed=False):
+        '''
+         Record a Galaxy API call.
+
+        :param name: The name of the call (e.g. 'libraries.show_library')
+        :param seconds: The number of seconds the call took
+        :param failed: True if the call raised an exception
+        :return: None
+        '''
+
+        with self._lock:
+            call = self._call(name)
+            call['count'] += 1
+            call['seconds'] += seconds
+            call['max_seconds'] = max(call['max_seconds'], seconds)
+            if failed:
+                call['failures'] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    call['buckets'][i] += 1
+                    break
+
+    def observeBytes(self, sent, received):
+        '''
+         Charge bytes sent and received to the API call running on this thread, if any.
+
+        :param sent: The number of bytes sent
+        :param received: The number of bytes received
+        :return: None
+        '''
+
+        name = getattr(self._local, 'call', None)
+        if name is None:
+            return
+        with self._lock:
+            call = self._call(name)
+            call['bytes_sent'] += sent
+            call['bytes_received'] += received
+
+    def phase(self, name):
+        '''
+         Context manager for timing a phase of local work, e.g. "with metrics.phase('scan'):".
+         Times from several threads are added together.
+
+        :param name: The name of the phase
+        :return: A context manager
+        '''
+
+        return _Phase(self, name)
+
+    def observePhase(self, name, seconds):
+        '''
+         Add time to a phase.
+
+        :param name: The name of the phase
+        :param seconds: The number of seconds spent in it
+        :return: None
+        '''
+
+        with self._lock:
+            phase = self.phases.setdefault(name, {'count': 0, 'seconds': 0.0})
+            phase['count'] += 1
+            phase['seconds'] += seconds
+
+    def timeIterator(self, name, iterable):
+        '''
+         Generator for timing the work done by an iterator (e.g. walking a directory) as a phase,
+         without counting the time spent by the caller between items.
+
+        :param name: The name of the phase
+        :param iterable: The iterable to time
+        :return: A generator of the items of the iterable
+        '''
+
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.observePhase(name, time.time() - start)
+                return
+            self.observePhase(name, time.time() - start)
+            yield item
+
+    def report(self, client_stats=None, cache_stats=None):
+        '''
+         Get the metrics as a dict.
+
+        :param client_stats: A dict of connection counters to include, e.g. from GalaxyClient.stats.summary()
+        :param cache_stats: A dict of cache counters to include, e.g. from FetchCache.stats()
+        :return: A dict of the metrics
+        '''
+
+        with self._lock:
+            calls = {}
+            for name, call in self.calls.items():
+                calls[name] = dict(call, buckets=dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                                                          call['buckets'])))
+            report = {'script': self.script,
+                      'started': self.started,
+                      'elapsed_seconds': time.time() - self.started,
+                      'calls': calls,
+                      'phases': dict((name, dict(phase)) for name, phase in self.phases.items())}
+        if client_stats is not None:
+            report['connection'] = client_stats
+        if cache_stats is not None:
+            report['cache'] = cache_stats
+        return report
+
+    def writeReport(self, json_path=None, prometheus_path=None, client_stats=None, cache_stats=None):
+        '''
+         Write the metrics to a JSON file and/or a Prometheus textfile. Each file is replaced in one step,
+         so readers never see a partly written one.
+
+        :param json_path: The path of the JSON report, or None
+        :param prometheus_path: The path of the Prometheus textfile, or None
+        :param client_stats: A dict of connection counters to include, e.g. from GalaxyClient.stats.summary()
+        :param cache_stats: A dict of cache counters to include, e.g. from FetchCache.stats()
+        :return: None
+        '''
+
+        report = self.report(client_stats, cache_stats)
+        if json_path:
+            _writeFile(json_path, json.dumps(report, indent=2, sort_keys=True) + "\n")
+        if prometheus_path:
+            _writeFile(prometheus_path, formatPrometheus(report))
+
+    def startPeriodicReports(self, interval, json_path=None, prometheus_path=None, client_stats=None,
+                             cache_stats=None):
+        '''
+         Write the report every interval seconds from a background thread.
+
+        :param interval: The number of seconds between reports
+        :param json_path: The path of the JSON report, or None
+        :param prometheus_path: The path of the Prometheus textfile, or None
+        :param client_stats: A function returning a dict of connection counters to include, or None
+        :param cache_stats: A function returning a dict of cache counters to include, or None
+        :return: None
+        '''
+
+        def write():
+            while True:
+                time.sleep(interval)
+                self.writeReport(json_path, prometheus_path, client_stats() if client_stats else None,
+                                 cache_stats() if cache_stats else None)
+
+        self._reporter = threading.Thread(target=write)
+        self._reporter.daemon = True
+        self._reporter.start()
+
+    def _call(self, name):
+        # Called with the lock held
+        if name not in self.calls:
+            self.calls[name] = {'count': 0, 'failures': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                'bytes_sent': 0, 'bytes_received': 0, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+        return self.calls[name]
+
+
+class _Phase(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observePhase(self.name, time.time() - self.start)
+        return False
+
+
+def instrumentClient(gi, metrics):
+    '''
+     Function for recording every call made through the bioblend clients of a Galaxy instance object, and every
+     request made directly on it. If the instance is a GalaxyClient, the bytes of each request are charged to the
+     call that made it.
+
+    :param gi: Galaxy instance object
+    :param metrics: The RunMetrics to record the calls in
+    :return: The Galaxy instance object
+    '''
+
+    gi.metrics = metrics
+    for client_name, client in list(vars(gi).items()):
+        if not isinstance(client, Client):
+            continue
+        for method_name in dir(client):
+            method = getattr(client, method_name)
+            if method_name.startswith('_') or not callable(method):
+                continue
+            setattr(client, method_name, _instrument(metrics, client_name + '.' + method_name, method))
+    for method in ('get', 'post', 'put', 'patch', 'delete', 'range'):
+        if hasattr(gi, 'make_' + method + '_request'):
+            setattr(gi, 'make_' + method + '_request',
+                    _instrument(metrics, 'http.' + method, getattr(gi, 'make_' + method + '_request')))
+    return gi
+
+
+def _instrument(metrics, name, method):
+    def instrumented(*args, **kwargs):
+        # Calls made from inside another call are part of the outer one
+        if getattr(metrics._local, 'call', None) is not None:
+            return method(*args, **kwargs)
+
+        metrics._local.call = name
+        start = time.time()
+        failed = True
+        try:
+            result = method(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            metrics._local.call = None
+            metrics.observeCall(name, time.time() - start, failed)
+    return instrumented
+
+
+def formatPrometheus(report):
+    '''
+     Function for formatting a report in the Prometheus text exposition format.
+
+    :param report: A report from RunMetrics.report()
+    :return: The textfile contents
+    '''
+
+    lines = []
+
+    def sample(name, labels, value):
+        label_text = ','.join('%s="%s"' % (key, _escapeLabel(str(val)))
+                              for key, val in [('script', report['script'])] + labels)
+        lines.append('%s{%s} %s' % (name, label_text, repr(value) if isinstance(value, float) else value))
+
+    def metric(name, help_text, metric_type, samples):
+        lines.append('# HELP ' + name + ' ' + help_text)
+        lines.append('# TYPE ' + name + ' ' + metric_type)
+        for labels, value in samples:
+            sample(name, labels, value)
+
+    calls = sorted(report['calls'].items())
+
+    # Histogram buckets are cumulative in Prometheus
+    lines.append('# HELP galaxy_api_call_seconds Latency of Galaxy API calls')
+    lines.append('# TYPE galaxy_api_call_seconds histogram')
+    for name, call in calls:
+        total = 0
+        for bound in [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']:
+            total += call['buckets'][bound]
+            sample('galaxy_api_call_seconds_bucket', [('call', name), ('le', bound)], total)
+        sample('galaxy_api_call_seconds_sum', [('call', name)], call['seconds'])
+        sample('galaxy_api_call_seconds_count', [('call', name)], call['count'])
+
+    metric('galaxy_api_call_failures_total', 'Galaxy API calls that raised an error', 'counter',
+           [([('call', name)], call['failures']) for name, call in calls])
+    metric('galaxy_api_bytes_sent_total', 'Bytes sent in Galaxy API requests', 'counter',
+           [([('call', name)], call['bytes_sent']) for name, call in calls])
+    metric('galaxy_api_bytes_received_total', 'Bytes received in Galaxy API responses', 'counter',
+           [([('call', name)], call['bytes_received']) for name, call in calls])
+    metric('galaxy_phase_seconds_total', 'Time spent in each phase of local work, summed over threads', 'counter',
+           [([('phase', name)], phase['seconds']) for name, phase in sorted(report['phases'].items())])
+    metric('galaxy_run_elapsed_seconds', 'Time since the run started', 'gauge', [([], report['elapsed_seconds'])])
+
+    connection = report.get('connection')
+    if connection:
+        metric('galaxy_http_requests_total', 'HTTP requests sent to Galaxy, including retries', 'counter',
+               [([], connection['requests'])])
+        metric('galaxy_http_retries_total', 'HTTP requests to Galaxy that were retried', 'counter',
+               [([], connection['retries'])])
+
+    cache = report.get('cache')
+    if cache:
+        metric('galaxy_cache_lookups_total', 'Cache lookups, by result', 'counter',
+               [([('result', result)], cache[result]) for result in ('hits', 'stale_hits', 'misses', 'coalesced', 'updates')])
+        metric('galaxy_cache_refreshes_total', 'Background refreshes of cached values, by result', 'counter',
+               [([('result', 'ok')], cache['refreshes']), ([('result', 'error')], cache['refresh_errors'])])
+        metric('galaxy_cache_evictions_total', 'Cached values evicted to stay within the size limits', 'counter',
+               [([], cache['evictions'])])
+        metric('galaxy_cache_expirations_total', 'Cached values fetched again as they had expired', 'counter',
+               [([], cache['expirations'])])
+        metric('galaxy_cache_entries', 'Values held in the cache', 'gauge', [([], cache['entries'])])
+        metric('galaxy_cache_bytes', 'Approximate size of the values held in the cache', 'gauge',
+               [([], cache['bytes'])])
+        blocks = cache.get('blocks')
+        if blocks:
+            metric('galaxy_block_cache_lookups_total', 'Block cache lookups, by result', 'counter',
+                   [([('result', result)], blocks[result]) for result in ('hits', 'misses')])
+            metric('galaxy_block_cache_evictions_total', 'Blocks removed to stay within the size limit', 'counter',
+                   [([], blocks['evictions'])])
+            metric('galaxy_block_cache_blocks', 'Blocks held in the block cache', 'gauge', [([], blocks['blocks'])])
+            metric('galaxy_block_cache_bytes', 'Size of the blocks held in the block cache', 'gauge',
+                   [([], blocks['bytes'])])
+
+    return '\n'.join(lines) + '\n'
+
+
+def _escapeLabel(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _writeFile(path, contents):
+    # Write to a temporary file first, then move it into place
+    with open(path + ".tmp", "w") as f:
+        f.write(contents)
+    os.rename(path + ".tmp", path)
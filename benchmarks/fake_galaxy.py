@@ -0,0 +1,626 @@
+'''
+ Stand-in Galaxy API server, for benchmarking the scripts in this repository without a real Galaxy.
+usage: fake_galaxy.py [-h] [-p PORT] [-k KEY] [-l LATENCY] [-j JITTER]
+                      [--job_time JOB_TIME] [--histories HISTORIES]
+                      [--datasets DATASETS] [--dataset_size DATASET_SIZE]
+                      [--no_ranges] [--users USERS]
+
+Run a stand-in Galaxy API server.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -p PORT, --port PORT  The port to listen on. Defaults to 8080
+  -k KEY, --key KEY     The API key requests must carry, as an x-api-key
+                        header or a key query parameter. Defaults to
+                        accepting any key
+  -l LATENCY, --latency LATENCY
+                        The number of seconds added to every request. Defaults
+                        to 0
+  -j JITTER, --jitter JITTER
+                        Up to this many more seconds, at random, are added to
+                        every request. Defaults to 0
+  --job_time JOB_TIME   The number of seconds an uploaded dataset stays queued
+                        before it is ok. Defaults to 0
+  --histories HISTORIES
+                        The number of histories to make. Defaults to 0
+  --datasets DATASETS   The number of datasets in each history. Defaults to 0
+  --dataset_size DATASET_SIZE
+                        The number of bytes in each dataset in a history.
+                        Defaults to 1024
+  --no_ranges           Send the whole of a dataset when part of it is asked
+                        for, as Galaxy servers that can't send ranges do
+  --users USERS         The number of users to make. Defaults to 0
+
+ Implements the library, folder, history, role and upload endpoints used by the scripts, keeping
+ everything in memory. Uploads are never run: a dataset is 'queued' until --job_time seconds after
+ it was created, then 'ok'. Requests without the API key given are refused, as Galaxy would, unless
+ no key is given. The number of calls to each endpoint is kept
+ in FakeGalaxy.calls. The contents of history datasets are made up from their IDs as they are
+ displayed, and parts of them can be asked for with a Range header.
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+
+# Routes handled by the server, as (method, path pattern, FakeGalaxy method). Paths are matched after /api.
+ROUTES = [
+    ('GET', '/libraries', 'getLibraries'),
+    ('POST', '/libraries', 'createLibrary'),
+    ('GET', '/libraries/{id}', 'showLibrary'),
+    ('GET', '/libraries/{id}/contents', 'getLibraryContents'),
+    ('POST', '/libraries/{id}/contents', 'createLibraryContents'),
+    ('GET', '/libraries/{id}/contents/{id}', 'showLibraryDataset'),
+    ('DELETE', '/libraries/{id}/contents/{id}', 'deleteLibraryDataset'),
+    ('GET', '/libraries/{id}/permissions', 'getLibraryPermissions'),
+    ('POST', '/libraries/{id}/permissions', 'setLibraryPermissions'),
+    ('GET', '/folders/{id}/contents', 'getFolderContents'),
+    ('GET', '/roles', 'getRoles'),
+    ('GET', '/histories', 'getHistories'),
+    ('GET', '/histories/{id}/contents', 'getHistoryContents'),
+    ('GET', '/histories/{id}/contents/dataset_collections/{id}', 'showHistoryCollection'),
+    ('GET', '/datasets/{id}/display', 'displayDataset'),
+]
+
+# Library permission types, as (name in responses, name in requests)
+PERMISSIONS = [('access_library_role_list', 'LIBRARY_ACCESS_in'),
+               ('modify_library_role_list', 'LIBRARY_MODIFY_in'),
+               ('add_library_item_role_list', 'LIBRARY_ADD_in'),
+               ('manage_library_role_list', 'LIBRARY_MANAGE_in')]
+
+# Time format used by Galaxy
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class NotFound(Exception):
+    pass
+
+
+class Forbidden(Exception):
+    pass
+
+
+class RawContent(object):
+    '''
+     A response sent as it is rather than encoded as JSON, e.g. the contents of a dataset.
+
+    :param data: The response body, as bytes
+    '''
+
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeGalaxy(object):
+    '''
+     In-memory Galaxy libraries, histories and roles. Safe to share between threads.
+
+    :param job_time: The number of seconds an uploaded dataset stays queued before it is ok
+    :param ranges: Whether parts of datasets can be asked for with a Range header, or the whole dataset is sent
+    :param api_key: The API key requests must carry, or None to accept any key
+    '''
+
+    def __init__(self, job_time=0.0, ranges=True, api_key=None):
+        self.job_time = job_time
+        self.ranges = ranges
+        self.api_key = api_key
+        self.calls = Counter()
+        self.libraries = {}
+        self.library_contents = {}
+        self.folders = {}
+        self.folder_contents = {}
+        self.datasets = {}
+        self.permissions = {}
+        self.roles = []
+        self.histories = []
+        self.history_contents = {}
+        self.history_datasets = {}
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def handle(self, method, path, query, payload):
+        '''
+         Handle an API request.
+
+        :param method: The HTTP method
+        :param path: The request path, after /api
+        :param query: A dict of query parameters
+        :param payload: A dict of the request payload
+        :return: The response, to be encoded as JSON
+        '''
+
+        for route_method, pattern, handler in ROUTES:
+            match = re.match('^' + pattern.replace('{id}', '([^/]+)') + '/?$', path)
+            if route_method == method and match:
+                with self._lock:
+                    self.calls[method + ' ' + pattern] += 1
+                    return getattr(self, handler)(query, payload, *match.groups())
+        with self._lock:
+            self.calls[method + ' unknown'] += 1
+        raise NotFound(method + ' ' + path)
+
+    def addUsers(self, count):
+        '''
+         Add users, each with a private role named after their email (user0@example.org, ...).
+
+        :param count: The number of users to add
+        :return: None
+        '''
+
+        with self._lock:
+            for i in range(count):
+                self.roles.append({'id': self._newId(), 'name': 'user%d@example.org' % i, 'type': 'private'})
+
+    def addHistories(self, count, datasets, dataset_size=1024):
+        '''
+         Add histories, each with datasets and a collection of two hidden datasets.
+
+        :param count: The number of histories to add
+        :param datasets: The number of visible datasets in each history
+        :param dataset_size: The number of bytes in each dataset
+        :return: None
+        '''
+
+        now = datetime.now().strftime(TIME_FORMAT)
+        with self._lock:
+            for i in range(count):
+                history = {'id': self._newId(), 'name': 'History %d' % i, 'deleted': False, 'update_time': now}
+                contents = []
+                for j in range(datasets):
+                    contents.append(self._historyDataset('dataset_%d.fna' % j, now, True, dataset_size))
+                # Galaxy allows duplicate names, which galaxy-fuse shows with the dataset ID appended
+                if datasets:
+                    contents.append(self._historyDataset('dataset_0.fna', now, True, dataset_size))
+                elements = [self._historyDataset('element_%d.fna' % j, now, False, dataset_size) for j in range(2)]
+                contents += elements
+                contents.append({'id': self._newId(), 'name': 'collection', 'history_content_type': 'dataset_collection',
+                                 'deleted': False, 'visible': True, 'update_time': now,
+                                 'elements': [{'element_identifier': e['name'], 'object': e} for e in elements]})
+                # Galaxy numbers the items in a history in the order they were added
+                for hid, item in enumerate(contents, 1):
+                    item['hid'] = hid
+                self.histories.append(history)
+                self.history_contents[history['id']] = contents
+
+    # Library endpoints
+
+    def getLibraries(self, query, payload):
+        deleted = query.get('deleted', 'False').lower() == 'true'
+        return [lib for lib in self.libraries.values() if lib['deleted'] == deleted]
+
+    def createLibrary(self, query, payload):
+        lib_id = self._newId()
+        folder_id = 'F' + self._newId()
+        lib = {'id': lib_id, 'name': payload['name'], 'description': payload.get('description', ''),
+               'deleted': False, 'root_folder_id': folder_id, 'url': '/api/libraries/' + lib_id}
+        self.libraries[lib_id] = lib
+        self.library_contents[lib_id] = [{'id': folder_id, 'name': '/', 'type': 'folder',
+                                          'url': '/api/libraries/' + lib_id + '/contents/' + folder_id}]
+        self.folders[folder_id] = {'library_id': lib_id, 'path': '/'}
+        self.folder_contents[folder_id] = []
+        self.permissions[lib_id] = dict((name, []) for name, _ in PERMISSIONS)
+        return lib
+
+    def showLibrary(self, query, payload, lib_id):
+        return self._library(lib_id)
+
+    def getLibraryContents(self, query, payload, lib_id):
+        self._library(lib_id)
+        return [dict((key, item[key]) for key in ('id', 'name', 'type', 'url')) for item in self.library_contents[lib_id]]
+
+    def createLibraryContents(self, query, payload, lib_id):
+        self._library(lib_id)
+        parent_id = payload.get('folder_id')
+        if parent_id not in self.folders or self.folders[parent_id]['library_id'] != lib_id:
+            raise NotFound('folder ' + str(parent_id))
+        parent_path = self.folders[parent_id]['path'].rstrip('/')
+
+        if payload.get('create_type') == 'folder':
+            folder_id = 'F' + self._newId()
+            item = {'id': folder_id, 'name': parent_path + '/' + payload['name'], 'type': 'folder',
+                    'url': '/api/libraries/' + lib_id + '/contents/' + folder_id}
+            self.library_contents[lib_id].append(item)
+            self.folders[folder_id] = {'library_id': lib_id, 'path': item['name']}
+            self.folder_contents[folder_id] = []
+            self.folder_contents[parent_id].append(item)
+            return [{'id': folder_id, 'name': payload['name'], 'url': item['url']}]
+
+        if payload.get('upload_option') == 'upload_paths':
+            paths = [path for path in payload['filesystem_paths'].split('\n') if path.strip()]
+        else:
+            paths = [payload['filename']]
+
+        created = []
+        for path in paths:
+            dataset_id = self._newId()
+            name = path.strip().split('/')[-1]
+            file_name = path.strip() if payload.get('upload_option') == 'upload_paths' \
+                else '/galaxy/files/dataset_' + dataset_id + '.dat'
+            item = {'id': dataset_id, 'name': parent_path + '/' + name, 'type': 'file',
+                    'url': '/api/libraries/' + lib_id + '/contents/' + dataset_id,
+                    'folder_id': parent_id, 'created': time.time(), 'file_size': 0, 'file_name': file_name}
+            self.library_contents[lib_id].append(item)
+            self.folder_contents[parent_id].append(item)
+            self.datasets[dataset_id] = item
+            created.append({'id': dataset_id, 'name': name, 'url': item['url']})
+        return created
+
+    def showLibraryDataset(self, query, payload, lib_id, dataset_id):
+        if dataset_id not in self.datasets:
+            raise NotFound('dataset ' + dataset_id)
+        item = self.datasets[dataset_id]
+        return {'id': dataset_id, 'ldda_id': dataset_id, 'name': item['name'].split('/')[-1],
+                'folder_id': item['folder_id'], 'file_size': item['file_size'], 'file_name': item['file_name'],
+                'update_time': datetime.fromtimestamp(item['created']).strftime(TIME_FORMAT)}
+
+    def deleteLibraryDataset(self, query, payload, lib_id, dataset_id):
+        item = self.datasets.pop(dataset_id, None)
+        if item is None:
+            raise NotFound('dataset ' + dataset_id)
+        self.library_contents[lib_id].remove(item)
+        self.folder_contents[item['folder_id']].remove(item)
+        return {'id': dataset_id, 'deleted': True}
+
+    def getLibraryPermissions(self, query, payload, lib_id):
+        self._library(lib_id)
+        roles = dict((role['id'], role['name']) for role in self.roles)
+        return dict((name, [[roles.get(role_id, role_id), role_id] for role_id in role_ids])
+                    for name, role_ids in self.permissions[lib_id].items())
+
+    def setLibraryPermissions(self, query, payload, lib_id):
+        lib = self._library(lib_id)
+        for name, request_name in PERMISSIONS:
+            role_ids = payload.get(request_name, [])
+            self.permissions[lib_id][name] = role_ids if isinstance(role_ids, list) else [role_ids]
+        return lib
+
+    def getFolderContents(self, query, payload, folder_id):
+        if folder_id not in self.folders:
+            raise NotFound('folder ' + folder_id)
+        items = []
+        for item in self.folder_contents[folder_id]:
+            if item['type'] == 'folder':
+                items.append({'id': item['id'], 'name': item['name'].split('/')[-1], 'type': 'folder'})
+            else:
+                state = 'ok' if time.time() - item['created'] >= self.job_time else 'queued'
+                items.append({'id': item['id'], 'ldda_id': item['id'], 'name': item['name'].split('/')[-1],
+                              'type': 'file', 'state': state, 'file_size': niceSize(item['file_size']),
+                              'raw_size': item['file_size'],
+                              'update_time': libraryTime(item['created'])})
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', len(items)))
+        return {'metadata': {'total_rows': len(items), 'full_path': [[folder_id, self.folders[folder_id]['path']]]},
+                'folder_contents': items[offset:offset + limit]}
+
+    # Role and history endpoints
+
+    def getRoles(self, query, payload):
+        return list(self.roles)
+
+    def getHistories(self, query, payload):
+        return list(self.histories)
+
+    def getHistoryContents(self, query, payload, history_id):
+        if history_id not in self.history_contents:
+            raise NotFound('history ' + history_id)
+        contents = self.history_contents[history_id]
+        if query.get('deleted', '').lower() == 'false':
+            contents = [item for item in contents if not item['deleted']]
+        if query.get('visible', '').lower() == 'true':
+            contents = [item for item in contents if item['visible']]
+        # Filtering by update time, as used by galaxy-fuse to fetch only what has changed, and by hid, as used
+        # to page through the contents. Times in TIME_FORMAT sort in time order as strings. Several filters
+        # can be given, as repeated q and qv parameters
+        filters = query.get('q', [])
+        values = query.get('qv', [])
+        for q, qv in zip(filters if isinstance(filters, list) else [filters], values if isinstance(values, list) else [values]):
+            if q == 'update_time-ge':
+                contents = [item for item in contents if item['update_time'] >= qv]
+            elif q == 'update_time-gt':
+                contents = [item for item in contents if item['update_time'] > qv]
+            elif q == 'deleted':
+                contents = [item for item in contents if item['deleted'] == (qv.lower() == 'true')]
+            elif q == 'hid-gt':
+                contents = [item for item in contents if item['hid'] > int(qv)]
+            else:
+                raise ValueError('unknown filter ' + q)
+        offset = int(query.get('offset', 0))
+        contents = contents[offset:offset + int(query['limit'])] if 'limit' in query else contents[offset:]
+        if query.get('keys'):
+            keys = query['keys'].split(',')
+            contents = [dict((key, item[key]) for key in keys if key in item) for item in contents]
+        return contents
+
+    def showHistoryCollection(self, query, payload, history_id, collection_id):
+        for item in self.history_contents.get(history_id, []):
+            if item['history_content_type'] == 'dataset_collection' and item['id'] == collection_id:
+                return item
+        raise NotFound('collection ' + collection_id)
+
+    def displayDataset(self, query, payload, dataset_id):
+        # Library datasets have the same IDs as the datasets they hold here
+        datasets = self.datasets if query.get('hda_ldda') == 'ldda' else self.history_datasets
+        if dataset_id not in datasets:
+            raise NotFound('dataset ' + dataset_id)
+        return RawContent(datasetContent(dataset_id, datasets[dataset_id]['file_size']))
+
+    def _library(self, lib_id):
+        if lib_id not in self.libraries:
+            raise NotFound('library ' + lib_id)
+        return self.libraries[lib_id]
+
+    def _historyDataset(self, name, update_time, visible, size):
+        dataset_id = self._newId()
+        # With some of the other details Galaxy gives, so responses are about the size of real ones
+        self.history_datasets[dataset_id] = {'id': dataset_id, 'name': name, 'history_content_type': 'dataset', 'deleted': False,
+                'purged': False, 'visible': visible, 'state': 'ok', 'update_time': update_time,
+                'create_time': update_time, 'file_name': '/galaxy/files/dataset_' + dataset_id + '.dat',
+                'file_ext': 'fasta', 'file_size': size, 'genome_build': '?', 'data_type': 'galaxy.datatypes.sequence.Fasta',
+                'model_class': 'HistoryDatasetAssociation', 'misc_blurb': '1 sequence', 'misc_info': 'uploaded fasta file',
+                'peek': '<table cellspacing="0" cellpadding="3"><tr><td>&gt;' + name + '</td></tr><tr><td>'
+                        + 'ACGT' * 16 + '</td></tr></table>',
+                'metadata_data_lines': 17, 'metadata_sequences': 1, 'metadata_dbkey': '?', 'annotation': None,
+                'tags': [], 'accessible': True, 'api_type': 'file', 'resubmitted': False, 'rerunnable': True,
+                'url': '/api/histories/datasets/' + dataset_id, 'download_url': '/api/datasets/' + dataset_id + '/display'}
+        return self.history_datasets[dataset_id]
+
+    def _newId(self):
+        # Called with the lock held, or before the server starts
+        self._next_id += 1
+        return '%016x' % self._next_id
+
+
+class FakeGalaxyServer(ThreadingMixIn, HTTPServer):
+    '''
+     HTTP server for a FakeGalaxy, handling each request in its own thread.
+
+    :param galaxy: The FakeGalaxy to serve
+    :param port: The port to listen on, 0 for any free port
+    :param latency: The number of seconds added to every request
+    :param jitter: Up to this many more seconds, at random, are added to every request
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, galaxy, port=0, latency=0.0, jitter=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeGalaxyHandler)
+        self.galaxy = galaxy
+        self.latency = latency
+        self.jitter = jitter
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_port
+
+    def start(self):
+        '''
+         Start serving requests in a background thread.
+
+        :return: The Galaxy URL of the server
+        '''
+
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        '''
+         Stop serving requests.
+
+        :return: None
+        '''
+
+        self.shutdown()
+        self.server_close()
+
+
+class FakeGalaxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response in one write, without waiting on the client's delayed ACKs
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        # The latency is added outside the lock, so concurrent requests overlap as they would in Galaxy
+        delay = self.server.latency + random.uniform(0, self.server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        url = urlparse(self.path)
+        # Repeated parameters (e.g. the q and qv filters of history contents) are given as lists
+        query = dict((key, values[-1] if len(values) == 1 else values) for key, values in parse_qs(url.query).items())
+        path = url.path[url.path.index('/api') + 4:] if '/api' in url.path else url.path
+        galaxy = self.server.galaxy
+        try:
+            # Galaxy takes the key from either, and bioblend sends one or the other depending on its release
+            if galaxy.api_key is not None and galaxy.api_key not in (self.headers.get('x-api-key'), query.get('key')):
+                with galaxy._lock:
+                    galaxy.calls[method + ' forbidden'] += 1
+                raise Forbidden()
+            response = galaxy.handle(method, path, query, parsePayload(self.headers, body))
+            status = 200
+        except Forbidden:
+            response = {'err_msg': 'Provided API key is not valid.'}
+            status = 403
+        except NotFound as e:
+            response = {'err_msg': 'Not found: ' + str(e)}
+            status = 404
+        except (KeyError, ValueError) as e:
+            response = {'err_msg': 'Bad request: ' + str(e)}
+            status = 400
+
+        if isinstance(response, RawContent):
+            self._sendRaw(response.data)
+            return
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _sendRaw(self, data):
+        # Only a single range of bytes is handled, as that is all galaxy-fuse asks for
+        match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if match and self.server.galaxy.ranges and int(match.group(1)) < len(data):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), len(data) - 1) if match.group(2) else len(data) - 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def niceSize(size):
+    '''
+     Function for formatting a size in bytes as Galaxy does in library folder contents, e.g. "1.2 KB".
+
+    :param size: The size in bytes
+    :return: The formatted size
+    '''
+
+    for power, unit in enumerate(['bytes', 'KB', 'MB', 'GB', 'TB']):
+        if size < 1024 ** (power + 1) or unit == 'TB':
+            if unit == 'bytes':
+                return '%d bytes' % size
+            return '%.1f %s' % (float(size) / 1024 ** power, unit)
+
+
+def libraryTime(t):
+    '''
+     Function for formatting a time as Galaxy does in library folder contents, to the minute.
+
+    :param t: The time, in seconds since the epoch
+    :return: The formatted time
+    '''
+
+    return time.strftime('%Y-%m-%d %I:%M %p', time.localtime(t))
+
+
+def datasetContent(dataset_id, size):
+    '''
+     Function for making up the contents of a dataset, the same every time for the same ID, and different
+     at every offset so a block read from the wrong place doesn't match.
+
+    :param dataset_id: The ID of the dataset
+    :param size: The number of bytes in the dataset
+    :return: The contents, as bytes
+    '''
+
+    lines = []
+    length = 0
+    while length < size:
+        line = ('>%s %d\n' % (dataset_id, length)).encode('utf-8')
+        lines.append(line)
+        length += len(line)
+    return b''.join(lines)[:size]
+
+
+def parsePayload(headers, body):
+    '''
+     Function for decoding a request payload, sent as JSON or as a multipart form (for file uploads).
+     Form fields are JSON decoded where they can be, and the name of an uploaded file is given as 'filename'.
+
+    :param headers: The request headers
+    :param body: The request body, as bytes
+    :return: A dict of the payload
+    '''
+
+    content_type = headers.get('Content-Type') or ''
+    if not body:
+        return {}
+    if not content_type.startswith('multipart/form-data'):
+        return json.loads(body.decode('utf-8'))
+
+    payload = {}
+    boundary = content_type.split('boundary=')[-1].strip('"').encode('utf-8')
+    for part in body.split(b'--' + boundary):
+        if b'\r\n\r\n' not in part:
+            continue
+        part_headers, value = part.split(b'\r\n\r\n', 1)
+        part_headers = part_headers.decode('utf-8', 'replace')
+        name = re.search(r'name="([^"]*)"', part_headers)
+        filename = re.search(r'filename="([^"]*)"', part_headers)
+        if filename:
+            payload['filename'] = filename.group(1)
+        elif name:
+            value = value[:-2].decode('utf-8', 'replace') if value.endswith(b'\r\n') else value.decode('utf-8', 'replace')
+            try:
+                payload[name.group(1)] = json.loads(value)
+            except ValueError:
+                payload[name.group(1)] = value
+    return payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a stand-in Galaxy API server.')
+    parser.add_argument('-p', '--port', type=int, help='The port to listen on. Defaults to 8080', default=8080)
+    parser.add_argument('-k', '--key', type=str, help='The API key requests must carry, as an x-api-key header or a key query parameter. Defaults to accepting any key')
+    parser.add_argument('-l', '--latency', type=float, help='The number of seconds added to every request. Defaults to 0', default=0.0)
+    parser.add_argument('-j', '--jitter', type=float, help='Up to this many more seconds, at random, are added to every request. Defaults to 0', default=0.0)
+    parser.add_argument('--job_time', type=float, help='The number of seconds an uploaded dataset stays queued before it is ok. Defaults to 0', default=0.0)
+    parser.add_argument('--histories', type=int, help='The number of histories to make. Defaults to 0', default=0)
+    parser.add_argument('--datasets', type=int, help='The number of datasets in each history. Defaults to 0', default=0)
+    parser.add_argument('--dataset_size', type=int, help='The number of bytes in each dataset in a history. Defaults to 1024', default=1024)
+    parser.add_argument('--no_ranges', action='store_true', help="Send the whole of a dataset when part of it is asked for, as Galaxy servers that can't send ranges do")
+    parser.add_argument('--users', type=int, help='The number of users to make. Defaults to 0', default=0)
+    args = parser.parse_args()
+
+    galaxy = FakeGalaxy(args.job_time, ranges=not args.no_ranges, api_key=args.key)
+    galaxy.addUsers(args.users)
+    galaxy.addHistories(args.histories, args.datasets, args.dataset_size)
+    server = FakeGalaxyServer(galaxy, args.port, args.latency, args.jitter)
+    print("Serving a fake Galaxy at " + server.url + " - press Ctrl-C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    for call, count in sorted(galaxy.calls.items()):
+        print(call + ": " + str(count))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+'''
+ Script to time galaxy-fuse listings, the equivalent of "ls -lR" under /histories, without mounting anything.
+usage: fuse_listing.py [-h] [--passes PASSES] url key
+
+Time galaxy-fuse listings of every history.
+
+positional arguments:
+  url              the Galaxy URL
+  key              the Galaxy API key to use
+
+optional arguments:
+  -h, --help       show this help message and exit
+  --passes PASSES  The number of times to list every history. Later passes
+                   are served from galaxy-fuse's caches. Defaults to 2
+
+ Calls the galaxy-fuse file system operations directly, so needs the same Python and fuse
+ module as galaxy-fuse.py itself. Prints a JSON line with the time taken by each pass.
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import imp
+import json
+import os
+import sys
+import time
+from stat import S_ISDIR
+
+GALAXY_FUSE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'galaxy-fuse.py')
+
+
+def listHistories(context):
+    '''
+     Function for listing every history, dataset and collection, and the attributes and link of each.
+
+    :param context: The galaxy-fuse Context
+    :return: The number of entries listed
+    '''
+
+    entries = 0
+    for history in context('readdir', '/histories', None)[2:]:
+        history_path = '/histories/' + history
+        context('getattr', history_path)
+        for name in context('readdir', history_path, None)[2:]:
+            path = history_path + '/' + name
+            entries += 1
+            if S_ISDIR(context('getattr', path)['st_mode']):
+                for element in context('readdir', path, None)[2:]:
+                    context('getattr', path + '/' + element)
+                    context('readlink', path + '/' + element)
+                    entries += 1
+            else:
+                context('readlink', path)
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time galaxy-fuse listings of every history.')
+    parser.add_argument('url', type=str, help='the Galaxy URL')
+    parser.add_argument('key', type=str, help='the Galaxy API key to use')
+    parser.add_argument('--passes', type=int, help="The number of times to list every history. Later passes are served from galaxy-fuse's caches. Defaults to 2", default=2)
+    args = parser.parse_args()
+
+    # galaxy-fuse.py imports the modules next to it, which aren't on the path when run from here
+    sys.path.insert(0, os.path.dirname(GALAXY_FUSE))
+    galaxy_fuse = imp.load_source('galaxy_fuse', GALAXY_FUSE)
+    context = galaxy_fuse.Context(args.key, 300, 5, url=args.url)
+
+    passes = []
+    for _ in range(args.passes):
+        start = time.time()
+        entries = listHistories(context)
+        passes.append(time.time() - start)
+    # Stop galaxy-fuse's background refreshes, as unmounting would
+    context('destroy', '/')
+    print(json.dumps({'entries': entries, 'seconds': passes}))
+
+if __name__ == "__main__":
+    main()
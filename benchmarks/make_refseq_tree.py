@@ -0,0 +1,106 @@
+'''
+ Script to make a synthetic RefSeq-style directory tree, for benchmarking the scripts in this repository.
+usage: make_refseq_tree.py [-h] [-n FILES] [-g GENERA] [-s SPECIES]
+                           [--file_size FILE_SIZE]
+                           directory
+
+Make a synthetic RefSeq directory tree.
+
+positional arguments:
+  directory             the directory to make the tree in
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -n FILES, --files FILES
+                        The number of files to make. Defaults to 1000
+  -g GENERA, --genera GENERA
+                        The number of genera to spread the folders over.
+                        Defaults to 10
+  -s SPECIES, --species SPECIES
+                        The number of species in each genus. Defaults to 5
+  --file_size FILE_SIZE
+                        The size of each file, in bytes. Defaults to 1024
+
+ Makes Genus_species_strain_uidN folders, each with one file of each RefSeq file type:
+    directory/
+        Genus_species_strain_uidN/
+            NC_NNNNNN.fna, .faa, .ffn, .gbk, .gff
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+
+# The RefSeq file types made in each folder
+FILE_TYPES = ['fna', 'faa', 'ffn', 'gbk', 'gff']
+
+# Name of the file recording the options a tree was made with, so it can be reused
+TREE_INFO_FILE = '.benchmark_tree.json'
+
+
+def makeRefSeqTree(directory, files, genera=10, species=5, file_size=1024):
+    '''
+     Function for making a synthetic RefSeq tree. Folders are spread evenly over the genera and species,
+     and every file has different contents. If the directory already has a tree made with the same options,
+     it is reused.
+
+    :param directory: The directory to make the tree in
+    :param files: The number of files to make
+    :param genera: The number of genera to spread the folders over
+    :param species: The number of species in each genus
+    :param file_size: The size of each file, in bytes
+    :return: True if the tree was made, False if an existing one was reused
+    '''
+
+    info = {'files': files, 'genera': genera, 'species': species, 'file_size': file_size}
+    info_path = os.path.join(directory, TREE_INFO_FILE)
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            if json.load(f) == info:
+                return False
+        raise ValueError("The directory " + directory + " has a tree made with different options")
+
+    # Every file is cut from the same block of bases, starting at a different offset
+    rand = random.Random(0)
+    block = ''.join(rand.choice('ACGT') for _ in range(4096))
+    block = block * (file_size // len(block) + 2)
+
+    for i in range(files):
+        folder = i // len(FILE_TYPES)
+        file_type = FILE_TYPES[i % len(FILE_TYPES)]
+        genus = 'Genus%d' % (folder % genera)
+        spc = 'species%d' % (folder // genera % species)
+        folder_path = os.path.join(directory, '%s_%s_strain%d_uid%d' % (genus, spc, folder, folder))
+        if i % len(FILE_TYPES) == 0 and not os.path.isdir(folder_path):
+            os.makedirs(folder_path)
+
+        header = '>NC_%06d synthetic %s %s\n' % (folder, genus, spc)
+        offset = i % 4096
+        with open(os.path.join(folder_path, 'NC_%06d.%s' % (folder, file_type)), 'w') as f:
+            f.write(header + block[offset:offset + max(0, file_size - len(header))])
+
+    with open(info_path, 'w') as f:
+        json.dump(info, f)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Make a synthetic RefSeq directory tree.')
+    parser.add_argument('directory', type=str, help='the directory to make the tree in')
+    parser.add_argument('-n', '--files', type=int, help='The number of files to make. Defaults to 1000', default=1000)
+    parser.add_argument('-g', '--genera', type=int, help='The number of genera to spread the folders over. Defaults to 10', default=10)
+    parser.add_argument('-s', '--species', type=int, help='The number of species in each genus. Defaults to 5', default=5)
+    parser.add_argument('--file_size', type=int, help='The size of each file, in bytes. Defaults to 1024', default=1024)
+    args = parser.parse_args()
+
+    if makeRefSeqTree(args.directory, args.files, args.genera, args.species, args.file_size):
+        print("Made " + str(args.files) + " files in " + args.directory)
+    else:
+        print("Tree already exists in " + args.directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+'''
+ Script to benchmark the scripts in this repository against a stand-in Galaxy, for comparing performance between commits.
+usage: run_benchmarks.py [-h] [-s SIZES [SIZES ...]]
+                         [--scenarios SCENARIOS [SCENARIOS ...]] [-w WORKERS]
+                         [-l LATENCY] [-j JITTER] [--job_time JOB_TIME]
+                         [-d WORK_DIR] [--fuse_python FUSE_PYTHON] [-o OUTPUT]
+                         [-c COMPARE]
+
+Benchmark the scripts against a stand-in Galaxy.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -s SIZES [SIZES ...], --sizes SIZES [SIZES ...]
+                        The numbers of files to benchmark with. Defaults to
+                        1000 10000 100000
+  --scenarios SCENARIOS [SCENARIOS ...]
+                        The scenarios to run. Defaults to all of them:
+                        refseq_to_library, refseq_to_library_rerun,
+                        directory_to_library, library_permissions, galaxy_fuse
+  -w WORKERS, --workers WORKERS
+                        The number of workers the scripts are run with.
+                        Defaults to 8
+  -l LATENCY, --latency LATENCY
+                        The number of seconds the stand-in Galaxy adds to
+                        every request. Defaults to 0.005
+  -j JITTER, --jitter JITTER
+                        Up to this many more seconds, at random, are added to
+                        every request. Defaults to 0.005
+  --job_time JOB_TIME   The number of seconds an uploaded dataset stays queued.
+                        Defaults to 0
+  -d WORK_DIR, --work_dir WORK_DIR
+                        The directory to make the synthetic trees, manifests
+                        and logs in. Trees are reused between runs. Defaults
+                        to galaxy_refseq_benchmarks in the temp directory
+  --fuse_python FUSE_PYTHON
+                        The Python to run galaxy-fuse with. Defaults to
+                        python2
+  -o OUTPUT, --output OUTPUT
+                        The file to write the results to, as JSON
+  -c COMPARE, --compare COMPARE
+                        A results file from an earlier run (e.g. of another
+                        commit) to compare the results with
+
+ Each scenario is run as a separate process against a fresh stand-in Galaxy for each size,
+ in order, so a re-run scenario sees the libraries made by the one before it. The wall time
+ and the number of calls to each Galaxy endpoint are recorded for each scenario. These are
+ benchmarks, not tests: a failing scenario is recorded with its exit code, and its output
+ is kept in the logs directory. The stand-in Galaxy refuses requests without the API key,
+ and what each scenario left in it is checked (e.g. that every file in the tree was added to
+ a library exactly once), so a scenario that exits cleanly without doing its job is
+ recorded with the problem, and fails the run.
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_galaxy import FakeGalaxy, FakeGalaxyServer
+from make_refseq_tree import TREE_INFO_FILE, makeRefSeqTree
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+SCENARIOS = ['refseq_to_library', 'refseq_to_library_rerun', 'directory_to_library', 'library_permissions',
+             'galaxy_fuse']
+
+# The API key given to the scripts, which the stand-in Galaxy refuses requests without
+API_KEY = 'benchmark'
+
+# The number of users made in the stand-in Galaxy, and given access by library_permissions.py
+USERS = 100
+
+# The number of datasets in each history listed by galaxy-fuse
+HISTORY_DATASETS = 1000
+
+# The name of the library made by directory_to_library.py
+LIBRARY_NAME = 'benchmark'
+
+
+def scenarioCommand(scenario, tree, url, manifest, workers, fuse_python):
+    '''
+     Function for getting the command line for a scenario.
+
+    :param scenario: The name of the scenario
+    :param tree: The synthetic RefSeq tree
+    :param url: The URL of the stand-in Galaxy
+    :param manifest: The sync manifest file for the refseq_to_library scenarios
+    :param workers: The number of workers the scripts are run with
+    :param fuse_python: The Python to run galaxy-fuse with
+    :return: The command line, as a list
+    '''
+
+    script = lambda name: os.path.join(REPO_DIR, name)
+    if scenario in ('refseq_to_library', 'refseq_to_library_rerun'):
+        return [sys.executable, script('refseq_to_library.py'), '--all', '-d', tree, '-u', url, '-k', API_KEY,
+                '-i', '', '-m', manifest, '-w', str(workers), '-c', str(max(1, workers // 2)), '-b', '100']
+    if scenario == 'directory_to_library':
+        return [sys.executable, script('directory_to_library.py'), tree, '-n', 'benchmark', '-u', url,
+                '-k', API_KEY, '-w', str(workers), '-b', '100']
+    if scenario == 'library_permissions':
+        return [sys.executable, script('library_permissions.py'), 'benchmark', '-u', url, '-k', API_KEY, '-s',
+                '-e'] + ['user%d@example.org' % i for i in range(USERS)]
+    if scenario == 'galaxy_fuse':
+        return [fuse_python, os.path.join(BENCHMARK_DIR, 'fuse_listing.py'), url, API_KEY]
+    raise ValueError("Unknown scenario " + scenario)
+
+
+def checkScenario(scenario, galaxy, tree, log_path, histories, datasets):
+    '''
+     Function for checking that a scenario did what it should have to the stand-in Galaxy, so a script that
+     exits cleanly without doing its job (e.g. because its requests were refused) isn't counted as a success.
+
+    :param scenario: The name of the scenario
+    :param galaxy: The FakeGalaxy the scenario was run against
+    :param tree: The synthetic RefSeq tree
+    :param log_path: The file the scenario's output was written to
+    :param histories: The number of histories in the stand-in Galaxy
+    :param datasets: The number of visible datasets in each history
+    :return: A description of what is wrong, or None if the results are as expected
+    '''
+
+    if scenario == 'galaxy_fuse':
+        # Every visible dataset, the duplicate, the collection and its two elements
+        expected = histories * (datasets + 1 + 1 + 2) if datasets else histories * 3
+        # The listing is the last line of JSON, which may be followed by warnings at exit
+        listing = None
+        with open(log_path) as log:
+            for line in log:
+                try:
+                    listing = json.loads(line)
+                except ValueError:
+                    pass
+        try:
+            entries = listing['entries']
+        except (KeyError, TypeError):
+            return "no listing in the output"
+        if entries != expected:
+            return "listed %d entries rather than %d" % (entries, expected)
+        return None
+
+    library_names = dict((lib_id, lib['name']) for lib_id, lib in galaxy.libraries.items())
+    if scenario == 'library_permissions':
+        access = [permissions['access_library_role_list'] for lib_id, permissions in galaxy.permissions.items()
+                  if library_names[lib_id] == LIBRARY_NAME]
+        if not access or len(access[0]) != USERS:
+            return "%d users given access rather than %d" % (len(access[0]) if access else 0, USERS)
+        return None
+
+    # Every file in the tree should have been added once, to the genus libraries or to the directory's library
+    wanted = set()
+    for directory, _, files in os.walk(tree):
+        wanted.update(os.path.join(directory, name) for name in files if name != TREE_INFO_FILE)
+    added = [item['file_name'] for item in galaxy.datasets.values()
+             if (library_names[galaxy.folders[item['folder_id']]['library_id']] == LIBRARY_NAME)
+             == (scenario == 'directory_to_library')]
+    missing = len(wanted - set(added))
+    extra = len(added) - len(wanted) + missing
+    if missing or extra:
+        return "%d files missing from the libraries, %d extra datasets" % (missing, extra)
+    return None
+
+
+def runSize(size, scenarios, args):
+    '''
+     Function for running the scenarios for one size, against a fresh stand-in Galaxy.
+
+    :param size: The number of files in the synthetic tree
+    :param scenarios: The names of the scenarios to run
+    :param args: The parsed command line options
+    :return: A list of result dicts, one per scenario
+    '''
+
+    tree = os.path.join(args.work_dir, 'refseq_%d' % size)
+    print("Making tree of " + str(size) + " files in " + tree)
+    makeRefSeqTree(tree, size, genera=max(1, size // 1000))
+
+    manifest = os.path.join(args.work_dir, 'manifest_%d.db' % size)
+    if os.path.exists(manifest):
+        os.remove(manifest)
+
+    galaxy = FakeGalaxy(args.job_time, api_key=API_KEY)
+    galaxy.addUsers(USERS)
+    histories = max(1, size // HISTORY_DATASETS)
+    datasets = min(size, HISTORY_DATASETS)
+    galaxy.addHistories(histories, datasets)
+    server = FakeGalaxyServer(galaxy, latency=args.latency, jitter=args.jitter)
+    url = server.start()
+
+    results = []
+    try:
+        for scenario in scenarios:
+            command = scenarioCommand(scenario, tree, url, manifest, args.workers, args.fuse_python)
+            log_path = os.path.join(args.work_dir, 'logs', '%s_%d.log' % (scenario, size))
+            calls_before = dict(galaxy.calls)
+
+            start = time.time()
+            with open(log_path, 'w') as log:
+                try:
+                    exit_code = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, cwd=REPO_DIR)
+                except OSError as e:
+                    log.write(str(e) + "\n")
+                    exit_code = None
+            seconds = time.time() - start
+
+            calls = dict((call, count - calls_before.get(call, 0)) for call, count in galaxy.calls.items()
+                         if count != calls_before.get(call, 0))
+            problem = checkScenario(scenario, galaxy, tree, log_path, histories, datasets) if exit_code == 0 else None
+            result = {'scenario': scenario, 'files': size, 'seconds': seconds, 'exit_code': exit_code,
+                      'problem': problem, 'requests': sum(calls.values()), 'calls': calls}
+            results.append(result)
+            if exit_code != 0:
+                status = '  FAILED (' + str(exit_code) + ') - see ' + log_path
+            elif problem:
+                status = '  WRONG RESULT (' + problem + ') - see ' + log_path
+            else:
+                status = ''
+            print("  %-26s %8d files %10.2fs %8d requests%s" % (scenario, size, seconds, result['requests'], status))
+    finally:
+        server.stop()
+    return results
+
+
+def gitCommit():
+    '''
+     Function for getting the commit of the repository being benchmarked.
+
+    :return: The commit hash, with "-dirty" appended if there are uncommitted changes, or None outside of git
+    '''
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR).decode('utf-8').strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=REPO_DIR)
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def printComparison(old, new):
+    '''
+     Function for printing the results of two runs side by side.
+
+    :param old: The results of the earlier run
+    :param new: The results of this run
+    :return: None
+    '''
+
+    print("Compared with " + str(old.get('commit')) + ":")
+    old_results = dict(((result['scenario'], result['files']), result) for result in old['results'])
+    for result in new['results']:
+        before = old_results.get((result['scenario'], result['files']))
+        if before is None:
+            continue
+        ratio = result['seconds'] / before['seconds'] if before['seconds'] else 0.0
+        print("  %-26s %8d files %10.2fs -> %8.2fs (x%.2f) %8d -> %8d requests"
+              % (result['scenario'], result['files'], before['seconds'], result['seconds'], ratio,
+                 before['requests'], result['requests']))
+
+
+def main():
+    work_dir = os.path.join(tempfile.gettempdir(), 'galaxy_refseq_benchmarks')
+
+    parser = argparse.ArgumentParser(description='Benchmark the scripts against a stand-in Galaxy.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', help='The numbers of files to benchmark with. Defaults to 1000 10000 100000', default=[1000, 10000, 100000])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, help='The scenarios to run. Defaults to all of them: ' + ', '.join(SCENARIOS), default=SCENARIOS)
+    parser.add_argument('-w', '--workers', type=int, help='The number of workers the scripts are run with. Defaults to 8', default=8)
+    parser.add_argument('-l', '--latency', type=float, help='The number of seconds the stand-in Galaxy adds to every request. Defaults to 0.005', default=0.005)
+    parser.add_argument('-j', '--jitter', type=float, help='Up to this many more seconds, at random, are added to every request. Defaults to 0.005', default=0.005)
+    parser.add_argument('--job_time', type=float, help='The number of seconds an uploaded dataset stays queued. Defaults to 0', default=0.0)
+    parser.add_argument('-d', '--work_dir', type=str, help='The directory to make the synthetic trees, manifests and logs in. Trees are reused between runs. Defaults to galaxy_refseq_benchmarks in the temp directory', default=work_dir)
+    parser.add_argument('--fuse_python', type=str, help='The Python to run galaxy-fuse with. Defaults to python2', default='python2')
+    parser.add_argument('-o', '--output', type=str, help='The file to write the results to, as JSON')
+    parser.add_argument('-c', '--compare', type=str, help='A results file from an earlier run (e.g. of another commit) to compare the results with')
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(args.work_dir, 'logs')):
+        os.makedirs(os.path.join(args.work_dir, 'logs'))
+
+    run = {'commit': gitCommit(),
+           'python': sys.version.split()[0],
+           'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'workers': args.workers,
+           'latency': args.latency,
+           'jitter': args.jitter,
+           'job_time': args.job_time,
+           'results': []}
+    print("Benchmarking commit " + str(run['commit']))
+    for size in args.sizes:
+        run['results'] += runSize(size, args.scenarios, args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            printComparison(json.load(f), run)
+
+    if any(result['exit_code'] != 0 or result['problem'] for result in run['results']):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+'''
+ Parallel checksumming of local files, for finding changed and duplicate files by content.
+
+ Files are hashed by a pool of worker processes, so hashing a large set of genomes uses every
+ core rather than a single one, and each file is read in large blocks so it is read at close to
+ the speed of the disk. Checksums are cached in the sync manifest, keyed by path, size, mtime and
+ inode, so a file is only read again once it has changed.
+
+ ChecksumPool also keeps track of the files claimed for each library during a run, so that a file
+ with the same contents as one already synced to a library (in this run or an earlier one) can be
+ found before it is uploaded again.
+'''
+
+import hashlib
+import multiprocessing
+import os
+import threading
+
+
+# The hash algorithm used for checksums
+CHECKSUM_ALGORITHM = 'sha1'
+
+# The number of bytes read from a file at a time while hashing it
+CHECKSUM_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def hashFile(path):
+    '''
+     Function for hashing the contents of a file. Run in the worker processes of a ChecksumPool.
+
+    :param path: The local path of the file
+    :return: A tuple of (path, hex digest of the contents)
+    '''
+
+    digest = hashlib.new(CHECKSUM_ALGORITHM)
+    with open(path, 'rb') as f:
+        block = f.read(CHECKSUM_BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = f.read(CHECKSUM_BLOCK_SIZE)
+    return path, digest.hexdigest()
+
+
+class ChecksumPool(object):
+    '''
+     Pool of worker processes for checksumming files, with a cache of checksums in the sync manifest.
+     Safe to share between threads.
+
+    :param manifest: The SyncManifest to cache checksums in
+    :param processes: The number of worker processes, 0 for one per CPU
+    '''
+
+    def __init__(self, manifest, processes=0):
+        self.manifest = manifest
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = multiprocessing.Pool(self.processes)
+        self._lock = threading.Lock()
+        self._claimed = {}
+
+    def getChecksums(self, file_paths):
+        '''
+         Get the checksums of a list of files, hashing the ones that aren't cached or have changed since they were.
+
+        :param file_paths: A list of local file paths
+        :return: A dict mapping each file path to its checksum
+        '''
+
+        checksums = {}
+        stats = {}
+        for file_path in file_paths:
+            st = os.stat(file_path)
+            checksum = self.manifest.getChecksum(file_path, st)
+            if checksum:
+                checksums[file_path] = checksum
+            else:
+                stats[file_path] = st
+
+        # Large files are started first, so one doesn't hold up the end of the batch
+        to_hash = sorted(stats, key=lambda file_path: stats[file_path].st_size, reverse=True)
+        for file_path, checksum in self._pool.imap_unordered(hashFile, to_hash):
+            checksums[file_path] = checksum
+            self.manifest.recordChecksum(file_path, stats[file_path], checksum)
+
+        return checksums
+
+    def claim(self, file_path, checksum, library_id):
+        '''
+         Claim a checksum for a file being added to a library, unless another file with the same contents
+         has already been claimed in this run or synced to the library in an earlier one.
+
+        :param file_path: The local path of the file
+        :param checksum: The checksum of the file contents
+        :param library_id: The Galaxy ID of the library
+        :return: The local path of the file with the same contents, or None if the checksum was claimed
+        '''
+
+        with self._lock:
+            duplicate = self._claimed.get((library_id, checksum))
+            if duplicate is None:
+                duplicate = self.manifest.findChecksum(checksum, library_id, exclude_path=file_path)
+            if duplicate is None:
+                self._claimed[(library_id, checksum)] = file_path
+            return duplicate
+
+    def close(self):
+        '''
+         Stop the worker processes.
+
+        :return: None
+        '''
+
+        self._pool.close()
+        self._pool.join()
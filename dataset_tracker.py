@@ -0,0 +1,147 @@
+'''
+ Tracking of the Galaxy jobs behind library uploads, to stop a big sync from flooding the job queue.
+
+ An upload request returns as soon as its datasets are created, but Galaxy still has to run an
+ upload job for each of them. DatasetTracker caps the number of uploaded datasets that haven't
+ reached a terminal state yet: before an upload, room is reserved for its files, waiting until
+ enough earlier datasets have finished. Dataset states are polled with one folder contents
+ request per folder with unfinished datasets, rather than one request per dataset.
+'''
+
+import threading
+import time
+
+
+# Dataset states that a dataset doesn't leave once it reaches them
+TERMINAL_STATES = ('ok', 'error', 'failed_metadata', 'discarded', 'paused', 'deferred')
+
+# Terminal states that mean the upload failed
+FAILED_STATES = ('error', 'failed_metadata', 'discarded', 'paused')
+
+# The number of folder items fetched per folder contents request
+FOLDER_PAGE_SIZE = 1000
+
+
+class DatasetTracker(object):
+    '''
+     Cap on the number of uploaded datasets that are still waiting for their Galaxy jobs. Safe to share between threads.
+
+    :param gi: Galaxy instance object
+    :param max_pending: The maximum number of datasets in non-terminal states at once
+    :param poll_interval: The number of seconds between polls of the dataset states
+    '''
+
+    def __init__(self, gi, max_pending, poll_interval=10):
+        self.gi = gi
+        self.max_pending = max(1, max_pending)
+        self.poll_interval = poll_interval
+        self.pending = {}
+        self.failed = []
+        self._reserved = 0
+        self._polling = False
+        self._last_poll = 0
+        self._cond = threading.Condition()
+
+    def reserve(self, count):
+        '''
+         Wait until there is room for more datasets, and reserve it. A batch larger than the cap is let through once
+         nothing else is pending or reserved.
+
+        :param count: The number of datasets about to be uploaded
+        :return: None
+        '''
+
+        with self._cond:
+            while (self.pending or self._reserved) and len(self.pending) + self._reserved + count > self.max_pending:
+                self._waitForUpdate()
+            self._reserved += count
+
+    def track(self, folder_id, datasets, count):
+        '''
+         Start tracking uploaded datasets, in place of the room reserved for them. If the upload failed part way,
+         only the datasets that were created are given, and the rest of the room is given up.
+
+        :param folder_id: The Galaxy ID of the folder the datasets were uploaded to
+        :param datasets: A list of (name, dataset ID) tuples, where name is used when reporting failures
+        :param count: The number of datasets reserved for the upload
+        :return: None
+        '''
+
+        with self._cond:
+            self._reserved -= count
+            for name, dataset_id in datasets:
+                if dataset_id:
+                    self.pending[dataset_id] = (folder_id, name)
+            self._cond.notify_all()
+
+    def wait(self):
+        '''
+         Wait for every tracked dataset to reach a terminal state.
+
+        :return: A list of (name, dataset ID, state) tuples for every dataset that failed
+        '''
+
+        with self._cond:
+            while self.pending:
+                self._waitForUpdate()
+            return self.failed
+
+    def _waitForUpdate(self):
+        # Called with the condition held. Poll the states if it's time and no one else is, otherwise wait for news.
+        if not self.pending:
+            self._cond.wait()
+            return
+
+        delay = self._last_poll + self.poll_interval - time.time()
+        if self._polling or delay > 0:
+            self._cond.wait(None if self._polling else delay)
+            return
+
+        self._polling = True
+        folders = set(folder_id for folder_id, _ in self.pending.values())
+        self._cond.release()
+        try:
+            states = {}
+            for folder_id in folders:
+                states.update(getFolderStates(self.gi, folder_id))
+        finally:
+            self._cond.acquire()
+            self._polling = False
+            self._last_poll = time.time()
+            self._cond.notify_all()
+
+        for dataset_id, (folder_id, name) in list(self.pending.items()):
+            if folder_id not in folders:
+                continue
+
+            # A dataset missing from its folder has been deleted, so won't finish
+            state = states.get(dataset_id, 'deleted')
+            if state in TERMINAL_STATES or state == 'deleted':
+                del self.pending[dataset_id]
+                if state in FAILED_STATES or state == 'deleted':
+                    self.failed.append((name, dataset_id, state))
+
+
+def getFolderStates(gi, folder_id):
+    '''
+     Function for getting the states of the datasets in a library folder, fetching the folder contents a page at a time.
+
+    :param gi: Galaxy instance object
+    :param folder_id: The Galaxy ID of the folder
+    :return: A dict mapping library dataset ID to state
+    '''
+
+    states = {}
+    offset = 0
+    while True:
+        contents = gi.make_get_request(gi.url + '/folders/' + folder_id + '/contents',
+                                       params={'limit': FOLDER_PAGE_SIZE, 'offset': offset}).json()
+        # Galaxy releases that don't report dataset states here can't be tracked, so their datasets count as done
+        for item in contents['folder_contents']:
+            if item['type'] == 'file':
+                states[item['id']] = item.get('state', 'ok')
+
+        # Older Galaxy releases return the whole folder at once, without a total
+        offset += FOLDER_PAGE_SIZE
+        if offset >= contents['metadata'].get('total_rows', 0):
+            return states
@@ -1,7 +1,15 @@
 '''
  Script to make data library of local file/directory structure.
 usage: directory_to_library.py [-h] [-u URL] [-k KEY] [-n NAME] [-v]
-                               [-t [FILETYPES [FILETYPES ...]]] [-e]
+                               [-t [FILETYPES [FILETYPES ...]]] [-e] [-w WORKERS]
+                               [--timeout TIMEOUT] [--retries RETRIES]
+                               [-b BATCH_SIZE] [--batch_bytes BATCH_BYTES]
+                               [--max_pending MAX_PENDING]
+                               [--poll_interval POLL_INTERVAL]
+                               [-m MANIFEST] [--checksum]
+                               [--checksum_processes CHECKSUM_PROCESSES]
+                               [--skip_duplicates] [-p PLAN] [--report REPORT]
+                               [--prometheus PROMETHEUS]
                                [-a [ALLOW_USERS [ALLOW_USERS ...]]]
                                directory
 
@@ -23,6 +31,51 @@ optional arguments:
                         data library. Defaults to fna, faa, ffn, gbk, gff
   -e, --exclude         Exclude the file types specified in -t. Defaults to
                         excluding fna, faa, ffn, gbk, gff
+  -w WORKERS, --workers WORKERS
+                        The number of folders to create, and uploads to run,
+                        concurrently. Defaults to 1
+  --timeout TIMEOUT     The number of seconds to wait for Galaxy to respond
+                        before giving up on a request. Defaults to 300
+  --retries RETRIES     The number of times to retry a request that failed
+                        with a temporary error. Defaults to 5
+  -b BATCH_SIZE, --batch_size BATCH_SIZE
+                        The maximum number of files to link in a single upload
+                        request to a local Galaxy. Defaults to 1
+  --batch_bytes BATCH_BYTES
+                        The maximum total size, in bytes, of the files linked
+                        in a single upload request to a local Galaxy. Defaults
+                        to 0 (no limit)
+  --max_pending MAX_PENDING
+                        The maximum number of uploaded datasets waiting for
+                        their Galaxy jobs to finish at once. Uploads wait for
+                        earlier ones to finish, and failed datasets are listed
+                        at the end. Defaults to 0 (no limit)
+  --poll_interval POLL_INTERVAL
+                        The number of seconds between checks of the states of
+                        uploaded datasets, with --max_pending. Defaults to 10
+  -m MANIFEST, --manifest MANIFEST
+                        A sync manifest file. Directories and files that are
+                        unchanged since they were recorded in the manifest are
+                        skipped, and files that have changed are replaced.
+  --checksum            Checksum files (caching the checksums in the
+                        manifest), so only files whose contents have changed
+                        are replaced. Needs -m.
+  --checksum_processes CHECKSUM_PROCESSES
+                        The number of processes to checksum files with.
+                        Defaults to 0 (one per CPU)
+  --skip_duplicates     Skip files with the same contents as a file already
+                        added to the library. Needs --checksum.
+  -p PLAN, --plan PLAN  Write a plan of the folders and files that would be
+                        added to the library, as newline-delimited JSON, to
+                        this file ("-" for stdout), without changing the
+                        library. The manifest is not used.
+  --report REPORT       Write a JSON report of the Galaxy API calls made (with
+                        counts, latency histograms and bytes transferred) and
+                        the time spent in each phase to this file when the run
+                        ends
+  --prometheus PROMETHEUS
+                        Write the same report as a Prometheus textfile to this
+                        file when the run ends
   -a [ALLOW_USERS [ALLOW_USERS ...]], --allow_users [ALLOW_USERS [ALLOW_USERS ...]]
                         A space-seperated list of emails of users to allow
                         access to the data library. Defaults to None- a public
@@ -34,12 +87,28 @@ optional arguments:
 '''
 
 from __future__ import print_function
-from bioblend.galaxy import GalaxyInstance
+from collections import defaultdict
+from api_metrics import RunMetrics, instrumentClient
+from checksums import ChecksumPool
+from dataset_tracker import DatasetTracker
+from galaxy_client import GalaxyClient, addClientArguments
+from library_index import LibraryIndex
+from sync_manifest import DirectoryRecorder, SyncManifest
+from sync_plan import PlanWriter
+from upload_pool import UploadPool, batchFiles, uploadFiles
 
 import argparse
 import os
 import sys
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+# Number of files to walk before planning directories and queueing uploads for them
+CHUNK_FILES = 1000
+
 
 def printerr(*args):
     '''
@@ -52,128 +121,320 @@ def printerr(*args):
     print(*args, file=sys.stderr)
 
 
-def getFilesInLibrary(contents):
+def walkFilesToInclude(filepath, file_types, exclude=False):
+    '''
+     Generator for walking a directory tree, top down, listing the files of a given type (or the inverse) in each directory.
+     Like os.walk, symlinks to directories are not followed.
+
+    :param filepath: The path of the top-level directory.
+    :param file_types: A list of file types you wish to include/exclude.
+    :param exclude: False if you want to include files matching those in file_types,
+            True if you want to exclude files matching those in file_types.
+    :return: A generator of (directory path as a list relative to filepath, list of file names) tuples,
+             for each directory with files to include
+    '''
+
+    stack = [[]]
+    while stack:
+        dirpath = stack.pop()
+        subdirs = []
+        filenames = []
+        try:
+            for entry in scandir(os.path.join(filepath, *dirpath)):
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
+                elif includeFile(entry.name, file_types, exclude):
+                    filenames.append(entry.name)
+        except OSError:
+            # Like os.walk, skip directories that can't be read, or have gone (e.g. while a mirror is syncing)
+            continue
+
+        if filenames:
+            yield dirpath, sorted(filenames)
+        stack.extend(dirpath + [name] for name in sorted(subdirs, reverse=True))
+
+def walkChangedFilesToInclude(manifest, filepath, library_id, file_types, exclude=False, verbose=False):
+    '''
+     Generator for walking a directory tree, top down, listing the files of a given type (or the inverse) in each
+     directory that have changed since they were recorded in the sync manifest. Directories that are unchanged
+     since they were recorded are not listed at all.
+
+    :param manifest: The SyncManifest
+    :param filepath: The path of the top-level directory.
+    :param library_id: The Galaxy ID of the library the directory is synced to
+    :param file_types: A list of file types you wish to include/exclude.
+    :param exclude: False if you want to include files matching those in file_types,
+            True if you want to exclude files matching those in file_types.
+    :param verbose: True if we're outputting debugging info.
+    :return: A generator of (directory path as a list relative to filepath, list of file names,
+             (local directory path, directory mtime, subdirectory names)) tuples, for each changed directory
+    '''
+
+    for path, mtime, subdirs, filenames in manifest.walkChanged(filepath, library_id):
+        dirpath = [d for d in os.path.relpath(path, filepath).split(os.sep) if d != "."]
+
+        # Skip files that haven't changed since the last sync.
+        changed_files = []
+        for filename in filenames:
+            if includeFile(filename, file_types, exclude):
+                local_path = os.path.join(path, filename)
+                if manifest.isFileUnchanged(local_path, os.stat(local_path), library_id):
+                    if verbose: print("File unchanged - " + filepathToString(dirpath + [filename]))
+                else:
+                    changed_files.append(filename)
+
+        yield dirpath, changed_files, (path, mtime, subdirs)
+
+def chunkDirectories(directories, max_files):
     '''
-     Function for getting a list of all files in a library.
+     Generator for grouping the directories from a walk into chunks, so each chunk can be planned and synced
+     while the walk carries on, without holding the whole tree in memory.
 
-    :param contents: The contents of the library - can be obtained with show_library(lib['id'], contents=True).
-    :return: A list of file names, including their directory path (strings) within library.
+    :param directories: An iterable of (directory path, list of file names, ...) tuples
+    :param max_files: The number of files after which a chunk is finished
+    :return: A generator of lists of directory tuples
     '''
 
-    return [item['name'] for item in contents if item['type'] == 'file']
+    chunk = []
+    files = 0
+    for directory in directories:
+        chunk.append(directory)
+        files += len(directory[1])
+        if files >= max_files:
+            yield chunk
+            chunk = []
+            files = 0
 
+    if chunk:
+        yield chunk
 
-def getFilesToInclude(filepath, file_types, exclude=False):
+def includeFile(filename, file_types, exclude=False):
     '''
-     Function for getting a list of all files of a given type (or the inverse).
+     Function for checking whether a file is of a given type (or the inverse). Hidden files are never included.
 
-    :param filepath: The path of the folder containing the files.
+    :param filename: The name of the file.
     :param file_types: A list of file types you wish to include/exclude.
-    :param include: True if you want to get files matching those in fileTypes,
-            False if you want to exclude files matching those in fileTypes.
-    :return: A list of file names (strings) within folder
+    :param exclude: False if you want to include files matching those in file_types,
+            True if you want to exclude files matching those in file_types.
+    :return: True if the file should be included
     '''
 
-    # Get all files and folders in the specified directory
-    dirlist = []
-    for root, dirs, files in os.walk(filepath):
-        for name in files:
-            dirlist.append(os.path.join(root, name).replace(filepath, ""))
+    if filename[0] == ".":  # Don't include hidden files.
+        return False
+
+    # Compare the file extension with the file_types list.
+    return filename.endswith(tuple(file_types)) != exclude
+
+def planDirectories(dirpaths, index):
+    """
+    Function to work out which directories need creating in a galaxy data library, given the directories
+    that files will be added to. Every parent of a directory is included, as the library needs those too.
+
+    :param dirpaths: The directory paths files will be added to, as lists (e.g. ['refseq', 'salmonella'])
+    :param index: The LibraryIndex of the library
+    :return: A list of levels, shallowest first, each a sorted list of the library paths of the missing
+             directories at that depth (e.g. [['/refseq'], ['/refseq/salmonella']])
+    """
+
+    needed = set()
+    for dirpath in dirpaths:
+        for dir_index in range(len(dirpath)):
+            needed.add(filepathToString(dirpath[:dir_index + 1]))
 
-    # By default, we check if the filetype is in the filetypes.
-    compareFunc=lambda ftype,ftypes: ftype.endswith(tuple(ftypes))
-    if exclude: # Overriding default behaviour
-        compareFunc=lambda ftype,ftypes: not ftype.endswith(tuple(ftypes))
+    levels = defaultdict(list)
+    for directory in needed:
+        if not index.hasFolder(directory):
+            levels[directory.count("/")].append(directory)
 
-    files_to_include = []
-    for fileName in dirlist:
-        # Compare the file extension with the fileTypes list.
-        if compareFunc(fileName, file_types):
-            if fileName.split("/")[-1][0] != ".":  # Don't include hidden files.
-                files_to_include.append(fileName)
+    return [sorted(levels[depth]) for depth in sorted(levels)]
 
-    return files_to_include
 
-def makeDirectoryOrFile(gi, lib, galaxy_parent_dir, local_parent_dir, filepath, dir_index, galaxy_url, verbose):
+def makeDirectory(gi, lib, index, directory, verbose):
     """
-    Recursive function for traversing a filepath, and at each step, make either a directory or a file in a
-    galaxy data library. Allows us to copy a whole directory structure in a galaxy data library.
+    Function to make a directory in a galaxy data library, and add it to the library index.
+    The parent directory must already be in the index.
 
     :param gi: Galaxy instance object
-    :param lib: The Galaxy library object, representing the library to create the directory structure in
-    :param galaxy_parent_dir: The galaxy directory object of the parent dir of our current traversal location.
-    :param local_parent_dir: The local filepath that preceeds the top-level directory of the structure we're creating.
-    :param filepath: The filepath to traverse, as a list (e.g. ['refseq', 'salmonella', 'ABC.gbk'])
-    :param dir_index: The index of the filepath that we're currently looking at
-    :param galaxy_url: The URL of the galaxy instance
+    :param lib: The Galaxy library object, representing the library to create the directory in
+    :param index: The LibraryIndex of the library
+    :param directory: The library path of the directory (e.g. '/refseq/salmonella')
     :param verbose: True if we're outputting debugging info.
     :return: None
     """
 
-    current_filepath = filepathToString(filepath[:dir_index + 1])
-    lib_dirs = [d['name'] for d in gi.libraries.get_folders(lib['id'])]
-    if dir_index == len(filepath)-1:
-        makeFile(gi, lib, galaxy_parent_dir, local_parent_dir, filepath, galaxy_url, verbose)
-    else:
-        # Check if folder exists, get required info if it does, otherwise create it
-        if current_filepath in lib_dirs:
-            if verbose: print("Directory exists: " + current_filepath)
+    if verbose: print("Adding directory to library - " + directory)
+    parent, _, name = directory.rpartition("/")
+    galaxy_folder = gi.libraries.create_folder(lib['id'], name, base_folder_id=index.getFolderId(parent or "/"))[0]
+    index.addFolder(directory, galaxy_folder['id'])
 
-            # Get directory information
-            galaxy_folder = gi.libraries.get_folders(lib['id'], name=current_filepath)[0]
-        else:
-            if verbose: print("Adding directory to library - " + current_filepath)
-            galaxy_folder = gi.libraries.create_folder(lib['id'],
-                                              current_filepath.split("/")[-1],
-                                              base_folder_id=galaxy_parent_dir['id'])[0]
 
-        dir_index += 1
-        makeDirectoryOrFile(gi, lib, galaxy_folder, local_parent_dir, filepath, dir_index, galaxy_url, verbose)
+def makeDirectories(gi, lib, index, levels, workers, verbose):
+    """
+    Function to make all the planned directories in a galaxy data library. Each level is made in parallel,
+    and only once the level above it is finished, so every directory's parent exists when it is made.
 
+    :param gi: Galaxy instance object
+    :param lib: The Galaxy library object, representing the library to create the directories in
+    :param index: The LibraryIndex of the library
+    :param levels: The missing directories, from planDirectories()
+    :param workers: The number of directories to make at once
+    :param verbose: True if we're outputting debugging info.
+    :return: A list of (directory, exception) tuples for every directory that could not be made, including those
+             skipped because a directory above them could not be made
+    """
 
-def makeFile(gi, lib, galaxy_parent_dir, local_parent_dir, filepath, galaxy_url, verbose):
+    errors = []
+    # directory that could not be made: (the directory above it that failed, or itself, and that one's exception)
+    failed = {}
+    for level in levels:
+        pool = UploadPool(workers)
+        for directory in level:
+            # Directories under one that could not be made can't be made either
+            parent = directory.rpartition("/")[0] or "/"
+            if index.hasFolder(parent):
+                pool.submit(directory, makeDirectory, gi, lib, index, directory, verbose)
+            else:
+                failed[directory] = failed[parent]
+                errors.append((directory, Exception("directory " + failed[parent][0] + " could not be added: " +
+                                                    str(failed[parent][1]))))
+        for directory, error in pool.join():
+            failed[directory] = (directory, error)
+            errors.append((directory, error))
+    return errors
+
+
+def getFileType(filename):
+    """
+    Function to get the Galaxy datatype to upload a file as.
+
+    :param filename: The name of the file
+    :return: 'fastqsanger' for fastq files, otherwise 'auto' to let Galaxy detect the datatype
     """
-    Function to add a file to a galaxy data library.
-    If the Galaxy instance is local, it will make a symlink instead of uploading.
+
+    extension = os.path.splitext(filename)[1]
+    if extension == '.fq' or extension == '.fastq':
+        return 'fastqsanger'
+    return 'auto'
+
+
+def makeFiles(gi, lib, index, local_parent_dir, dirpath, filenames, galaxy_url, pool, verbose,
+              batch_size=1, batch_bytes=0, manifest=None, checksums=None, checksum_pool=None, duplicates=None,
+              tracker=None, recorder=None):
+    """
+    Function to add the files in a directory to a galaxy data library. The directory must already be in
+    the library index. The uploads are queued on the upload pool.
+    If the Galaxy instance is local, it will make symlinks instead of uploading, linking up to
+    batch_size files (and batch_bytes bytes) of the same datatype in each request.
+    If a manifest is given, added files are recorded in it, and files that have changed since they
+    were recorded are replaced. If checksums are given, a file is only treated as changed if its contents
+    have changed, and if a list of duplicates is given, files with the same contents as one already added to
+    the library are skipped.
 
     :param gi: Galaxy instance object
     :param lib: The Galaxy library object, representing the library to create the directory structure in
-    :param galaxy_parent_dir: The galaxy directory object of the parent dir of the file.
-    :param local_parent_dir: The local filepath that preceeds the filepath param below.
-    :param filepath: The filepath to traverse, as a list (e.g. ['refseq', 'salmonella', 'ABC.gbk'])
+    :param index: The LibraryIndex of the library
+    :param local_parent_dir: The local filepath that preceeds the dirpath param below.
+    :param dirpath: The path of the directory containing the files, as a list (e.g. ['refseq', 'salmonella'])
+    :param filenames: The names of the files in the directory to add
     :param galaxy_url: The URL of the galaxy instance
+    :param pool: The UploadPool to queue uploads on
     :param verbose: True if we're outputting debugging info.
+    :param batch_size: The maximum number of files to link in a single request.
+    :param batch_bytes: The maximum total size of the files linked in a single request, 0 for no limit.
+    :param manifest: The SyncManifest to record the files in, or None
+    :param checksums: A dict mapping local file paths to checksums, or None
+    :param checksum_pool: The ChecksumPool to claim the checksums of added files with, if skipping duplicates
+    :param duplicates: A list to append (local path, local path of the file with the same contents) to for
+                       each duplicate file skipped, or None to add duplicates
+    :param tracker: The DatasetTracker to limit the number of unfinished uploads with, or None
+    :param recorder: The DirectoryRecorder to record the directory with once its uploads finish, or None. The
+                     directory must already have been started on it.
     :return: None
     """
 
-    filename = filepath[-1]
-    # If file doesn't exist, add it
-    if filepathToString(filepath) not in getFilesInLibrary(gi.libraries.show_library(lib['id'], contents=True)):
-        if verbose: print("Adding file - " + filepathToString(filepath))
-        
-        filetype = 'auto'
-
-        simon_filename, simon_file_extension = os.path.splitext(filename)
-        print ("filename " + filename + " filetype " + simon_file_extension)
-        if simon_file_extension == '.fq' or simon_file_extension == '.fastq':
-            filetype = 'fastqsanger'
+    galaxy_dir = filepathToString(dirpath)
+    galaxy_dir_id = index.getFolderId(galaxy_dir)
+
+    # Group the files to add by datatype, as each request can only set one datatype
+    files_to_add = defaultdict(list)
+    replaced = {}
+    for filename in filenames:
+        filepath = dirpath + [filename]
+        local_path = os.path.join(local_parent_dir, *filepath)
+        checksum = checksums.get(local_path) if checksums else None
+        record = manifest.getFile(local_path, lib['id']) if manifest else None
+
+        # If file doesn't exist, add it - unless the library already has a file with the same contents
+        if not index.hasFile(galaxy_dir, filename):
+            duplicate = None
+            if checksum and duplicates is not None:
+                duplicate = checksum_pool.claim(local_path, checksum, lib['id'])
+            if duplicate:
+                if verbose: print("Skipping duplicate file - " + filepathToString(filepath) + " (same as " + duplicate + ")")
+                duplicates.append((local_path, duplicate))
+                # The directory is only synced once the file it duplicates has been added
+                if recorder:
+                    recorder.follow(os.path.dirname(local_path), os.path.dirname(duplicate))
+                continue
+
+            filetype = getFileType(filename)
+            if verbose: print("Adding file - " + filepathToString(filepath) + " (filetype " + filetype + ")")
+            files_to_add[filetype].append(local_path)
+        elif record is not None and not ((checksum and record['checksum'] == checksum)
+                                         or manifest.isFileUnchanged(local_path, os.stat(local_path), lib['id'])):
+            # The file has changed since it was added - replace it, deleting the old one once it's uploaded
+            if verbose: print("Replacing changed file - " + filepathToString(filepath))
+            replaced[local_path] = index.getFileId(galaxy_dir, filename)
+            files_to_add[getFileType(filename)].append(local_path)
+        else:
+            if verbose: print("File exists - " + filename)
+            if manifest:
+                manifest.recordFile(local_path, os.stat(local_path), lib['id'], galaxy_dir_id,
+                                    index.getFileId(galaxy_dir, filename), checksum)
 
+    for filetype, local_paths in files_to_add.items():
+        # Links to a local Galaxy can be made for several files at once, uploads are one file per request
         if "127.0.0.1" in galaxy_url or "localhost" in galaxy_url:
-            # Local Galaxy server - create a symbolic link instead of a copy
-            gi.libraries.upload_from_galaxy_filesystem(
-                library_id=lib['id'],
-                filesystem_paths=local_parent_dir + filepathToString(filepath),
-                folder_id=galaxy_parent_dir['id'],
-                file_type=filetype,
-                link_data_only="link_to_files")
+            batches = batchFiles(local_paths, batch_size, batch_bytes)
         else:
-            # Remote Galaxy server - copy files from local machine
-            gi.libraries.upload_file_from_local_path(
-                library_id=lib['id'],
-                file_local_path=local_parent_dir + filepathToString(filepath),
-                folder_id=galaxy_parent_dir['id'])
-    else:
-        if verbose: print("File exists - " + filename)
+            batches = [[local_path] for local_path in local_paths]
+
+        for batch in batches:
+            upload = recorder.wrap(os.path.join(local_parent_dir, *dirpath), uploadFiles) if recorder else uploadFiles
+            pool.submit(batch, upload, gi, lib, index, galaxy_dir, galaxy_dir_id, batch, galaxy_url,
+                        manifest, filetype, checksums, tracker, replaced)
+
+def writePlan(gi, libraries, lib_name, local_directory, file_types, exclude, plan_path):
+    """
+    Function to write a plan of the folders and files that syncing a directory would add to a galaxy data
+    library, from one snapshot of the library and one walk of the directory. Nothing in Galaxy is changed.
+
+    :param gi: Galaxy instance object
+    :param libraries: The existing libraries - obtained with get_libraries(deleted=False)
+    :param lib_name: The name of the library
+    :param local_directory: The directory to make the library from
+    :param file_types: A list of file types you wish to include/exclude.
+    :param exclude: True if you want to exclude files matching those in file_types.
+    :param plan_path: The file to write the plan to, or "-" for stdout
+    :return: None
+    """
+
+    existing = [lib for lib in libraries if lib['name'] == lib_name and not lib['deleted']]
+    index = LibraryIndex(gi, existing[0]) if existing else None
+
+    local_files = ((filepathToString(dirpath), filename, os.path.join(local_directory, *(dirpath + [filename])))
+                   for dirpath, filenames in walkFilesToInclude(local_directory, file_types, exclude)
+                   for filename in filenames)
+
+    out = sys.stdout if plan_path == "-" else open(plan_path, "w")
+    try:
+        plan = PlanWriter(out)
+        plan.writeLibrary(lib_name, index, local_files)
+        plan.close()
+    finally:
+        if out is not sys.stdout:
+            out.close()
 
 def filepathToString(filepath):
     """
@@ -232,10 +493,27 @@ def main():
     parser.add_argument('-v', '--verbose', action="store_true", help='Print out debugging information')
     parser.add_argument('-t', '--filetypes', nargs='*', help='A space-seperated list of filetypes to include in the data library. Defaults to fna, faa, ffn, gbk, gff', default=file_types)
     parser.add_argument('-e', '--exclude', action='store_true', help='Exclude the file types specified in -t. Defaults to excluding fna, faa, ffn, gbk, gff')
+    parser.add_argument('-w', '--workers', type=int, help='The number of folders to create, and uploads to run, concurrently. Defaults to 1', default=1)
+    addClientArguments(parser)
+    parser.add_argument('-b', '--batch_size', type=int, help='The maximum number of files to link in a single upload request to a local Galaxy. Defaults to 1', default=1)
+    parser.add_argument('--batch_bytes', type=int, help='The maximum total size, in bytes, of the files linked in a single upload request to a local Galaxy. Defaults to 0 (no limit)', default=0)
+    parser.add_argument('-m', '--manifest', type=str, help='A sync manifest file. Directories and files that are unchanged since they were recorded in the manifest are skipped, and files that have changed are replaced.')
+    parser.add_argument('--max_pending', type=int, help='The maximum number of uploaded datasets waiting for their Galaxy jobs to finish at once. Uploads wait for earlier ones to finish, and failed datasets are listed at the end. Defaults to 0 (no limit)', default=0)
+    parser.add_argument('--poll_interval', type=float, help='The number of seconds between checks of the states of uploaded datasets, with --max_pending. Defaults to 10', default=10)
+    parser.add_argument('--checksum', action='store_true', help='Checksum files (caching the checksums in the manifest), so only files whose contents have changed are replaced. Needs -m.')
+    parser.add_argument('--checksum_processes', type=int, help='The number of processes to checksum files with. Defaults to 0 (one per CPU)', default=0)
+    parser.add_argument('--skip_duplicates', action='store_true', help='Skip files with the same contents as a file already added to the library. Needs --checksum.')
+    parser.add_argument('-p', '--plan', type=str, help='Write a plan of the folders and files that would be added to the library, as newline-delimited JSON, to this file ("-" for stdout), without changing the library. The manifest is not used.')
+    parser.add_argument('--report', type=str, help='Write a JSON report of the Galaxy API calls made (with counts, latency histograms and bytes transferred) and the time spent in each phase to this file when the run ends')
+    parser.add_argument('--prometheus', type=str, help='Write the same report as a Prometheus textfile to this file when the run ends')
     parser.add_argument('-a', '--allow_users', nargs='*', help='A space-seperated list of emails of users to allow access to the data library. For existing libraries, these users will be appended to the existing permissions list.', default=[])
 
     # Parse args.
     args = parser.parse_args()
+    if args.checksum and not args.manifest:
+        parser.error("--checksum needs a manifest (-m)")
+    if args.skip_duplicates and not args.checksum:
+        parser.error("--skip_duplicates needs --checksum")
 
     # Renaming for readability.
     local_directory = args.directory
@@ -259,6 +537,13 @@ def main():
         print("File types: " + str(file_types))
         print("Exclude: " + str(args.exclude))
         print("Users: " + str(allow_users))
+        print("Workers: " + str(args.workers))
+        print("Batch size: " + str(args.batch_size) + " files, " + str(args.batch_bytes) + " bytes")
+        print("Max pending datasets: " + str(args.max_pending) + ", polled every " + str(args.poll_interval) + " seconds")
+        print("Manifest: " + str(args.manifest))
+        print("Checksum: " + str(args.checksum) + ", " + str(args.checksum_processes) + " processes, skip duplicates " + str(args.skip_duplicates))
+        print("Plan: " + str(args.plan))
+        print("Report: " + str(args.report) + ", Prometheus: " + str(args.prometheus))
 
     # Check the RefSeq directory exists, exit if we can't find it.
     if not os.path.isdir(local_directory):
@@ -267,7 +552,11 @@ def main():
 
     # Initiating Galaxy connection.
     if args.verbose: print("Connecting to Galaxy")
-    gi = GalaxyInstance(url=galaxy_url, key=galaxy_key)
+    gi = GalaxyClient(galaxy_url, galaxy_key, workers=args.workers, timeout=args.timeout, retries=args.retries)
+
+    # Calls to Galaxy and phases of local work are timed for the report.
+    metrics = RunMetrics('directory_to_library')
+    instrumentClient(gi, metrics)
 
     # Get list of existing libraries.
     libraries = gi.libraries.get_libraries(deleted=False)
@@ -278,6 +567,14 @@ def main():
 
     if args.verbose: print("Library name: " + possible_lib_name)
 
+    # Only write a plan of the changes, if asked to - nothing in Galaxy is changed.
+    if args.plan:
+        with metrics.phase('plan'):
+            writePlan(gi, libraries, possible_lib_name, local_directory, file_types, args.exclude, args.plan)
+        if args.report or args.prometheus:
+            metrics.writeReport(args.report, args.prometheus, gi.stats.summary())
+        sys.exit(0)
+
     # Get existing library info if it does exist, if it doesn't exist create library.
     if possible_lib_name in [lib['name'] for lib in libraries if not lib['deleted']]:
         if args.verbose: print("Library already exists - checking it is up to date")
@@ -310,16 +607,123 @@ def main():
                                          add_in=current_permissions["add_library_item_role_list"],
                                          manage_in=current_permissions["manage_library_role_list"])
 
-    # Get list of files and directories to include.
-    filepaths_to_include = getFilesToInclude(local_directory, file_types, args.exclude)
-
-    # For each species specified, go through each folder and add appropriate files
-    galaxy_parent_dir = gi.libraries.get_folders(lib['id'], name="/")[0]
-
-    # Add each file and directory.
-    for filepath in filepaths_to_include:
-        makeDirectoryOrFile(gi, lib, galaxy_parent_dir, local_directory, filepath.split("/"), 0,
-                            galaxy_url, args.verbose)
+    # Walk the directory, only listing changed directories if we have a manifest.
+    manifest = None
+    if args.manifest:
+        manifest = SyncManifest(args.manifest)
+        manifest.checkOptions(lib['id'], str(sorted(file_types)) + " exclude=" + str(args.exclude))
+        directories = walkChangedFilesToInclude(manifest, local_directory, lib['id'], file_types, args.exclude,
+                                                args.verbose)
+    else:
+        directories = ((dirpath, filenames, None) for dirpath, filenames
+                       in walkFilesToInclude(local_directory, file_types, args.exclude))
+
+    # The snapshot of the library's folders and files is taken once there are files to check, and kept up
+    # to date as they are added.
+    index = None
+
+    # Uploads start as soon as the first chunk of the walk is ready, while the walk carries on. The upload
+    # pool's queue is bounded, so the walk waits for the uploads rather than getting far ahead of them.
+    # The checksum processes are started before the upload threads, so they aren't forked from a threaded process.
+    checksum_pool = ChecksumPool(manifest, args.checksum_processes) if args.checksum else None
+    duplicates = [] if args.skip_duplicates else None
+
+    # Uploads wait for room among the unfinished datasets, if we're limiting them.
+    tracker = DatasetTracker(gi, args.max_pending, args.poll_interval) if args.max_pending else None
+
+    # Directories are recorded in the manifest as their uploads finish, rather than all at the end.
+    recorder = DirectoryRecorder(manifest, lib['id']) if manifest else None
+
+    pool = UploadPool(args.workers)
+    folder_errors = []
+    for chunk in chunkDirectories(metrics.timeIterator('scan', directories), CHUNK_FILES):
+        # Directories without files to add are synced already
+        if manifest:
+            for _, filenames, (path, mtime, subdirs) in chunk:
+                if not filenames:
+                    manifest.recordDirectory(path, mtime, lib['id'], subdirs)
+
+        if not any(filenames for _, filenames, _ in chunk):
+            continue
+        if index is None:
+            index = LibraryIndex(gi, lib)
+
+        # Make every missing directory in the chunk before any of its files are added.
+        levels = planDirectories([dirpath for dirpath, filenames, _ in chunk if filenames], index)
+        if args.verbose: print("Directories to add: " + str(sum(len(level) for level in levels)))
+        with metrics.phase('folders'):
+            folder_errors += makeDirectories(gi, lib, index, levels, args.workers, args.verbose)
+
+        # Checksum the chunk's files in parallel, if we're comparing files by their contents.
+        chunk = [(dirpath, filenames, record) for dirpath, filenames, record in chunk
+                 if filenames and index.hasFolder(filepathToString(dirpath))]
+        checksums = None
+        if checksum_pool:
+            with metrics.phase('checksum'):
+                checksums = checksum_pool.getChecksums([os.path.join(local_directory, *(dirpath + [filename]))
+                                                        for dirpath, filenames, _ in chunk for filename in filenames])
+
+        # Add the files in every directory that exists. Time spent here includes waiting for room in the upload queue.
+        # Directories whose library folder couldn't be made are left out, so aren't recorded.
+        with metrics.phase('queue_uploads'):
+            for dirpath, filenames, record in chunk:
+                if recorder:
+                    recorder.start(*record)
+                makeFiles(gi, lib, index, local_directory, dirpath, filenames, galaxy_url, pool, args.verbose,
+                          args.batch_size, args.batch_bytes, manifest, checksums, checksum_pool, duplicates, tracker,
+                          recorder)
+                if recorder:
+                    recorder.finish(record[0])
+
+    with metrics.phase('finish_uploads'):
+        errors = pool.join()
+    if checksum_pool:
+        checksum_pool.close()
+
+    # Wait for the uploaded datasets to finish, so any that failed can be listed.
+    failed_datasets = []
+    if tracker:
+        if args.verbose: print("Waiting for " + str(len(tracker.pending)) + " dataset(s) to finish")
+        with metrics.phase('finish_datasets'):
+            failed_datasets = tracker.wait()
+
+    # Directories with failed uploads were never recorded. Failed datasets, and their directories, are forgotten,
+    # so they are added again once they have been deleted from the library, as are the directories of any
+    # duplicates of them that were skipped.
+    if manifest:
+        failed_paths = set(local_path for local_path, _, _ in failed_datasets)
+        for local_path in failed_paths:
+            manifest.forgetFile(local_path, lib['id'])
+            manifest.forgetDirectory(os.path.dirname(local_path), lib['id'])
+        for local_path, duplicate in duplicates or []:
+            if duplicate in failed_paths:
+                manifest.forgetDirectory(os.path.dirname(local_path), lib['id'])
+        manifest.close()
+
+    if args.verbose: print("Galaxy requests: " + str(gi.stats.summary()))
+    if args.report or args.prometheus:
+        metrics.writeReport(args.report, args.prometheus, gi.stats.summary())
+
+    # List the duplicate files that were skipped.
+    if duplicates:
+        print(str(len(duplicates)) + " duplicate file(s) skipped:")
+        for local_path, duplicate in duplicates:
+            print("  " + local_path + " (same as " + duplicate + ")")
+
+    # Report any directories and files that could not be added.
+    for directory, error in folder_errors:
+        printerr("ERROR: Directory " + directory + " could not be added to the library: " + str(error))
+    if errors:
+        printerr("ERROR: " + str(sum(len(local_paths) for local_paths, _ in errors)) + " file(s) could not be added to the library:")
+        for local_paths, error in errors:
+            for local_path in local_paths:
+                printerr("  " + local_path + ": " + str(error))
+    if failed_datasets:
+        printerr("ERROR: " + str(len(failed_datasets)) + " dataset(s) failed in Galaxy - delete them from the library and run again to retry:")
+        for local_path, dataset_id, state in failed_datasets:
+            printerr("  " + local_path + ": dataset " + dataset_id + " is " + state)
+    if folder_errors or errors or failed_datasets:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,510 @@
+'''
+ Cache of values fetched from Galaxy for galaxy-fuse, safe to share between FUSE threads.
+
+ fusepy runs each file system operation in its own thread, so when an entry expires several
+ threads can miss it at once. FetchCache makes sure only one fetch per key is in flight: the
+ first thread to miss fetches the value, and the others wait for its result rather than sending
+ the same request again. A failed fetch isn't cached; its error is raised in every waiting thread.
+
+ A value can be fetched for a version of what it was fetched from (e.g. the update time of a
+ history), rather than for a fixed time. It is then kept until a different version is asked for,
+ and can be brought up to date from the value already cached rather than fetched again in full.
+
+ So that file system operations don't wait on Galaxy once a value has been fetched, an out of
+ date value can be served for a while longer (stale_time) while a background thread refreshes
+ it, and values that are in use are refreshed by that thread shortly before they expire
+ (refresh_ahead). Only values that have never been fetched, or are too old to serve, are
+ fetched by the thread asking for them.
+
+ A mount can stay up for weeks and touch thousands of histories, so the cache is bounded: it holds
+ at most a number of entries and an approximate number of bytes, and evicts the least recently
+ used entries to stay within them.
+
+ BlockCache keeps blocks of dataset contents read from a remote Galaxy in files in a directory,
+ and likewise evicts the least recently used to stay within a number of bytes. It is kept between
+ mounts.
+'''
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+# Approximate overhead, in bytes, of each object counted by approximateSize()
+OBJECT_OVERHEAD = 56
+
+# Number of seconds between the background thread's checks for values about to expire
+REFRESH_INTERVAL = 1.0
+
+try:
+    STRING_TYPES = (str, bytes, unicode)
+except NameError:
+    STRING_TYPES = (str, bytes)
+
+
+class FetchCache(object):
+    '''
+     Cache of fetched values, each kept for a fixed time, with the least recently used evicted when the cache
+     is full. Safe to share between threads.
+
+    :param ttl: The number of seconds a fetched value is used for before it is fetched again
+    :param max_entries: The maximum number of values kept, 0 for no limit
+    :param max_bytes: The maximum approximate size of the values kept, 0 for no limit
+    :param sizeof: A function giving the approximate size of a value in bytes. Defaults to approximateSize
+    :param stale_time: The number of seconds past its ttl a value is served for while it is refreshed in the
+                       background, 0 to always wait for the refresh. If it isn't 0, a value cached for an out
+                       of date version is also served while it is brought up to date, if it was fetched no
+                       more than ttl + stale_time seconds ago
+    :param refresh_ahead: Values used in the last ttl seconds are refreshed in the background this many seconds
+                          before they expire, 0 to only refresh values when they are asked for
+    '''
+
+    def __init__(self, ttl, max_entries=0, max_bytes=0, sizeof=None, stale_time=0, refresh_ahead=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or approximateSize
+        self.stale_time = stale_time
+        self.refresh_ahead = refresh_ahead
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.updates = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.bytes = 0
+        # key: _Entry, least recently used first
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+        # Refreshes to run in the background, as (key, flight, refresh, version), or None once closed
+        self._queue = Queue()
+        self._stop = threading.Event()
+        self._refresher = None
+        if stale_time or refresh_ahead:
+            self._refresher = threading.Thread(target=self._refreshLoop)
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def get(self, key, fetch, version=None, update=None):
+        '''
+         Get the value for a key, fetching it if it isn't cached or is out of date. If another thread is already
+         fetching it, wait for that fetch instead. An out of date value is returned straight away if it can be
+         served while it is refreshed in the background.
+
+        :param key: The cache key
+        :param fetch: A function taking no arguments that fetches the value
+        :param version: The version of the value wanted, or None for a value no older than the cache's ttl
+        :param update: A function taking the cached value and its version, and returning the value brought up
+                       to date, used instead of fetch when a different version is cached. None to always use fetch
+        :return: The value
+        '''
+
+        refresh = fetch
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                now = time.time()
+                entry.used = now
+                if version is not None:
+                    fresh = entry.version == version
+                    servable = False
+                    if entry.version is not None and update is not None:
+                        refresh = _Update(update, entry.value, entry.version)
+                        servable = self.stale_time > 0 and now - entry.time <= self.ttl + self.stale_time
+                else:
+                    fresh = now - entry.time <= self.ttl
+                    servable = now - entry.time <= self.ttl + self.stale_time
+
+                # Put back as the most recently used, and refresh in the background if out of date
+                servable = servable and not self._stop.is_set()
+                if fresh or servable:
+                    self._entries[key] = entry
+                    if fresh:
+                        self.hits += 1
+                    else:
+                        self.stale_hits += 1
+                        if key not in self._flights:
+                            self._schedule(key, refresh, version, fetch)
+                    return entry.value
+
+                if refresh is fetch:
+                    self.expirations += 1
+                self.bytes -= entry.size
+
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._newFlight(key, refresh, fetch)
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if isinstance(flight.error, _Closed):
+                return self.get(key, fetch, version, update)
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        return self._run(key, flight, refresh, version)
+
+    def invalidate(self, key):
+        '''
+         Forget the value for a key, so it is fetched again when next needed.
+
+        :param key: The cache key
+        :return: None
+        '''
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry.size
+
+    def close(self):
+        '''
+         Stop refreshing values in the background, waiting for a refresh in progress to finish. Values can still
+         be got, but out of date ones are then fetched by the thread asking for them.
+
+        :return: None
+        '''
+
+        self._stop.set()
+        if self._refresher is not None:
+            # Wake the thread rather than wait for it to next check
+            self._queue.put(None)
+            self._refresher.join()
+
+    def stats(self):
+        '''
+         Get the counters as a dict.
+
+        :return: A dict of the counters, and the number and approximate size of the values kept
+        '''
+
+        with self._lock:
+            return {'hits': self.hits,
+                    'stale_hits': self.stale_hits,
+                    'misses': self.misses,
+                    'coalesced': self.coalesced,
+                    'updates': self.updates,
+                    'refreshes': self.refreshes,
+                    'refresh_errors': self.refresh_errors,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'entries': len(self._entries),
+                    'bytes': self.bytes}
+
+    def _newFlight(self, key, refresh, fetch):
+        # Called with the lock held
+        if refresh is fetch:
+            self.misses += 1
+        else:
+            self.updates += 1
+        flight = self._flights[key] = _Flight(fetch)
+        return flight
+
+    def _schedule(self, key, refresh, version, fetch):
+        # Called with the lock held. The flight is made now, so threads that can't be served the out of date
+        # value wait for this refresh rather than starting another
+        self._queue.put((key, self._newFlight(key, refresh, fetch), refresh, version))
+
+    def _run(self, key, flight, refresh, version):
+        try:
+            flight.value = refresh()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            # Sized outside the lock, as it walks the whole value
+            self._store(key, flight.value, self.sizeof(flight.value), version, flight.fetch)
+            return flight.value
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _store(self, key, value, size, version, fetch):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.size
+            if self.max_bytes and size > self.max_bytes:
+                # Never fits, so isn't kept - the caller still gets the value
+                self.evictions += 1
+                return
+            entry = self._entries[key] = _Entry(value, size, version, fetch)
+            if old is not None:
+                # A background refresh isn't a use
+                entry.used = old.used
+            self.bytes += size
+            while self._entries and ((self.max_entries and len(self._entries) > self.max_entries)
+                                     or (self.max_bytes and self.bytes > self.max_bytes)):
+                (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def _refreshLoop(self):
+        # Run refreshes as they are scheduled, and schedule refreshes of values in use that are about to expire
+        last_check = time.time()
+        while not self._stop.is_set():
+            try:
+                scheduled = self._queue.get(timeout=REFRESH_INTERVAL)
+            except Empty:
+                scheduled = None
+            if scheduled is not None:
+                (key, flight, refresh, version) = scheduled
+                try:
+                    self._run(key, flight, refresh, version)
+                except Exception:
+                    # The out of date value is kept, and fetched again once it is too old to serve
+                    with self._lock:
+                        self.refresh_errors += 1
+                else:
+                    with self._lock:
+                        self.refreshes += 1
+
+            if self.refresh_ahead and time.time() - last_check >= REFRESH_INTERVAL:
+                last_check = time.time()
+                with self._lock:
+                    for key, entry in list(self._entries.items()):
+                        if (entry.version is None and key not in self._flights
+                                and last_check - entry.time >= self.ttl - self.refresh_ahead
+                                and last_check - entry.used <= self.ttl):
+                            self._schedule(key, entry.fetch, None, entry.fetch)
+
+        # Refreshes scheduled since the last one ran won't be run, so threads waiting on them fetch for themselves.
+        # Refreshes are scheduled with the lock held, and none once the cache is closed
+        with self._lock:
+            while True:
+                try:
+                    scheduled = self._queue.get_nowait()
+                except Empty:
+                    break
+                if scheduled is None:
+                    continue
+                (key, flight, refresh, version) = scheduled
+                del self._flights[key]
+                flight.error = _Closed()
+                flight.done.set()
+
+
+class BlockCache(object):
+    '''
+     Cache of fixed size blocks of dataset contents, kept in files in a directory, with the least recently used
+     removed when the cache is full. Safe to share between threads. Blocks already in the directory when the
+     cache is made are used, oldest written counting as least recently used.
+
+    :param directory: The directory to keep the blocks in, made if it doesn't exist
+    :param max_bytes: The maximum total size of the blocks kept, 0 for no limit
+    :param block_size: The size of each block in bytes. Only the last block of a dataset can be smaller
+    '''
+
+    def __init__(self, directory, max_bytes, block_size):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        # file name: size, least recently used first
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Blocks of another size can't be used, so are left out, and removed as the cache fills up
+        existing = []
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                # Left by a mount that stopped while writing a block
+                os.remove(os.path.join(directory, name))
+            elif name.endswith('.%d' % block_size):
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                existing.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(existing):
+            self._blocks[name] = size
+            self.bytes += size
+        self._evict()
+
+    def get(self, key, index):
+        '''
+         Get a block.
+
+        :param key: The key of the dataset, which should change when its contents do
+        :param index: The number of the block in the dataset, from 0
+        :return: The block, as bytes, or None if it isn't cached
+        '''
+
+        name = self._name(key, index)
+        with self._lock:
+            size = self._blocks.pop(name, None)
+            if size is None:
+                self.misses += 1
+                return None
+            self._blocks[name] = size
+            self.hits += 1
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            # Removed from the directory by something else
+            with self._lock:
+                if self._blocks.pop(name, None) is not None:
+                    self.bytes -= size
+            return None
+
+    def has(self, key, index):
+        '''
+         Check whether a block is cached, without counting it as used.
+
+        :param key: The key of the dataset
+        :param index: The number of the block in the dataset, from 0
+        :return: True if the block is cached
+        '''
+
+        with self._lock:
+            return self._name(key, index) in self._blocks
+
+    def put(self, key, index, data):
+        '''
+         Add a block, removing the least recently used blocks if the cache is then full.
+
+        :param key: The key of the dataset, which should change when its contents do
+        :param index: The number of the block in the dataset, from 0
+        :param data: The block, as bytes
+        :return: None
+        '''
+
+        name = self._name(key, index)
+        path = os.path.join(self.directory, name)
+        # Written to a temporary file first, so other threads and later mounts never see a partial block
+        temp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+        with self._lock:
+            old = self._blocks.pop(name, None)
+            if old is not None:
+                self.bytes -= old
+            self._blocks[name] = len(data)
+            self.bytes += len(data)
+        self._evict()
+
+    def stats(self):
+        '''
+         Get the counters as a dict.
+
+        :return: A dict of the counters, and the number and total size of the blocks kept
+        '''
+
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'blocks': len(self._blocks),
+                    'bytes': self.bytes}
+
+    def _name(self, key, index):
+        # Block size last, so blocks of another size are never mistaken for these
+        return '%s.%d.%d' % (re.sub(r'[^A-Za-z0-9_-]', '_', key), index, self.block_size)
+
+    def _evict(self):
+        removed = []
+        with self._lock:
+            while self.max_bytes and self.bytes > self.max_bytes and self._blocks:
+                (name, size) = self._blocks.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+                removed.append(name)
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+def approximateSize(value):
+    '''
+     Function for estimating the memory used by a value: the strings in it and a fixed overhead for every
+     other object and dict entry, following lists, tuples, dict values and the attributes of objects. Objects
+     other than strings reached more than once are counted once.
+
+    :param value: The value to size
+    :return: The approximate size in bytes
+    '''
+
+    size = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, STRING_TYPES):
+            # Strings aren't remembered, to keep this small - a string counted twice is rare but for
+            # dict keys, which are skipped below
+            size += OBJECT_OVERHEAD + len(obj)
+            continue
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += OBJECT_OVERHEAD
+        if isinstance(obj, dict):
+            # Keys are usually the same few strings, shared by every dict
+            size += OBJECT_OVERHEAD * len(obj)
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.append(vars(obj))
+    return size
+
+
+class _Entry(object):
+    # A cached value, when it was fetched and last used, and how to fetch it again
+    __slots__ = ('time', 'used', 'value', 'size', 'version', 'fetch')
+
+    def __init__(self, value, size, version, fetch):
+        self.time = self.used = time.time()
+        self.value = value
+        self.size = size
+        self.version = version
+        self.fetch = fetch
+
+
+class _Update(object):
+    # Brings a cached value up to date from its version
+    def __init__(self, update, value, version):
+        self.update = update
+        self.value = value
+        self.version = version
+
+    def __call__(self):
+        return self.update(self.value, self.version)
+
+
+class _Closed(Exception):
+    # The error of a background refresh that was dropped when the cache was closed
+    pass
+
+
+class _Flight(object):
+    # A fetch in progress, and its result once it has finished
+    def __init__(self, fetch):
+        self.done = threading.Event()
+        self.fetch = fetch
+        self.value = None
+        self.error = None
@@ -11,6 +11,12 @@ using a command like
 
 This puts the galaxy-fuse process into the background. Galaxy Datasets will then
 appear as read-only files, organised by History, under the directory galaxy_files.
+Datasets in Data Libraries appear under galaxy_files/libraries, organised by
+Library and folder.
+
+Datasets are symlinks to Galaxy's own files, so the mount must be on a machine that
+can see them. For a remote Galaxy, add --remote to read datasets through the API
+instead, a block at a time, with the blocks kept on disk for later reads.
 
 galaxy-fuse was written by Dr David Powell and began life at
 https://github.com/drpowell/galaxy-fuse .
@@ -18,21 +24,80 @@ https://github.com/drpowell/galaxy-fuse .
 Modified December 2016 by Madison Flannery.
 """
 
-from errno import ENOENT
+from errno import ENOENT, EIO, EINVAL
 from stat import S_IFDIR, S_IFREG, S_IFLNK
 from sys import argv, exit
 import re
 import time
 import os
 import argparse
+import threading
+from collections import OrderedDict
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, fuse_get_context
 
-from bioblend import galaxy
+from api_metrics import RunMetrics, instrumentClient
+from fuse_cache import BlockCache, FetchCache
+from galaxy_client import GalaxyClient, addClientArguments
 
 # number of seconds to cache history/dataset lookups
 CACHE_TIME = 30
 
+# number of seconds past CACHE_TIME a lookup is still used for while it is refreshed in the background
+CACHE_STALE = 300
+
+# number of seconds before they expire that lookups in use are refreshed in the background
+REFRESH_AHEAD = 5
+
+# number of history/dataset lookups to cache - the least recently used are dropped beyond this
+CACHE_ENTRIES = 1000
+
+# approximate number of megabytes the cached lookups may take up
+CACHE_MB = 512
+
+# number of pooled connections to Galaxy, for FUSE operations running at once
+FUSE_THREADS = 8
+
+# keys fetched for each item in a history - the details of collections are only fetched when they are opened
+HISTORY_CONTENTS_KEYS = 'id,hid,name,history_content_type,update_time,visible,deleted,purged,file_name,file_size'
+
+# keys kept for each item in a history, whatever Galaxy sends - deleted items are left out, so whether
+# an item is deleted isn't kept
+HISTORY_CONTENTS_KEEP = ['id', 'name', 'history_content_type', 'update_time', 'visible', 'file_name', 'file_path',
+                         'file_size', 'elements']
+
+# number of items in a history fetched per request, so very large histories come in pages
+# rather than in one response that has to be held and decoded all at once
+HISTORY_CONTENTS_PAGE_SIZE = 5000
+
+# number of items in a library folder fetched per request
+FOLDER_PAGE_SIZE = 1000
+
+# keys kept for each item in a library folder - Galaxy gives the size of a dataset in bytes as raw_size,
+# and file_size is for showing
+FOLDER_CONTENTS_KEEP = ['id', 'name', 'type', 'update_time', 'raw_size', 'ldda_id']
+
+# directory to keep blocks of datasets read from a remote Galaxy in, between mounts
+BLOCK_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'galaxy-fuse')
+
+# megabytes of blocks of datasets read from a remote Galaxy to keep
+BLOCK_CACHE_MB = 1024
+
+# kilobytes of a dataset fetched from a remote Galaxy at a time
+BLOCK_KB = 1024
+
+# number of blocks fetched ahead of reads that follow on from the last one
+READ_AHEAD = 4
+
+# number of datasets whose last read position is kept, to spot reads that follow on from it
+READ_ENDS = 1000
+
+# URL of the Galaxy to mount datasets from
+GALAXY_URL = 'http://127.0.0.1:80/galaxy/'
+
+# Number of seconds between writes of the report, if one is asked for
+REPORT_INTERVAL = 60
+
 # Split a path into hash of components
 def path_type(path):
     parts = filter(lambda x: len(x)>0, path.split('/'))
@@ -50,6 +115,14 @@ def path_type(path):
         # Path: histories/<history_name>/<coll_name>/<dataset_name>
         return ('collectiondataset',dict(h_name=unesc_filename(parts[1]), c_name=unesc_filename(parts[2]),
                                   ds_name=unesc_filename(parts[3])))
+    elif path=='/libraries':
+        return ('libraries',dict())
+    elif len(parts)==2 and parts[0]=='libraries':
+        return ('library',dict(l_name=unesc_filename(parts[1])))
+    elif len(parts)>2 and parts[0]=='libraries':
+        # Path: libraries/<library_name>/<folder_name>/.../<data_name>
+        # OR libraries/<library_name>/<folder_name>/.../<folder_name>
+        return ('libraryitem',dict(l_name=unesc_filename(parts[1]), names=[unesc_filename(x) for x in parts[2:]]))
     print "Unknown : %s"%path
     return ('',0)
 
@@ -75,62 +148,242 @@ def unesc_filename(fname):
     return re.sub(r'%(.)', unesc, fname)
 
 def parse_name_with_id(fname):
-    m = re.match(r"^(?P<name>.*)-(?P<id>[0-9a-f]{16})", fname)
+    # Library folder IDs start with F
+    m = re.match(r"^(?P<name>.*)-(?P<id>F?[0-9a-f]{16})", fname)
     if m is not None:
         return (m.group('name'), m.group('id'))
     else:
         return (fname,'')
 
+# Stat of a read-only directory
+def dir_stat(t):
+    return dict(st_mode=(S_IFDIR | 0555), st_nlink=2, st_ctime=t, st_mtime=t, st_atime=t)
+
+# Update time of a history or library item, or t if it has none. Library folders give theirs
+# to the minute, in a different format to histories
+def update_time(item, t):
+    for time_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d %I:%M %p'):
+        try:
+            return time.mktime(time.strptime(item['update_time'], time_format))
+        except (KeyError, ValueError):
+            pass
+    return t
+
+# Index of histories or datasets by name and by (name, id), built once each time they are fetched,
+# so looking up a path component is a dict lookup rather than a scan of the whole list
+class NameIndex(object):
+    def __init__(self, items=None):
+        self.items = []
+        # The first item with each name, and the number of items with each name shared by several
+        self.by_name = {}
+        self.shared = {}
+        # Items with shared names, by (name, id)
+        self.by_name_id = {}
+        self.listing = []
+        if items is not None:
+            self.add(items)
+            self.make_listing()
+
+    # Add items to the index, e.g. a page at a time - make_listing() is called once all are added
+    def add(self, items):
+        for item in items:
+            self.items.append(item)
+            name = item['name']
+            first = self.by_name.setdefault(name, item)
+            if first is not item:
+                if name not in self.shared:
+                    self.shared[name] = 1
+                    self.by_name_id[(name, first['id'])] = first
+                self.shared[name] += 1
+                self.by_name_id[(name, item['id'])] = item
+
+    # Entries for readdir, in the order Galaxy returned them. Only known once every item has been
+    # added, as names shared by several items are shown differently
+    def make_listing(self):
+        self.listing = [self.display_name(item) for item in self.items]
+
+    # Name shown for an item - names shared by several items have the item ID appended
+    def display_name(self, item):
+        if item['name'] in self.shared:
+            return esc_filename(item['name'] + '-' + item['id'])
+        return esc_filename(item['name'])
+
+    # Find the item for a file name from display_name(), or None
+    def lookup(self, fname):
+        (name, item_id) = parse_name_with_id(fname)
+        if name in self.shared:
+            return self.by_name_id.get((name, item_id))
+        return self.by_name.get(name)
+
+# Contents of a history, fetched once for both the visible datasets shown in the history's directory
+# and the hidden ones that collections are made of, with the stat of each item for getattr worked out
+# once each time the contents are fetched. Can be built a page of items at a time, like NameIndex
+class HistoryContents(object):
+    def __init__(self, items=None, links=True):
+        # Whether datasets are symlinks to their files, or regular files read through Galaxy
+        self.links = links
+        self.items = []
+        self.all = NameIndex()
+        self.visible = NameIndex()
+        # Stats by (type, id) - datasets and collections are numbered separately, so can share an ID
+        self.stats = {}
+        # Stats by (time, size) - datasets made together usually have the same ones, so share them
+        self.shared_stats = {}
+        if items is not None:
+            self.add(items)
+            self.make_listing()
+
+    # Add items, keeping only the keys needed to list them (and the elements of collections, from
+    # Galaxy releases that send them) rather than everything Galaxy sent
+    def add(self, items):
+        items = [dict((key, item[key]) for key in HISTORY_CONTENTS_KEEP if key in item) for item in items]
+        self.items += items
+        self.all.add(items)
+        self.visible.add([item for item in items if item.get('visible', True)])
+        now = time.time()
+        for item in items:
+            if item['history_content_type'] == 'dataset_collection':
+                # A collection, will be a simple directory.
+                self.stats[(item['history_content_type'], item['id'])] = dir_stat(now)
+            elif 'file_path' in item or 'file_name' in item or not self.links:
+                # A file, will be a symlink to a galaxy dataset, or a file read through Galaxy.
+                t = update_time(item, now)
+                if self.links:
+                    (mode, size) = (S_IFLNK | 0444, len(esc_filename(item.get('file_path', item['file_name']))))
+                else:
+                    (mode, size) = (S_IFREG | 0444, item.get('file_size') or 0)
+                st = self.shared_stats.get((t, size))
+                if st is None:
+                    st = self.shared_stats[(t, size)] = dict(st_mode=mode, st_nlink=1, st_size=size,
+                                                             st_ctime=t, st_mtime=t, st_atime=t)
+                self.stats[(item['history_content_type'], item['id'])] = st
+
+    # Entries for readdir, once every item has been added
+    def make_listing(self):
+        self.all.make_listing()
+        self.visible.make_listing()
+
+    # These contents with changed items merged in - changed items replace the ones with the same ID,
+    # new ones are added at the end, and deleted ones are removed. New indexes are made, so threads
+    # using these ones aren't disturbed.
+    def merged(self, changed):
+        changed_by_id = dict(((item['history_content_type'], item['id']), item) for item in changed)
+        items = []
+        for item in self.items:
+            item = changed_by_id.pop((item['history_content_type'], item['id']), item)
+            if not item.get('deleted') and not item.get('purged'):
+                items.append(item)
+        for item in changed:
+            if (item['history_content_type'], item['id']) in changed_by_id and not item.get('deleted') \
+                    and not item.get('purged'):
+                items.append(item)
+        return HistoryContents(items, self.links)
+
+# Contents of a library folder - its folders and datasets, indexed by name, with the stat of each
+# folder, and of each dataset read through Galaxy, worked out once each time the folder is fetched.
+# The stat of a dataset that is a symlink needs its path, which is only fetched when it is used.
+# Can be built a page of items at a time, like NameIndex
+class FolderContents(object):
+    def __init__(self, items=None, links=True):
+        self.links = links
+        self.index = NameIndex()
+        self.stats = {}
+        if items is not None:
+            self.add(items)
+            self.index.make_listing()
+
+    def add(self, items):
+        items = [dict((key, item[key]) for key in FOLDER_CONTENTS_KEEP if key in item) for item in items]
+        self.index.add(items)
+        now = time.time()
+        for item in items:
+            t = update_time(item, now)
+            if item['type'] == 'folder':
+                self.stats[item['id']] = dir_stat(t)
+            elif not self.links:
+                self.stats[item['id']] = dict(st_mode=(S_IFREG | 0444), st_nlink=1, st_size=item.get('raw_size') or 0,
+                                              st_ctime=t, st_mtime=t, st_atime=t)
+
+
+# A fetch of blocks of a dataset in progress, and the blocks fetched once it has finished
+class BlockFetch(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.blocks = None
+        self.error = None
+
 
 class Context(LoggingMixIn, Operations):
     'Prototype FUSE to galaxy histories'
 
-    def __init__(self, api_key):
-        self.gi = galaxy.GalaxyInstance(url='http://127.0.0.1:80/galaxy/', key=api_key)
-        self.filtered_datasets_cache = {}
-        self.full_datasets_cache = {}
-        self.histories_cache = {'time':None, 'contents':None}
+    def __init__(self, api_key, timeout, retries, metrics=None, url=GALAXY_URL, cache_time=CACHE_TIME,
+                 cache_entries=CACHE_ENTRIES, cache_mb=CACHE_MB, cache_stale=CACHE_STALE,
+                 refresh_ahead=REFRESH_AHEAD, remote=False, block_cache=BLOCK_CACHE, block_cache_mb=BLOCK_CACHE_MB,
+                 block_kb=BLOCK_KB, read_ahead=READ_AHEAD):
+        # FUSE runs each operation in its own thread, so keep a pooled connection for several at once
+        self.gi = GalaxyClient(url, api_key, workers=FUSE_THREADS, timeout=timeout, retries=retries)
+        # Calls to Galaxy, and the time taken by each FUSE operation, are recorded for the report
+        self.metrics = metrics or RunMetrics('galaxy-fuse')
+        instrumentClient(self.gi, self.metrics)
+        # Histories and their contents, shared by the FUSE threads with one fetch of each at a time,
+        # and bounded so a long running mount doesn't keep every history it has ever listed. Lookups
+        # are refreshed in the background, so operations only wait on Galaxy for a first lookup
+        self.cache = FetchCache(cache_time, cache_entries, int(cache_mb * 1024 * 1024), stale_time=cache_stale,
+                                refresh_ahead=refresh_ahead)
+        # Whether Galaxy can list history contents with only some keys, and filter them by update
+        # time, until it turns out not to
+        self.contents_api = True
+        # For a Galaxy whose files aren't on this machine, datasets are regular files read through the
+        # API a block at a time, and the blocks kept on disk
+        self.remote = remote
+        self.blocks = BlockCache(block_cache, int(block_cache_mb * 1024 * 1024), block_kb * 1024) if remote else None
+        self.read_ahead = read_ahead
+        # Where the last read of each of the most recently read datasets ended, to spot reads that
+        # follow on from it, and the block fetches in progress, so readers of the same blocks share one
+        self.read_ends = OrderedDict()
+        self.block_fetches = {}
+        self.read_lock = threading.Lock()
+
+    def __call__(self, op, *args):
+        start = time.time()
+        try:
+            return super(Context, self).__call__(op, *args)
+        finally:
+            self.metrics.observePhase('fuse.' + op, time.time() - start)
 
     def getattr(self, path, fh=None):
         (typ,kw) = path_type(path)
-        now = time.time()
-        if typ=='root' or typ=='histories':
+        if typ=='root' or typ=='histories' or typ=='datasets' or typ=='libraries':
             # Simple directory
-            st = dict(st_mode=(S_IFDIR | 0555), st_nlink=2)
-            st['st_ctime'] = st['st_mtime'] = st['st_atime'] = now
-        elif typ=='datasets':
-            # Simple directory
-            st = dict(st_mode=(S_IFDIR | 0555), st_nlink=2)
-            st['st_ctime'] = st['st_mtime'] = st['st_atime'] = now
+            st = dir_stat(time.time())
+        elif typ=='library':
+            # Library, the directory of its root folder
+            self._library(kw['l_name'])
+            st = dir_stat(time.time())
         elif typ=='historydataorcoll':
-            # Dataset or collection
-            d = self._dataset(kw)
-
-            if d['history_content_type'] == 'dataset_collection':
-                # A collection, will be a simple directory.
-                st = dict(st_mode=(S_IFDIR | 0555), st_nlink=2)
-                st['st_ctime'] = st['st_mtime'] = st['st_atime'] = now
-            else:
-                # A file, will be a symlink to a galaxy dataset.
-                t = time.mktime(time.strptime(d['update_time'],'%Y-%m-%dT%H:%M:%S.%f'))
-                fname = esc_filename(d.get('file_path', d['file_name']))
-                st = dict(st_mode=(S_IFLNK | 0444), st_nlink=1,
-                                  st_size=len(fname), st_ctime=t, st_mtime=t,
-                                  st_atime=t)
+            # Dataset or collection - stats are worked out when the history contents are fetched
+            (contents, d) = self._dataset_entry(kw)
+            st = contents.stats[(d['history_content_type'], d['id'])]
         elif typ=='collectiondataset':
             # A file within a collection, will be a symlink to a galaxy dataset.
-            d = self._dataset(kw, display=False)
-            t = time.mktime(time.strptime(d['update_time'],'%Y-%m-%dT%H:%M:%S.%f'))
-            fname = esc_filename(d.get('file_path', d['file_name']))
-            st = dict(st_mode=(S_IFLNK | 0444), st_nlink=1,
-                              st_size=len(fname), st_ctime=t, st_mtime=t,
-                              st_atime=t)
+            (contents, d) = self._dataset_entry(kw, display=False)
+            st = contents.stats[(d['history_content_type'], d['id'])]
+        elif typ=='libraryitem':
+            # Folder or dataset inside library - datasets that are symlinks need their path for their size
+            (lib, contents, item) = self._library_item(kw)
+            if item['id'] in contents.stats:
+                st = contents.stats[item['id']]
+            else:
+                st = self._library_dataset(lib, item)[1]
         else:
             raise FuseOSError(ENOENT)
         return st
 
     # Return a symlink for the given dataset
     def readlink(self, path):
+        if self.remote:
+            # Datasets are regular files
+            raise FuseOSError(EINVAL)
         (typ,kw) = path_type(path)
         if typ=='historydataorcoll':
             # Dataset inside history.
@@ -144,154 +397,336 @@ class Context(LoggingMixIn, Operations):
 
             # We have already checked that one of these keys is present
             return d.get('file_path', d['file_name'])
+        elif typ=='libraryitem':
+            # Dataset inside library.
+            (lib, contents, item) = self._library_item(kw)
+            if item['type'] == 'folder':
+                raise FuseOSError(EINVAL)
+            return self._library_dataset(lib, item)[0]
         raise FuseOSError(ENOENT)
 
+    # Read part of a dataset from a remote Galaxy, through the block cache
     def read(self, path, size, offset, fh):
+        (typ,kw) = path_type(path)
+        if self.remote and typ in ('historydataorcoll', 'collectiondataset'):
+            d = self._dataset(kw, display=(typ=='historydataorcoll'))
+            if d['history_content_type'] == 'dataset_collection':
+                raise FuseOSError(EINVAL)
+            return self._read_dataset(d['id'], 'hda', d.get('update_time', ''), d.get('file_size') or 0, size,
+                                      offset)
+        elif self.remote and typ=='libraryitem':
+            (lib, contents, item) = self._library_item(kw)
+            if item['type'] == 'folder':
+                raise FuseOSError(EINVAL)
+            # Library datasets are displayed by the ID of the dataset they hold
+            return self._read_dataset(item['ldda_id'], 'ldda', item.get('update_time', ''),
+                                      item.get('raw_size') or 0, size, offset)
         raise RuntimeError('unexpected path: %r' % path)
 
-    # Lookup all histories in galaxy; cache
+    # Read part of a history ('hda') or library ('ldda') dataset, fetching the blocks not already cached
+    def _read_dataset(self, dataset_id, hda_ldda, version, file_size, size, offset):
+        end = min(offset + size, file_size)
+        if offset >= end:
+            return b''
+        block_size = self.blocks.block_size
+        first = offset // block_size
+        last = (end - 1) // block_size
+
+        # Reads that follow on from the last one fetch blocks ahead of it too
+        key = hda_ldda + '-' + dataset_id + '-' + version
+        with self.read_lock:
+            follows_on = self.read_ends.pop(key, None) == offset
+            self.read_ends[key] = end
+            if len(self.read_ends) > READ_ENDS:
+                self.read_ends.popitem(last=False)
+
+        blocks = {}
+        for index in range(first, last + 1):
+            if index not in blocks:
+                block = self.blocks.get(key, index)
+                if block is None:
+                    # Fetch this block and the rest of the run of missing ones in one request
+                    run_end = index
+                    while run_end < last and not self.blocks.has(key, run_end + 1):
+                        run_end += 1
+                    if follows_on and run_end == last:
+                        run_end = min(last + self.read_ahead, (file_size - 1) // block_size)
+                    blocks.update(self._fetch_blocks(dataset_id, hda_ldda, file_size, key, index, run_end))
+                else:
+                    blocks[index] = block
+        data = b''.join(blocks[index] for index in range(first, last + 1))
+        start = offset - first * block_size
+        return data[start:start + end - offset]
+
+    # Fetch blocks of a dataset, waiting for a fetch already in progress from the same block rather
+    # than sending another request for it
+    def _fetch_blocks(self, dataset_id, hda_ldda, file_size, key, first, last):
+        with self.read_lock:
+            fetch = self.block_fetches.get((key, first))
+            leader = fetch is None
+            if leader:
+                fetch = self.block_fetches[(key, first)] = BlockFetch()
+        if leader:
+            try:
+                fetch.blocks = self._fetch_range(dataset_id, hda_ldda, file_size, key, first, last)
+                return fetch.blocks
+            except Exception as e:
+                fetch.error = e
+                raise
+            finally:
+                with self.read_lock:
+                    del self.block_fetches[(key, first)]
+                fetch.done.set()
+
+        fetch.done.wait()
+        if fetch.error is not None:
+            raise fetch.error
+        blocks = dict((index, block) for (index, block) in fetch.blocks.items() if index <= last)
+        if len(blocks) < last - first + 1:
+            # The other fetch stopped short of the blocks wanted here
+            blocks.update(self._fetch_blocks(dataset_id, hda_ldda, file_size, key, first + len(blocks), last))
+        return blocks
+
+    # Fetch blocks of a dataset from Galaxy with a range request, and add them to the block cache
+    # A Galaxy that can't send ranges sends the whole dataset, and every block of it is cached
+    def _fetch_range(self, dataset_id, hda_ldda, file_size, key, first, last):
+        block_size = self.blocks.block_size
+        response = self.gi.make_range_request(self.gi.url + '/datasets/' + dataset_id + '/display',
+                                              first * block_size, min((last + 1) * block_size, file_size) - 1,
+                                              params={'hda_ldda': hda_ldda})
+        if response.status_code == 206:
+            index = first
+        elif response.status_code == 200:
+            index = 0
+        else:
+            response.close()
+            raise FuseOSError(EIO)
+
+        blocks = {}
+        buf = b''
+        try:
+            for chunk in response.iter_content(block_size):
+                buf += chunk
+                while len(buf) >= block_size:
+                    self.blocks.put(key, index, buf[:block_size])
+                    if first <= index <= last:
+                        blocks[index] = buf[:block_size]
+                    buf = buf[block_size:]
+                    index += 1
+            if buf:
+                self.blocks.put(key, index, buf)
+                if first <= index <= last:
+                    blocks[index] = buf
+        finally:
+            response.close()
+        if len(blocks) != last - first + 1:
+            # The dataset is shorter than Galaxy said
+            raise FuseOSError(EIO)
+        return blocks
+
+    # Lookup all histories in galaxy; cache, indexed by name
     def _histories(self):
-        cache = self.histories_cache
-        now = time.time()
-        if cache['contents'] is None or now - cache['time'] > CACHE_TIME:
-            cache['time'] = now
-            cache['contents'] = self.gi.histories.get_histories()
-        return cache['contents']
+        return self.cache.get(('histories',), lambda: NameIndex(self.gi.histories.get_histories()))
 
     # Find a specific history by name
     def _history(self,h_name):
-        (fixed_name, hist_id) = parse_name_with_id(h_name)
-        h = filter(lambda x: x['name']==fixed_name, self._histories())
-        if len(h)==0:
+        h = self._histories().lookup(h_name)
+        if h is None:
+            raise FuseOSError(ENOENT)
+        return h
+
+    # Lookup all libraries in galaxy; cache, indexed by name
+    def _libraries(self):
+        return self.cache.get(('libraries',), lambda: NameIndex(self.gi.libraries.get_libraries(deleted=False)))
+
+    # Find a specific library by name
+    def _library(self, l_name):
+        lib = self._libraries().lookup(l_name)
+        if lib is None:
             raise FuseOSError(ENOENT)
-        if len(h)>1:
-            h = filter(lambda x: x['id']==hist_id, self._histories())
-            if len(h)==0:
+        return lib
+
+    # Lookup the folders and datasets in a library folder; cache, indexed by name
+    # Each folder is only fetched when a path through it is used
+    def _folder_contents(self, folder_id):
+        return self.cache.get(('folder_contents', folder_id), lambda: self._fetch_folder_contents(folder_id))
+
+    # Fetch the contents of a library folder, a page at a time
+    def _fetch_folder_contents(self, folder_id):
+        contents = FolderContents(links=not self.remote)
+        offset = 0
+        while True:
+            response = self.gi.make_get_request(self.gi.url + '/folders/' + folder_id + '/contents',
+                                                params={'limit': FOLDER_PAGE_SIZE, 'offset': offset})
+            if response.status_code != 200:
+                raise FuseOSError(EIO)
+            page = response.json()
+            contents.add(page['folder_contents'])
+            # Older Galaxy releases return the whole folder at once, without a total
+            offset += FOLDER_PAGE_SIZE
+            if offset >= page['metadata'].get('total_rows', 0):
+                contents.index.make_listing()
+                return contents
+
+    # Find a library folder or dataset from its path in the library - the 'kw' parameter is from path_type() above
+    # Returns the library, the contents of the folder it is in, and the item
+    def _library_item(self, kw):
+        lib = self._library(kw['l_name'])
+        item = dict(id=lib['root_folder_id'], type='folder')
+        contents = None
+        for name in kw['names']:
+            if item['type'] != 'folder':
                 raise FuseOSError(ENOENT)
-            if len(h)>1:
-                print "Too many histories with identical names and IDs"
-            return h[0]
-        return h[0]
-
-    # Lookup visible datasets in the specified history; cache
-    # This will not return deleted or hidden datasets.
-    def _filtered_datasets(self, h):
-        id = h['id']
-        cache = self.filtered_datasets_cache
-        now = time.time()
-        if id not in cache or now - cache[id]['time'] > CACHE_TIME:
-            cache[id] = {'time':now,
-                         'contents':self.gi.histories.show_history(id,contents=True,details='all', deleted=False, visible=True)}
-        return cache[id]['contents']
-
-    # Lookup all datasets in the specified history; cache
-    # This will return hidden datasets. Will not return deleted datasets.
-    def _all_datasets(self, h):
-        id = h['id']
-        cache = self.full_datasets_cache
-        now = time.time()
-        if id not in cache or now - cache[id]['time'] > CACHE_TIME:
-            cache[id] = {'time':now,
-                         'contents':self.gi.histories.show_history(id,contents=True,details='all', deleted=False)}
-        return cache[id]['contents']
+            contents = self._folder_contents(item['id'])
+            item = contents.index.lookup(name)
+            if item is None:
+                raise FuseOSError(ENOENT)
+        return (lib, contents, item)
+
+    # Lookup the path of a library dataset, and its stat as a symlink to it; cache until the dataset's
+    # update time changes
+    def _library_dataset(self, lib, item):
+        def fetch():
+            d = self.gi.libraries.show_dataset(lib['id'], item['id'])
+            if 'file_path' not in d and 'file_name' not in d:
+                print "Unable to find file of dataset.  Have you set : expose_dataset_path = True"
+                raise FuseOSError(ENOENT)
+            fname = d.get('file_path', d['file_name'])
+            t = update_time(item, time.time())
+            return (fname, dict(st_mode=(S_IFLNK | 0444), st_nlink=1, st_size=len(fname),
+                                st_ctime=t, st_mtime=t, st_atime=t))
+        return self.cache.get(('library_dataset', item['id']), fetch, item.get('update_time'))
+
+    # Counters of the lookup cache, and of the block cache when reading from a remote Galaxy
+    def cache_stats(self):
+        stats = self.cache.stats()
+        if self.blocks is not None:
+            stats['blocks'] = self.blocks.stats()
+        return stats
+
+    # Lookup the datasets and collections in the specified history; cache, indexed by name
+    # Both visible and hidden datasets are fetched at once. Will not return deleted datasets.
+    # Cached until the history's update time changes, and then only the changed datasets are fetched
+    def _history_contents(self, h):
+        return self.cache.get(('history_contents', h['id']), lambda: self._fetch_history_contents(h),
+                              h.get('update_time'), lambda contents, since: self._updated_contents(h, contents, since))
+
+    # Fetch the contents of a history, with only the keys needed to list them where Galaxy allows it
+    def _fetch_history_contents(self, h):
+        if self.contents_api:
+            contents = HistoryContents(links=not self.remote)
+            if self._get_history_contents(h, 'deleted', 'false', contents.add):
+                contents.make_listing()
+                return contents
+        return HistoryContents(self.gi.histories.show_history(h['id'], contents=True, details='all', deleted=False),
+                               not self.remote)
+
+    # Bring the contents of a history up to date, by fetching the datasets updated since the history's
+    # update time when they were fetched. Deleted datasets are included, so they can be removed.
+    # Galaxy releases that can't filter contents by update time get everything.
+    def _updated_contents(self, h, contents, since):
+        if self.contents_api:
+            changed = []
+            if self._get_history_contents(h, 'update_time-ge', since, changed.extend):
+                return contents.merged(changed)
+        return self._fetch_history_contents(h)
+
+    # Get the contents of a history matching a filter, with only HISTORY_CONTENTS_KEYS, a page at a
+    # time, passing each page to add. Returns False if Galaxy can't do that
+    # Each page starts after the last hid of the one before rather than at an offset, so an item deleted
+    # between pages doesn't shift a later one back onto a page already fetched
+    def _get_history_contents(self, h, q, qv, add):
+        last_hid = None
+        while True:
+            filters = [(q, qv)] + ([('hid-gt', last_hid)] if last_hid is not None else [])
+            response = self.gi.make_get_request(self.gi.url + '/histories/' + h['id'] + '/contents',
+                                                params={'v': 'dev', 'keys': HISTORY_CONTENTS_KEYS,
+                                                        'q': [f[0] for f in filters], 'qv': [f[1] for f in filters],
+                                                        'order': 'hid-asc', 'limit': HISTORY_CONTENTS_PAGE_SIZE})
+            if response.status_code in (400, 404, 501) and last_hid is None:
+                self.contents_api = False
+                return False
+            if response.status_code != 200:
+                raise FuseOSError(EIO)
+            page = response.json()
+            add(page)
+            if len(page) < HISTORY_CONTENTS_PAGE_SIZE:
+                return True
+            last_hid = page[-1]['hid']
+
+    # Lookup the elements of a collection; cache until the collection's update time changes
+    def _collection_elements(self, h, c):
+        if 'elements' in c:
+            # Already fetched with the history contents, by Galaxy releases that can't leave them out
+            return c['elements']
+        return self.cache.get(('collection', c['id']), lambda: self.gi.histories.show_dataset_collection(
+            h['id'], c['id'])['elements'], c.get('update_time'))
 
     # Find a specific dataset - the 'kw' parameter is from path_type() above
     # Will also handle dataset collections.
     def _dataset(self, kw, display=True):
+        return self._dataset_entry(kw, display)[1]
+
+    # Find a specific dataset, and the history contents it was found in
+    # With display, only visible datasets are found, otherwise hidden ones are too
+    def _dataset_entry(self, kw, display=True):
         h = self._history(kw['h_name'])
+        contents = self._history_contents(h)
         if display:
-            ds = self._filtered_datasets(h)
+            d = contents.visible.lookup(kw['ds_name'])
         else:
-            ds = self._all_datasets(h)
-        (d_name, d_id) = parse_name_with_id(kw['ds_name'])
-        d = filter(lambda x: x['name']==d_name, ds)
-
-        if len(d)==0:
+            d = contents.all.lookup(kw['ds_name'])
+        if d is None:
             raise FuseOSError(ENOENT)
-        if len(d)>1:
-            d = filter(lambda x: x['name']==d_name and x['id'] == d_id, ds)
-            if len(d)==0:
-                raise FuseOSError(ENOENT)
-            if len(d)>1:
-                print "Too many datasets with that name and ID"
-            return d[0]
 
         # This is a collection. Deal with it upstream.
-        if d[0]['history_content_type'] == 'dataset_collection':
-            return d[0]
+        if d['history_content_type'] == 'dataset_collection':
+            return (contents, d)
 
         # Some versions of the Galaxy API use file_path and some file_name
-        if 'file_path' not in d[0] and 'file_name' not in d[0]:
+        if 'file_path' not in d and 'file_name' not in d and not self.remote:
             print "Unable to find file of dataset.  Have you set : expose_dataset_path = True"
             raise FuseOSError(ENOENT)
-        return d[0]
+        return (contents, d)
 
     # read directory contents
     def readdir(self, path, fh):
         (typ,kw) = path_type(path)
         if typ=='root':
-            return ['.', '..', 'histories']
+            return ['.', '..', 'histories', 'libraries']
         elif typ=='histories':
-            hl = self._histories()
-            # Count duplicates
-            hist_count = {}
-            for h in hl:
-                try:
-                    hist_count[h['name']] += 1
-                except:
-                    hist_count[h['name']] = 1
-            # Build up results manually
-            results = ['.', '..']
-            for h in hl:
-                if h['name'] in hist_count and hist_count[h['name']] > 1:
-                    results.append(esc_filename(h['name'] + '-' + h['id']))
-                else:
-                    results.append(esc_filename(h['name']))
-            return results
+            # Duplicate names are already handled by the index
+            return ['.', '..'] + self._histories().listing
         elif typ=='datasets':
             h = self._history(kw['h_name'])
-            ds = self._filtered_datasets(h)
-
-            # Count duplicates
-            d_count = {}
-            for d in ds:
-                try:
-                    d_count[d['name']] += 1
-                except:
-                    d_count[d['name']] = 1
-            results = ['.', '..']
-            for d in ds:
-                if d['name'] in d_count and d_count[d['name']] > 1:
-                    results.append(esc_filename(d['name'] + '-' + d['id']))
-                else:
-                    results.append(esc_filename(d['name']))
-            return results
+            return ['.', '..'] + self._history_contents(h).visible.listing
         elif typ=='historydataorcoll':
             # This is a dataset collection
 
-            # Get the datasets in the collection
-            ds = [x['object'] for x in self._dataset(kw)['elements']]
+            c = self._dataset(kw)
 
-            # Get all datasets - we need this for checking and handling duplicates
+            # Names are made unique among all datasets, not just the collection's, so the listing
+            # is taken from the index of all datasets
             # Handles the situation in which duplicates in history and
             # one (or more) of the duplicates are in collection.
             h = self._history(kw['h_name'])
-            all_ds = self._all_datasets(h)
-
-            # Count duplicates
-            d_count = {}
-            for d in all_ds:
-                try:
-                    d_count[d['name']] += 1
-                except:
-                    d_count[d['name']] = 1
-            results = ['.', '..']
-            for d in ds:
-                if d['name'] in d_count and d_count[d['name']] > 1:
-                    results.append(esc_filename(d['name'] + '-' + d['id']))
-                else:
-                    results.append(esc_filename(d['name']))
-            return results
+            all_ds = self._history_contents(h).all
+            return ['.', '..'] + [all_ds.display_name(x['object']) for x in self._collection_elements(h, c)]
+        elif typ=='libraries':
+            return ['.', '..'] + self._libraries().listing
+        elif typ=='library':
+            lib = self._library(kw['l_name'])
+            return ['.', '..'] + self._folder_contents(lib['root_folder_id']).index.listing
+        elif typ=='libraryitem':
+            # This is a library folder
+            (lib, contents, item) = self._library_item(kw)
+            if item['type'] != 'folder':
+                raise FuseOSError(ENOENT)
+            return ['.', '..'] + self._folder_contents(item['id']).index.listing
+
+    # Stop refreshing lookups in the background once the file system is unmounted
+    def destroy(self, path):
+        self.cache.close()
 
     # Disable unused operations:
     access = None
@@ -312,13 +747,55 @@ if __name__ == '__main__':
                         help="Galaxy API key for the account to read")
     parser.add_argument("-m", "--mountpoint", default="galaxy_files",
                         help="Directory under which to mount the Galaxy Datasets.")
+    parser.add_argument("-u", "--url", default=GALAXY_URL,
+                        help="URL of the Galaxy to mount datasets from. Defaults to " + GALAXY_URL)
+    addClientArguments(parser)
+    parser.add_argument("--cache_time", type=float, default=CACHE_TIME,
+                        help="Number of seconds history and dataset lookups are cached for. Defaults to " + str(CACHE_TIME))
+    parser.add_argument("--cache_stale", type=float, default=CACHE_STALE,
+                        help="Number of seconds past --cache_time a lookup is still used for while it is refreshed in the background, 0 to wait for the refresh. Defaults to " + str(CACHE_STALE))
+    parser.add_argument("--refresh_ahead", type=float, default=REFRESH_AHEAD,
+                        help="Number of seconds before they expire that lookups in use are refreshed in the background, 0 to only refresh them when used. Defaults to " + str(REFRESH_AHEAD))
+    parser.add_argument("--cache_entries", type=int, default=CACHE_ENTRIES,
+                        help="Maximum number of history and dataset lookups cached, 0 for no limit. The least recently used are dropped first. Defaults to " + str(CACHE_ENTRIES))
+    parser.add_argument("--cache_mb", type=float, default=CACHE_MB,
+                        help="Approximate maximum number of megabytes taken up by cached lookups, 0 for no limit. Defaults to " + str(CACHE_MB))
+    parser.add_argument("--remote", action="store_true",
+                        help="Read datasets through the Galaxy API, for a Galaxy whose files aren't on this machine, rather than making them symlinks to its files.")
+    parser.add_argument("--block_cache", default=BLOCK_CACHE,
+                        help="Directory to keep the blocks of datasets read with --remote in, between mounts. Defaults to " + BLOCK_CACHE)
+    parser.add_argument("--block_cache_mb", type=float, default=BLOCK_CACHE_MB,
+                        help="Maximum number of megabytes of blocks kept with --remote, 0 for no limit. The least recently used are removed first. Defaults to " + str(BLOCK_CACHE_MB))
+    parser.add_argument("--block_kb", type=int, default=BLOCK_KB,
+                        help="Number of kilobytes of a dataset fetched at a time with --remote. Defaults to " + str(BLOCK_KB))
+    parser.add_argument("--read_ahead", type=int, default=READ_AHEAD,
+                        help="Number of blocks fetched ahead of reads that follow on from the last read of a dataset with --remote, 0 for none. Defaults to " + str(READ_AHEAD))
+    parser.add_argument("--report",
+                        help="File to write a JSON report of the Galaxy API calls made and the time taken by each file system operation to, every --report_interval seconds.")
+    parser.add_argument("--prometheus",
+                        help="File to write the same report to as a Prometheus textfile, every --report_interval seconds.")
+    parser.add_argument("--report_interval", type=float, default=REPORT_INTERVAL,
+                        help="Number of seconds between writes of the report. Defaults to " + str(REPORT_INTERVAL))
     args = parser.parse_args()
 
     # Create the directory if it does not exist
     if not os.path.exists(args.mountpoint):
         os.makedirs(args.mountpoint)
 
-    fuse = FUSE(Context(args.apikey),
+    context = Context(args.apikey, args.timeout, args.retries, url=args.url, cache_time=args.cache_time,
+                      cache_entries=args.cache_entries, cache_mb=args.cache_mb, cache_stale=args.cache_stale,
+                      refresh_ahead=args.refresh_ahead, remote=args.remote, block_cache=args.block_cache,
+                      block_cache_mb=args.block_cache_mb, block_kb=args.block_kb, read_ahead=args.read_ahead)
+    if args.report or args.prometheus:
+        context.metrics.startPeriodicReports(args.report_interval, args.report, args.prometheus,
+                                             context.gi.stats.summary, context.cache_stats)
+
+    fuse = FUSE(context,
                 args.mountpoint,
                 foreground=True,
                 ro=True)
+
+    # Write a last report once the file system is unmounted
+    if args.report or args.prometheus:
+        context.metrics.writeReport(args.report, args.prometheus, context.gi.stats.summary(),
+                                    context.cache_stats())
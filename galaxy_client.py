@@ -0,0 +1,318 @@
+'''
+ Shared Galaxy connection for the scripts in this repository.
+
+ GalaxyClient is a bioblend GalaxyInstance that sends its requests through one pooled
+ requests.Session, so connections are kept alive and reused rather than opened for every
+ call, with enough pooled connections for every worker thread. Every request has a timeout,
+ and requests that fail in a way that is likely to be temporary are retried with jittered
+ exponential backoff:
+
+  - reads (GET), and writes that can safely be repeated (PUT, DELETE), are retried after a
+    connection error, a timeout, or a 429, 502, 503 or 504 response.
+  - other writes (POST, PATCH) are only retried when Galaxy can't have acted on them: when the
+    connection couldn't be made, or on a 429 or 503 response.
+  - uploads of local files are never retried, as their file handles can't be read again.
+
+ The number of requests in flight at once can be capped, and counts of requests, retries,
+ failures, latencies and bytes transferred are kept in ClientStats. If metrics are attached
+ with api_metrics.instrumentClient(), the bytes of each request are also charged to the API
+ call that made it.
+'''
+
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from bioblend import ConnectionError
+from bioblend.galaxy import GalaxyInstance
+
+try:
+    from urllib3.exceptions import NewConnectionError
+except ImportError:
+    from requests.packages.urllib3.exceptions import NewConnectionError
+
+
+# The number of seconds to wait for Galaxy to connect or respond before giving up on a request
+DEFAULT_TIMEOUT = 300
+
+# The number of times a failed request is retried
+DEFAULT_RETRIES = 5
+
+# The number of seconds to wait before the first retry, doubled for each retry after that
+DEFAULT_BACKOFF = 1.0
+
+# The longest wait between retries, in seconds
+MAX_BACKOFF = 60.0
+
+# Response statuses after which a request that can safely be repeated is retried
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Response statuses after which any request is retried, as Galaxy hasn't acted on it
+SAFE_RETRY_STATUSES = (429, 503)
+
+# Methods that can be repeated without changing the result
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+
+class ClientStats(object):
+    '''
+     Counters for the requests made by a GalaxyClient. Safe to share between threads.
+    '''
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.methods = {}
+        self._lock = threading.Lock()
+
+    def recordRequest(self, method, latency, sent=0, received=0, failed=False):
+        '''
+         Count a request attempt.
+
+        :param method: The HTTP method of the request (e.g. 'GET')
+        :param latency: The number of seconds the request took
+        :param sent: The number of bytes sent in the request body
+        :param received: The number of bytes received in the response body
+        :param failed: True if the request failed (after any retries)
+        :return: None
+        '''
+
+        with self._lock:
+            self.requests += 1
+            self.methods[method] = self.methods.get(method, 0) + 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.bytes_sent += sent
+            self.bytes_received += received
+            if failed:
+                self.failures += 1
+
+    def recordRetry(self):
+        '''
+         Count a retry of a request.
+
+        :return: None
+        '''
+
+        with self._lock:
+            self.retries += 1
+
+    def summary(self):
+        '''
+         Get the counters as a dict.
+
+        :return: A dict of the counters, with the mean latency in seconds
+        '''
+
+        with self._lock:
+            return {'requests': self.requests,
+                    'methods': dict(self.methods),
+                    'retries': self.retries,
+                    'failures': self.failures,
+                    'bytes_sent': self.bytes_sent,
+                    'bytes_received': self.bytes_received,
+                    'mean_latency': self.latency / self.requests if self.requests else 0.0,
+                    'max_latency': self.max_latency}
+
+
+class GalaxyClient(GalaxyInstance):
+    '''
+     Galaxy instance object with pooled connections, timeouts and retries.
+
+    :param url: The Galaxy URL
+    :param key: The Galaxy API key to use
+    :param workers: The number of threads that will make requests at once, which sets the size of the connection pool
+    :param timeout: The number of seconds to wait for Galaxy to connect or respond before giving up on a request
+    :param retries: The number of times a failed request is retried
+    :param backoff: The number of seconds to wait before the first retry, doubled for each retry after that
+    :param max_requests: The maximum number of requests in flight at once, 0 for no limit
+    '''
+
+    def __init__(self, url, key, workers=1, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 max_requests=0):
+        GalaxyInstance.__init__(self, url=url, key=key)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = ClientStats()
+        self.metrics = None
+        self._semaphore = threading.BoundedSemaphore(max_requests) if max_requests else None
+
+        # Retries are handled here rather than by the adapter, so they can be counted and backed off with jitter
+        self.session = requests.Session()
+        pool_size = max(1, workers, max_requests)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def make_get_request(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('verify', self.verify)
+        return self._request('GET', url, headers=self.json_headers, **kwargs)
+
+    def make_range_request(self, url, start, end, params=None):
+        '''
+         Send a GET request for part of a file, e.g. of a dataset's contents. The response is streamed, as a server
+         that doesn't support ranges sends the whole file.
+
+        :param url: The URL of the file
+        :param start: The offset of the first byte wanted
+        :param end: The offset of the last byte wanted
+        :param params: A dict of query parameters, or None
+        :return: The response - 206 with the bytes asked for, or 200 with the whole file
+        '''
+
+        headers = dict(self.json_headers, Range='bytes=%d-%d' % (start, end))
+        return self._request('GET', url, params=params, headers=headers, timeout=self.timeout, verify=self.verify,
+                             stream=True)
+
+    def make_post_request(self, url, payload=None, params=None, files_attached=False):
+        if files_attached:
+            # Multipart uploads of local files are sent by bioblend, and can't be retried
+            start = time.time()
+            failed = True
+            try:
+                with self._limit():
+                    result = GalaxyInstance.make_post_request(self, url, payload=payload, params=params,
+                                                              files_attached=True)
+                failed = False
+                return result
+            finally:
+                self.stats.recordRequest('POST', time.time() - start, failed=failed)
+
+        data = json.dumps(payload) if payload is not None else None
+        return self._decode(self._request('POST', url, params=params, data=data, headers=self.json_headers,
+                                          timeout=self.timeout, allow_redirects=False, verify=self.verify))
+
+    def make_put_request(self, url, payload=None, params=None):
+        data = json.dumps(payload) if payload is not None else None
+        return self._decode(self._request('PUT', url, params=params, data=data, headers=self.json_headers,
+                                          timeout=self.timeout, allow_redirects=False, verify=self.verify))
+
+    def make_patch_request(self, url, payload=None, params=None):
+        data = json.dumps(payload) if payload is not None else None
+        return self._decode(self._request('PATCH', url, params=params, data=data, headers=self.json_headers,
+                                          timeout=self.timeout, allow_redirects=False, verify=self.verify))
+
+    def make_delete_request(self, url, payload=None, params=None):
+        data = json.dumps(payload) if payload is not None else None
+        return self._request('DELETE', url, params=params, data=data, headers=self.json_headers,
+                             timeout=self.timeout, allow_redirects=False, verify=self.verify)
+
+    def _request(self, method, url, **kwargs):
+        # Send a request on the pooled session, retrying it as described at the top of the module
+        statuses = RETRY_STATUSES if method in IDEMPOTENT_METHODS else SAFE_RETRY_STATUSES
+        # bioblend releases before 0.16 (the last to run on Python 2) send the API key as a query parameter
+        # rather than a header, so it has to be added here as bioblend's own requests would
+        if 'x-api-key' not in (kwargs.get('headers') or {}):
+            kwargs['params'] = dict(kwargs.get('params') or {}, key=self.key)
+        data = kwargs.get('data')
+        sent = len(data) if isinstance(data, (str, bytes)) else 0
+
+        attempt = 0
+        while True:
+            start = time.time()
+            response = None
+            error = None
+            try:
+                with self._limit():
+                    response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                # A request that was sent before the connection failed may have been acted on
+                error = e
+                retry = method in IDEMPOTENT_METHODS or not wasSent(e)
+            except requests.exceptions.Timeout as e:
+                error = e
+                retry = method in IDEMPOTENT_METHODS
+            else:
+                retry = response.status_code in statuses
+
+            retry = retry and attempt < self.retries
+            received = 0
+            if response is not None:
+                received = int(response.headers.get('Content-Length') or 0)
+                if not received and not kwargs.get('stream'):
+                    received = len(response.content)
+            self.stats.recordRequest(method, time.time() - start, sent, received,
+                                     failed=not retry and (error is not None or response.status_code >= 400))
+            if self.metrics is not None:
+                self.metrics.observeBytes(sent, received)
+
+            if not retry:
+                if error is not None:
+                    raise error
+                return response
+
+            self.stats.recordRetry()
+            delay = self._delay(attempt, response)
+            if response is not None:
+                # Give the connection back to the pool rather than hold it until the response is collected
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def _delay(self, attempt, response=None):
+        # Full jitter: a random delay up to the exponential backoff, or as long as Galaxy asks for
+        delay = random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+        if response is not None:
+            try:
+                delay = max(delay, min(MAX_BACKOFF, float(response.headers.get('Retry-After', 0))))
+            except ValueError:
+                pass
+        return delay
+
+    def _limit(self):
+        # Hold a slot among the requests in flight, if they are capped
+        return self._semaphore if self._semaphore else _NoLimit()
+
+    def _decode(self, response):
+        # Return the decoded body of a successful response, or raise the same error bioblend would
+        if response.status_code == 200:
+            try:
+                return response.json()
+            except ValueError as e:
+                raise ConnectionError("Request was successful, but cannot decode the response content: " + str(e),
+                                      body=response.content, status_code=response.status_code)
+        raise ConnectionError("Unexpected HTTP status code: " + str(response.status_code),
+                              body=response.text, status_code=response.status_code)
+
+
+class _NoLimit(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def wasSent(error):
+    '''
+     Function for checking whether a request that failed with a connection error may have reached Galaxy.
+
+    :param error: The requests ConnectionError
+    :return: False if the connection to Galaxy couldn't be made, so the request wasn't sent
+    '''
+
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return not isinstance(reason, NewConnectionError)
+
+def addClientArguments(parser):
+    '''
+     Function for adding the command line options for a GalaxyClient to an argument parser.
+
+    :param parser: The argparse.ArgumentParser
+    :return: None
+    '''
+
+    parser.add_argument('--timeout', type=float, help='The number of seconds to wait for Galaxy to respond before giving up on a request. Defaults to ' + str(DEFAULT_TIMEOUT), default=DEFAULT_TIMEOUT)
+    parser.add_argument('--retries', type=int, help='The number of times to retry a request that failed with a temporary error. Defaults to ' + str(DEFAULT_RETRIES), default=DEFAULT_RETRIES)
@@ -0,0 +1,132 @@
+'''
+ In-memory index of the folders and files of a Galaxy data library.
+
+ The index is built from a single show_library(lib['id'], contents=True) call, mapping
+ each folder path to its folder ID and each (folder path, file name) to its dataset ID, and
+ is then updated in place as folders are created and files are uploaded, so that
+ checking whether a file is already in the library does not need another API call.
+ Updates are locked so the index can be shared by upload worker threads.
+
+ Folder paths are library paths as reported by Galaxy, e.g. '/' for the root folder
+ and '/salmonella/Salmonella_enterica_XYZ' for a nested folder.
+'''
+
+import threading
+
+
+class LibraryIndex(object):
+    '''
+     Snapshot of the contents of a Galaxy data library.
+
+    :param gi: Galaxy instance object
+    :param lib: The Galaxy library object to index
+    '''
+
+    def __init__(self, gi, lib):
+        self.gi = gi
+        self.lib = lib
+        self.folders = {}
+        self.files = {}
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        '''
+         Replace the index with a fresh snapshot of the library contents.
+
+        :return: None
+        '''
+
+        contents = self.gi.libraries.show_library(self.lib['id'], contents=True)
+
+        folders = {}
+        files = {}
+        for item in contents:
+            if item['type'] == 'folder':
+                folders[item['name']] = item['id']
+            elif item['type'] == 'file':
+                files[splitLibraryPath(item['name'])] = item['id']
+
+        with self._lock:
+            self.folders = folders
+            self.files = files
+
+    def hasFolder(self, folder):
+        '''
+         Check whether a folder exists in the library.
+
+        :param folder: The library path of the folder (e.g. '/salmonella')
+        :return: True if the folder exists
+        '''
+
+        return folder in self.folders
+
+    def getFolderId(self, folder):
+        '''
+         Get the Galaxy ID of a folder in the library.
+
+        :param folder: The library path of the folder (e.g. '/salmonella')
+        :return: The folder ID, or None if the folder does not exist
+        '''
+
+        return self.folders.get(folder)
+
+    def addFolder(self, folder, folder_id):
+        '''
+         Record a folder that has been created in the library.
+
+        :param folder: The library path of the folder (e.g. '/salmonella')
+        :param folder_id: The Galaxy ID of the folder, as returned by create_folder
+        :return: None
+        '''
+
+        with self._lock:
+            self.folders[folder] = folder_id
+
+    def hasFile(self, folder, name):
+        '''
+         Check whether a file exists in a folder of the library.
+
+        :param folder: The library path of the folder containing the file (e.g. '/salmonella')
+        :param name: The file name
+        :return: True if the file exists
+        '''
+
+        return (folder, name) in self.files
+
+    def getFileId(self, folder, name):
+        '''
+         Get the Galaxy ID of the library dataset for a file in the library.
+
+        :param folder: The library path of the folder containing the file (e.g. '/salmonella')
+        :param name: The file name
+        :return: The library dataset ID, or None if the file does not exist
+        '''
+
+        return self.files.get((folder, name))
+
+    def addFile(self, folder, name, dataset_id=None):
+        '''
+         Record a file that has been added to the library.
+
+        :param folder: The library path of the folder containing the file (e.g. '/salmonella')
+        :param name: The file name
+        :param dataset_id: The Galaxy ID of the library dataset, as returned by the upload call
+        :return: None
+        '''
+
+        with self._lock:
+            self.files[(folder, name)] = dataset_id
+
+
+def splitLibraryPath(path):
+    '''
+     Split a library path into its folder path and file name.
+     e.g. turn '/salmonella/abc.gbk' into ('/salmonella', 'abc.gbk') and '/abc.gbk' into ('/', 'abc.gbk')
+
+    :param path: The library path of a file
+    :return: A tuple of (folder path, file name)
+    '''
+
+    folder, _, name = path.rpartition('/')
+    return (folder or '/', name)
@@ -3,7 +3,7 @@ Script to edit permissions of an existing Galaxy data library.
 
 usage: library_permissions.py [-h] [-u URL] [-k KEY]
                               [-e [EMAILS [EMAILS ...]]] [-a] [-s] [-i] [-p]
-                              [-r] [-v]
+                              [-r] [-v] [--timeout TIMEOUT] [--retries RETRIES]
                               name
 
 Edit permissions for an existing data library. This script will append users
@@ -32,13 +32,17 @@ optional arguments:
                         unspecified, reset specified categories to default
                         permission level.
   -v, --verbose         Print out debugging information
+  --timeout TIMEOUT     The number of seconds to wait for Galaxy to respond
+                        before giving up on a request. Defaults to 300
+  --retries RETRIES     The number of times to retry a request that failed
+                        with a temporary error. Defaults to 5
 
 NOTE: You cannot restrict access to a data library for any admin users.
 
 '''
 
 from __future__ import print_function
-from bioblend.galaxy import GalaxyInstance
+from galaxy_client import GalaxyClient, addClientArguments
 
 import argparse
 import sys
@@ -130,6 +134,7 @@ def main():
                         help='Overwrite existing permissions for the specified categories with the specified users. If users unspecified, reset specified categories to default permission level.')
 
     parser.add_argument('-v', '--verbose', action="store_true", help='Print out debugging information')
+    addClientArguments(parser)
 
 
     # Parse args.
@@ -154,7 +159,7 @@ def main():
 
     # Initiating Galaxy connection.
     if args.verbose: print("Connecting to Galaxy")
-    gi = GalaxyInstance(url=args.url, key=args.key)
+    gi = GalaxyClient(args.url, args.key, timeout=args.timeout, retries=args.retries)
 
     # Get list of existing libraries.
     libraries = gi.libraries.get_libraries(deleted=False)
@@ -1,16 +1,31 @@
 '''
  Script to make data library of RefSeq reference genomes for specified genus (or species)
-usage: refseq_to_library.py [-h] [-s SPECIES] [-u URL] [-d DIR] [-k KEY] [-v]
-                            [-t [FILETYPES [FILETYPES ...]]] [-e]
-                            genus
+usage: refseq_to_library.py [-h] [-f GENERA_FILE] [--all] [-s SPECIES] [-u URL]
+                            [-d DIR] [-k KEY] [-v]
+                            [-t [FILETYPES [FILETYPES ...]]] [-e] [-w WORKERS]
+                            [-c CONCURRENT_GENERA] [--max_requests MAX_REQUESTS]
+                            [--timeout TIMEOUT] [--retries RETRIES]
+                            [-b BATCH_SIZE] [--batch_bytes BATCH_BYTES]
+                            [--max_pending MAX_PENDING]
+                            [--poll_interval POLL_INTERVAL]
+                            [-i TAXONOMY_INDEX] [-m MANIFEST] [--checksum]
+                            [--checksum_processes CHECKSUM_PROCESSES]
+                            [--skip_duplicates] [-p PLAN] [--report REPORT]
+                            [--prometheus PROMETHEUS]
+                            [genus [genus ...]]
 
 Add RefSeq reference genomes to galaxy data libraries.
 
 positional arguments:
-  genus                 the genus to create a library for
+  genus                 the genus (or genera) to create a library for
 
 optional arguments:
   -h, --help            show this help message and exit
+  -f GENERA_FILE, --genera_file GENERA_FILE
+                        A file listing genera to create libraries for, one per
+                        line
+  --all                 Create a library for every genus in the RefSeq
+                        directory
   -s SPECIES, --species SPECIES
                         the species to create the library for
   -u URL, --url URL     the galaxy URL
@@ -23,6 +38,64 @@ optional arguments:
                         data library. Defaults to fna, faa, ffn, gbk, gff
   -e, --exclude         Exclude the file types specified in -t. Defaults to
                         excluding fna, faa, ffn, gbk, gff
+  -w WORKERS, --workers WORKERS
+                        The number of uploads to run concurrently. Defaults to
+                        1
+  -c CONCURRENT_GENERA, --concurrent_genera CONCURRENT_GENERA
+                        The number of genus libraries to work on concurrently.
+                        Defaults to 1
+  --max_requests MAX_REQUESTS
+                        The maximum number of Galaxy API requests in flight at
+                        once, across all genera and uploads. Defaults to 0 (no
+                        limit)
+  --timeout TIMEOUT     The number of seconds to wait for Galaxy to respond
+                        before giving up on a request. Defaults to 300
+  --retries RETRIES     The number of times to retry a request that failed
+                        with a temporary error. Defaults to 5
+  -b BATCH_SIZE, --batch_size BATCH_SIZE
+                        The maximum number of files to link in a single upload
+                        request to a local Galaxy. Defaults to 1
+  --batch_bytes BATCH_BYTES
+                        The maximum total size, in bytes, of the files linked
+                        in a single upload request to a local Galaxy. Defaults
+                        to 0 (no limit)
+  --max_pending MAX_PENDING
+                        The maximum number of uploaded datasets waiting for
+                        their Galaxy jobs to finish at once. Uploads wait for
+                        earlier ones to finish, and failed datasets are listed
+                        at the end. Defaults to 0 (no limit)
+  --poll_interval POLL_INTERVAL
+                        The number of seconds between checks of the states of
+                        uploaded datasets, with --max_pending. Defaults to 10
+  -i TAXONOMY_INDEX, --taxonomy_index TAXONOMY_INDEX
+                        The file to keep an index of the genus and species
+                        folders in the RefSeq directory in. The index is
+                        rebuilt when the RefSeq directory changes. Use "" to
+                        always scan the RefSeq directory. Defaults to
+                        ~/.refseq_taxonomy_index.json
+  -m MANIFEST, --manifest MANIFEST
+                        A sync manifest file. Folders and files that are
+                        unchanged since they were recorded in the manifest are
+                        skipped, and files that have changed are replaced.
+  --checksum            Checksum files (caching the checksums in the
+                        manifest), so only files whose contents have changed
+                        are replaced. Needs -m.
+  --checksum_processes CHECKSUM_PROCESSES
+                        The number of processes to checksum files with.
+                        Defaults to 0 (one per CPU)
+  --skip_duplicates     Skip files with the same contents as a file already
+                        added to the library. Needs --checksum.
+  -p PLAN, --plan PLAN  Write a plan of the folders and files that would be
+                        added to each library, as newline-delimited JSON, to
+                        this file ("-" for stdout), without changing any
+                        library. The manifest is not used.
+  --report REPORT       Write a JSON report of the Galaxy API calls made (with
+                        counts, latency histograms and bytes transferred) and
+                        the time spent in each phase to this file when the run
+                        ends
+  --prometheus PROMETHEUS
+                        Write the same report as a Prometheus textfile to this
+                        file when the run ends
 
  Needs an API key in GALAXY_KEY unless specified via command line
  Assumes Galaxy instance exists at localhost and refseq folder has the following structure:
@@ -34,12 +107,28 @@ optional arguments:
 
 from __future__ import print_function
 from collections import defaultdict
-from bioblend.galaxy import GalaxyInstance
+from api_metrics import RunMetrics, instrumentClient
+from checksums import ChecksumPool
+from dataset_tracker import DatasetTracker
+from galaxy_client import GalaxyClient, addClientArguments
+from library_index import LibraryIndex
+from sync_manifest import SyncManifest
+from sync_plan import PlanWriter
+from upload_pool import UploadPool, batchFiles, uploadFiles
 
 import os
 import sys
+import json
 import argparse
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+# Version of the taxonomy index file format, bump this if it changes
+TAXONOMY_INDEX_VERSION = 1
+
 
 def printerr(*args):
     '''
@@ -52,26 +141,6 @@ def printerr(*args):
     print(*args, file=sys.stderr)
 
 
-def getFilesInLibraryFolder(contents, folder):
-    '''
-     Function for getting a list of all files in a library's folder.
-
-    :param contents: The contents of the library - can be obtained with show_library(lib['id'], contents=True)
-    :param folder: The name of the folder (as a string)
-    :return: A list of file names (strings) within folder
-    '''
-
-    file_names = []
-    for item in contents:
-        # Split file path
-        filepath = item['name'].split('/')
-
-        # Check if file and inside folder, if so, add to list
-        if item['type'] == 'file' and filepath[1] == folder:
-            file_names.append(filepath[2])
-
-    return file_names
-
 def getFilesToInclude(filePath, fileTypes, exclude=False):
     '''
      Function for getting a list of all files of a given type (or the inverse).
@@ -96,151 +165,510 @@ def getFilesToInclude(filePath, fileTypes, exclude=False):
 
     return files_to_include
 
-if __name__ == "__main__":
+def parseRefSeqFolder(folder):
+    '''
+     Function for getting the genus and species from the name of a RefSeq folder.
+     e.g. turn 'Salmonella_enterica_serovar_Typhi_uid123' into ('salmonella', 'enterica')
+
+    :param folder: The name of the folder
+    :return: A tuple of (genus, species) in lowercase, or None if the folder isn't a RefSeq genome folder
+    '''
+
+    # Ignore hidden folders/files
+    if folder[0] == ".":
+        return None
+
+    # If folder starts with a _ then trim string
+    folder_tmp = folder
+    if folder_tmp.find("_") == 0:
+        folder_tmp = folder_tmp[1:]
+
+    # Grab genus and species from folder name
+    split_point = folder_tmp.split("_")
+    if len(split_point) > 2:
+        return (split_point[0].lower(), split_point[1].lower())
+    return None
+
+def scanRefSeqDirectory(refseq_dir, verbose=False):
+    '''
+     Function for making a dict of all genus/species/RefSeq directories.
+
+    :param refseq_dir: The RefSeq directory containing all species
+    :param verbose: True if we're outputting debugging info.
+    :return: A dict mapping genus to a dict of species to a list of folder names
+    '''
+
+    dirs = defaultdict(lambda : defaultdict(list))
+
+    for entry in scandir(refseq_dir):
+        if verbose: print("Processing folder - " + entry.name)
+
+        taxonomy = parseRefSeqFolder(entry.name)
+        if taxonomy and entry.is_dir():
+            dirs[taxonomy[0]][taxonomy[1]].append(entry.name)
+
+    return dirs
+
+def loadTaxonomyIndex(index_path, refseq_dir, verbose=False):
+    '''
+     Function for getting the dict of all genus/species/RefSeq directories, from the taxonomy index file if it
+     is up to date, otherwise by scanning the RefSeq directory and saving the result to the index file.
+     The index is out of date if the RefSeq directory's mtime has changed since it was written, as that
+     happens whenever a folder is added to, removed from or renamed in the directory.
+
+    :param index_path: The path of the taxonomy index file, or None to always scan the RefSeq directory
+    :param refseq_dir: The RefSeq directory containing all species
+    :param verbose: True if we're outputting debugging info.
+    :return: A dict mapping genus to a dict of species to a list of folder names
+    '''
+
+    mtime = os.stat(refseq_dir).st_mtime
+
+    if index_path and os.path.exists(index_path):
+        try:
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+            if (index['version'] == TAXONOMY_INDEX_VERSION and index['directory'] == os.path.abspath(refseq_dir)
+                    and index['mtime'] == mtime):
+                if verbose: print("Using taxonomy index - " + index_path)
+                dirs = defaultdict(lambda : defaultdict(list))
+                for genus, species in index['genera'].items():
+                    dirs[genus].update(species)
+                return dirs
+        except (ValueError, KeyError, IOError):
+            printerr("WARNING: Ignoring unreadable taxonomy index at " + index_path)
+
+    dirs = scanRefSeqDirectory(refseq_dir, verbose)
+
+    if index_path:
+        if verbose: print("Saving taxonomy index - " + index_path)
+        index = {'version': TAXONOMY_INDEX_VERSION,
+                 'directory': os.path.abspath(refseq_dir),
+                 'mtime': mtime,
+                 'genera': dirs}
+        try:
+            # Write to a temporary file first, so another run never reads a partly written index
+            with open(index_path + ".tmp", "w") as index_file:
+                json.dump(index, index_file, separators=(',', ':'))
+            os.rename(index_path + ".tmp", index_path)
+        except (IOError, OSError) as e:
+            printerr("WARNING: Could not save taxonomy index to " + index_path + ": " + str(e))
+
+    return dirs
+
+def readGeneraFile(genera_file):
+    '''
+     Function for reading a list of genera from a file, one per line. Blank lines and lines starting with # are ignored.
+
+    :param genera_file: The path of the file
+    :return: A list of genera (strings) in lowercase
+    '''
+
+    with open(genera_file) as f:
+        return [line.strip().lower() for line in f if line.strip() and not line.strip().startswith("#")]
+
+def getLibraryFolders(dirs, genus, species=""):
+    '''
+     Function for getting the library name and RefSeq folders for a genus - if species is not specified,
+     the library has all species in the genus.
+
+    :param dirs: A dict mapping genus to a dict of species to a list of folder names
+    :param genus: The genus
+    :param species: The species, or "" for all species in the genus
+    :return: A tuple of (library name, list of RefSeq folder names)
+    '''
+
+    if species:
+        return genus + " " + species, dirs[genus][species]
+    return genus, [folder for spc in dirs[genus] for folder in dirs[genus][spc]]
+
+def syncLibrary(gi, libraries, lib_name, folders, refseq_dir, file_types, exclude, galaxy_url, pool, manifest,
+                synced_folders, verbose=False, batch_size=1, batch_bytes=0, checksum_pool=None, duplicates=None,
+                tracker=None, metrics=None):
+    '''
+     Function for adding the files in a list of RefSeq folders to a data library, creating the library if needed.
+     Folders are created straight away, the files are queued on the upload pool.
+     If a checksum pool is given, a file is only treated as changed if its contents have changed, and if a list
+     of duplicates is also given, files with the same contents as one already added to the library are skipped.
+
+    :param gi: Galaxy instance object
+    :param libraries: The existing libraries - obtained with get_libraries(deleted=False)
+    :param lib_name: The name of the library (e.g. 'salmonella' or 'salmonella enterica')
+    :param folders: A list of RefSeq folder names to add to the library
+    :param refseq_dir: The RefSeq directory containing all species
+    :param file_types: A list of file types you wish to include/exclude.
+    :param exclude: True if you want to exclude files matching those in file_types.
+    :param galaxy_url: The URL of the galaxy instance
+    :param pool: The UploadPool to queue uploads on
+    :param manifest: The SyncManifest to skip unchanged folders and files with, or None
+    :param synced_folders: A list to append (folder path, folder mtime, library ID) to for each folder synced
+    :param verbose: True if we're outputting debugging info.
+    :param batch_size: The maximum number of files to link in a single request.
+    :param batch_bytes: The maximum total size of the files linked in a single request, 0 for no limit.
+    :param checksum_pool: The ChecksumPool to checksum files with, or None to compare files by size and mtime
+    :param duplicates: A list to append (file path, file path with the same contents) to for each duplicate
+                       file skipped, or None to add duplicates
+    :param tracker: The DatasetTracker to limit the number of unfinished uploads with, or None
+    :param metrics: The RunMetrics to time the scan and checksum phases in, or None
+    :return: None
+    '''
+
+    if metrics is None:
+        metrics = RunMetrics('refseq_to_library')
+
+    # Get existing library info if it does exist, if it doesn't exist create library
+    existing = [lib for lib in libraries if lib['name'] == lib_name and not lib['deleted']]
+    if existing:
+        if verbose: print("Library already exists - checking it is up to date - " + lib_name)
+
+        # Get library - assumes there is only one library of that name
+        lib = existing[0]
+    else:
+        if verbose: print("Library doesn't exist - adding new library - " + lib_name)
+        lib = gi.libraries.create_library(lib_name, "Reference genomes for " + lib_name)
+
+    if manifest:
+        manifest.checkOptions(lib['id'], str(sorted(file_types)) + " exclude=" + str(exclude))
+
+    # The snapshot of the library contents is only taken once a folder needs checking
+    index = None
+
+    # Go through each folder and add appropriate files
+    for folder in folders:
+        lib_folder = "/" + folder
+        folder_mtime = os.stat(refseq_dir + folder).st_mtime
+
+        # Skip folders that haven't changed since they were last synced
+        if manifest and manifest.isDirectoryUnchanged(refseq_dir + folder, folder_mtime, lib['id']):
+            if verbose: print("Directory unchanged: " + folder)
+            continue
+
+        if index is None:
+            index = LibraryIndex(gi, lib)
+
+        # Check if folder exists, get required info if it does, otherwise create it
+        if index.hasFolder(lib_folder):
+            if verbose: print("Directory exists: " + folder)
+        else:
+            if verbose: print("Adding directory to library - " + folder)
+            fldr = gi.libraries.create_folder(lib['id'], folder)[0]
+            index.addFolder(lib_folder, fldr['id'])
+
+        folder_id = index.getFolderId(lib_folder)
+
+        candidates = []
+        with metrics.phase('scan'):
+            for fna in getFilesToInclude(refseq_dir + folder, file_types, exclude):
+                file_path = refseq_dir + folder + "/" + fna
+
+                if manifest and manifest.isFileUnchanged(file_path, os.stat(file_path), lib['id']):
+                    if verbose: print("File unchanged - " + fna)
+                    continue
+                candidates.append((fna, file_path))
+
+        # Checksum the folder's files in parallel, if we're comparing files by their contents
+        checksums = {}
+        if checksum_pool:
+            with metrics.phase('checksum'):
+                checksums = checksum_pool.getChecksums([file_path for _, file_path in candidates])
+
+        pending = []
+        replaced = {}
+        for fna, file_path in candidates:
+            checksum = checksums.get(file_path)
+            record = manifest.getFile(file_path, lib['id']) if manifest else None
+
+            # If file doesn't exist, add it - unless the library already has a file with the same contents
+            if not index.hasFile(lib_folder, fna):
+                duplicate = None
+                if checksum and duplicates is not None:
+                    duplicate = checksum_pool.claim(file_path, checksum, lib['id'])
+                if duplicate:
+                    if verbose: print("Skipping duplicate file - " + fna + " (same as " + duplicate + ")")
+                    duplicates.append((file_path, duplicate))
+                    continue
+
+                if verbose: print("Adding file - " + fna)
+                pending.append(file_path)
+            elif record is not None and not (checksum and record['checksum'] == checksum):
+                # The file has changed since it was added - replace it, deleting the old one once it's uploaded
+                if verbose: print("Replacing changed file - " + fna)
+                replaced[file_path] = index.getFileId(lib_folder, fna)
+                pending.append(file_path)
+            else:
+                if verbose: print("File exists - " + fna)
+                if manifest:
+                    manifest.recordFile(file_path, os.stat(file_path), lib['id'], folder_id,
+                                        index.getFileId(lib_folder, fna), checksum)
+
+        # Links to a local Galaxy can be made for several files at once, uploads are one file per request
+        if "127.0.0.1" in galaxy_url or "localhost" in galaxy_url:
+            batches = batchFiles(pending, batch_size, batch_bytes)
+        else:
+            batches = [[file_path] for file_path in pending]
+
+        for batch in batches:
+            pool.submit(batch, uploadFiles, gi, lib, index, lib_folder, folder_id, batch, galaxy_url, manifest,
+                        checksums=checksums, tracker=tracker, replaced=replaced)
+
+        synced_folders.append((refseq_dir + folder, folder_mtime, lib['id']))
+
+def planLibrary(gi, libraries, lib_name, folders, refseq_dir, file_types, exclude, plan):
+    '''
+     Function for writing a plan of the folders and files that syncing a list of RefSeq folders would add to a
+     data library, from one snapshot of the library. Nothing in Galaxy is changed.
+
+    :param gi: Galaxy instance object
+    :param libraries: The existing libraries - obtained with get_libraries(deleted=False)
+    :param lib_name: The name of the library (e.g. 'salmonella' or 'salmonella enterica')
+    :param folders: A list of RefSeq folder names to add to the library
+    :param refseq_dir: The RefSeq directory containing all species
+    :param file_types: A list of file types you wish to include/exclude.
+    :param exclude: True if you want to exclude files matching those in file_types.
+    :param plan: The PlanWriter to write the plan with
+    :return: None
+    '''
+
+    existing = [lib for lib in libraries if lib['name'] == lib_name and not lib['deleted']]
+    index = LibraryIndex(gi, existing[0]) if existing else None
+
+    local_files = (("/" + folder, fna, refseq_dir + folder + "/" + fna) for folder in folders
+                   for fna in getFilesToInclude(refseq_dir + folder, file_types, exclude))
+    plan.writeLibrary(lib_name, index, local_files)
+
+def main():
     # Default values
-    GALAXY_URL = 'http://127.0.0.1:8080/galaxy/'
-    GALAXY_KEY = ''
-    REFSEQ_DIR = '/mnt/galaxyIndices/Bacteria/'
-    FILE_TYPES=['fna', 'faa', 'ffn', 'gbk', 'gff']
+    galaxy_url = 'http://127.0.0.1:8080/galaxy/'
+    galaxy_key = ''
+    refseq_dir = '/mnt/galaxyIndices/Bacteria/'
+    file_types = ['fna', 'faa', 'ffn', 'gbk', 'gff']
+    taxonomy_index = os.path.expanduser('~/.refseq_taxonomy_index.json')
 
     # Get things like API Key, RefSeq directory and genus from command line
     parser = argparse.ArgumentParser(description='Add RefSeq reference genomes to galaxy data libraries.')
 
-    parser.add_argument("genus", type=str, help="the genus to create a library for")
+    parser.add_argument("genus", type=str, nargs='*', help="the genus (or genera) to create a library for")
+    parser.add_argument('-f', '--genera_file', type=str, help='A file listing genera to create libraries for, one per line')
+    parser.add_argument('--all', action='store_true', help='Create a library for every genus in the RefSeq directory')
     parser.add_argument('-s', '--species', type=str, help='the species to create the library for', default="")
-    parser.add_argument('-u', '--url', type=str, help='the galaxy URL', default=GALAXY_URL)
-    parser.add_argument('-d', '--dir', type=str, help='the RefSeq directory containing all species (overrides default)', default=REFSEQ_DIR)
-    parser.add_argument('-k', '--key', type=str, help='the Galaxy API key to use (overrides default)', default=GALAXY_KEY)
+    parser.add_argument('-u', '--url', type=str, help='the galaxy URL', default=galaxy_url)
+    parser.add_argument('-d', '--dir', type=str, help='the RefSeq directory containing all species (overrides default)', default=refseq_dir)
+    parser.add_argument('-k', '--key', type=str, help='the Galaxy API key to use (overrides default)', default=galaxy_key)
     parser.add_argument('-v', '--verbose', action="store_true", help='Print out debugging information')
-    parser.add_argument('-t', '--filetypes', nargs='*', help='A space-seperated list of filetypes to include in the data library. Defaults to fna, faa, ffn, gbk, gff', default=FILE_TYPES)
+    parser.add_argument('-t', '--filetypes', nargs='*', help='A space-seperated list of filetypes to include in the data library. Defaults to fna, faa, ffn, gbk, gff', default=file_types)
     parser.add_argument('-e', '--exclude', action='store_true', help='Exclude the file types specified in -t. Defaults to excluding fna, faa, ffn, gbk, gff')
-
-    # Parse args, store genus in lowercase
+    parser.add_argument('-w', '--workers', type=int, help='The number of uploads to run concurrently. Defaults to 1', default=1)
+    parser.add_argument('-c', '--concurrent_genera', type=int, help='The number of genus libraries to work on concurrently. Defaults to 1', default=1)
+    parser.add_argument('--max_requests', type=int, help='The maximum number of Galaxy API requests in flight at once, across all genera and uploads. Defaults to 0 (no limit)', default=0)
+    addClientArguments(parser)
+    parser.add_argument('-b', '--batch_size', type=int, help='The maximum number of files to link in a single upload request to a local Galaxy. Defaults to 1', default=1)
+    parser.add_argument('--batch_bytes', type=int, help='The maximum total size, in bytes, of the files linked in a single upload request to a local Galaxy. Defaults to 0 (no limit)', default=0)
+    parser.add_argument('-i', '--taxonomy_index', type=str, help='The file to keep an index of the genus and species folders in the RefSeq directory in. The index is rebuilt when the RefSeq directory changes. Use "" to always scan the RefSeq directory. Defaults to ~/.refseq_taxonomy_index.json', default=taxonomy_index)
+    parser.add_argument('-m', '--manifest', type=str, help='A sync manifest file. Folders and files that are unchanged since they were recorded in the manifest are skipped, and files that have changed are replaced.')
+    parser.add_argument('--max_pending', type=int, help='The maximum number of uploaded datasets waiting for their Galaxy jobs to finish at once. Uploads wait for earlier ones to finish, and failed datasets are listed at the end. Defaults to 0 (no limit)', default=0)
+    parser.add_argument('--poll_interval', type=float, help='The number of seconds between checks of the states of uploaded datasets, with --max_pending. Defaults to 10', default=10)
+    parser.add_argument('--checksum', action='store_true', help='Checksum files (caching the checksums in the manifest), so only files whose contents have changed are replaced. Needs -m.')
+    parser.add_argument('--checksum_processes', type=int, help='The number of processes to checksum files with. Defaults to 0 (one per CPU)', default=0)
+    parser.add_argument('--skip_duplicates', action='store_true', help='Skip files with the same contents as a file already added to the library. Needs --checksum.')
+    parser.add_argument('-p', '--plan', type=str, help='Write a plan of the folders and files that would be added to each library, as newline-delimited JSON, to this file ("-" for stdout), without changing any library. The manifest is not used.')
+    parser.add_argument('--report', type=str, help='Write a JSON report of the Galaxy API calls made (with counts, latency histograms and bytes transferred) and the time spent in each phase to this file when the run ends')
+    parser.add_argument('--prometheus', type=str, help='Write the same report as a Prometheus textfile to this file when the run ends')
+
+    # Parse args, store genera in lowercase
     args = parser.parse_args()
-    genus = args.genus.lower()
+    if args.checksum and not args.manifest:
+        parser.error("--checksum needs a manifest (-m)")
+    if args.skip_duplicates and not args.checksum:
+        parser.error("--skip_duplicates needs --checksum")
+    genera = [genus.lower() for genus in args.genus]
 
     # Renaming for readability.
     species = args.species.lower()
-    GALAXY_URL = args.url
-    REFSEQ_DIR = args.dir
-    GALAXY_KEY = args.key
-    FILE_TYPES = args.filetypes
+    galaxy_url = args.url
+    refseq_dir = args.dir
+    galaxy_key = args.key
+    file_types = args.filetypes
 
 
     # Ensure the RefSeq directory and Galaxy URL end in a / to avoid errors later
-    if REFSEQ_DIR[-1] != "/": REFSEQ_DIR += "/"
-    if GALAXY_URL[-1] != "/": GALAXY_URL += "/"
+    if refseq_dir[-1] != "/": refseq_dir += "/"
+    if galaxy_url[-1] != "/": galaxy_url += "/"
 
 
     # Print out debugging info
     if args.verbose:
-        print("Galaxy URL: " + GALAXY_URL)
-        print("Galaxy Key: " + GALAXY_KEY)
-        print("RefSeq Directory: " + REFSEQ_DIR)
-        print("Genus: " + genus)
+        print("Galaxy URL: " + galaxy_url)
+        print("Galaxy Key: " + galaxy_key)
+        print("RefSeq Directory: " + refseq_dir)
+        print("Genera: " + str(genera) + (" + " + args.genera_file if args.genera_file else "") + (" + all" if args.all else ""))
         print("Species: " + species)
+        print("Workers: " + str(args.workers) + " uploads, " + str(args.concurrent_genera) + " genera, " + str(args.max_requests) + " requests")
+        print("Batch size: " + str(args.batch_size) + " files, " + str(args.batch_bytes) + " bytes")
+        print("Max pending datasets: " + str(args.max_pending) + ", polled every " + str(args.poll_interval) + " seconds")
+        print("Taxonomy index: " + str(args.taxonomy_index))
+        print("Manifest: " + str(args.manifest))
+        print("Checksum: " + str(args.checksum) + ", " + str(args.checksum_processes) + " processes, skip duplicates " + str(args.skip_duplicates))
+        print("Plan: " + str(args.plan))
+        print("Report: " + str(args.report) + ", Prometheus: " + str(args.prometheus))
 
     # Check the RefSeq directory exists, exit if we can't find it
-    if not os.path.isdir(REFSEQ_DIR):
-        printerr("ERROR: The RefSeq directory could not be found at " + REFSEQ_DIR)
+    if not os.path.isdir(refseq_dir):
+        printerr("ERROR: The RefSeq directory could not be found at " + refseq_dir)
         sys.exit(1)
 
-    # Initiating Galaxy connection
-    gi = GalaxyInstance(url=GALAXY_URL, key=GALAXY_KEY)
-
+    # Calls to Galaxy and phases of local work are timed for the report
+    metrics = RunMetrics('refseq_to_library')
 
     # Make a dict of all genus/species/RefSeq directories, map genus to a dict of species:folder pairs
-    dirs = defaultdict(lambda : defaultdict(list))
-
-    for folder in os.listdir(REFSEQ_DIR):
-        if args.verbose: print("Processing folder - " + folder)
-
-        # Ignore hidden folders/files
-        if folder[0] != ".":
-            # Temp copy folder in case it starts with a _
-            folder_tmp = folder
-
-            # If folder starts with a _ then trim string
-            if folder_tmp.find("_") == 0:
-                folder_tmp = folder_tmp[1:]
-
-            # Grab genus from folder name, add species:folder pair to genus dict
-            split_point = folder_tmp.split("_")
-            if len(split_point) > 2:
-                dirs[split_point[0].lower()][split_point[1].lower()].append(folder)
+    with metrics.phase('taxonomy_index'):
+        dirs = loadTaxonomyIndex(args.taxonomy_index, refseq_dir, args.verbose)
+
+    # Collect the genera to make libraries for, without duplicates
+    if args.genera_file:
+        genera += readGeneraFile(args.genera_file)
+    if args.all:
+        genera += sorted(dirs.keys())
+    seen = set()
+    unique_genera = []
+    for genus in genera:
+        if genus not in seen:
+            seen.add(genus)
+            unique_genera.append(genus)
+    genera = unique_genera
+
+    if not genera:
+        printerr("ERROR: No genus specified - give a genus, a file of genera with -f, or --all")
+        sys.exit(1)
 
+    if species and len(genera) > 1:
+        printerr("ERROR: A species can only be specified for a single genus")
+        sys.exit(1)
 
-    # If we don't have the genus, error and exit
-    if genus not in dirs:
+    # If we don't have a genus, error and skip it, exit if we have none left
+    failed = False
+    for genus in [genus for genus in genera if genus not in dirs]:
         printerr("ERROR: There are no genomes for your specified genus " + genus)
+        genera.remove(genus)
+        failed = True
+    if not genera:
         sys.exit(1)
 
     # If we don't have the species, error and exit
-    if species and species not in dirs[genus].keys():
+    if species and species not in dirs[genera[0]].keys():
         printerr("ERROR: There are no genomes for your specified species " + species)
         sys.exit(1)
 
+    # Initiating Galaxy connection, shared by all genera, with a connection for each upload and genus worker
+    gi = GalaxyClient(galaxy_url, galaxy_key, workers=args.workers + args.concurrent_genera, timeout=args.timeout,
+                      retries=args.retries, max_requests=args.max_requests)
+    instrumentClient(gi, metrics)
+
     # Check for existing libraries
     libraries = gi.libraries.get_libraries(deleted=False)
 
-    # Determine the library name - if species is not specified, nothing is added and trailing whitespace trimmed
-    possible_lib_name = genus + " " + species
-    possible_lib_name = possible_lib_name.strip()
-
-    # Get existing library info if it does exist, if it doesn't exist create library
-    if possible_lib_name in [lib['name'] for lib in libraries if not lib['deleted']]:
-        if args.verbose: print("Library already exists - checking it is up to date")
-
-        # Get library - assumes there is only one library of that name
-        lib = gi.libraries.get_libraries(name=possible_lib_name, deleted=False)[0]
-    else:
-        if args.verbose: print("Library doesn't exist - adding new library")
-        lib = gi.libraries.create_library(possible_lib_name, "Reference genomes for " + possible_lib_name)
-
-    # Species needs to be an iterable - ensure it is
-    if species:
-        # If species exists, put it in a list
-        species = [species]
-    else:
-        # If it was unspecified, make it a list of all the possible species
-        species = list(dirs[genus].keys())
-
-    # Get all the directory names for checking later on
-    lib_dirs = [d['name'][1:] for d in gi.libraries.get_folders(lib['id'])]
-
-    # For each species specified, go through each folder and add appropriate files
-    for spc in species:
-        for folder in dirs[genus][spc]:
-
-            # Check if folder exists, get required info if it does, otherwise create it
-            if folder in lib_dirs:
-                if args.verbose: print("Directory exists: " + folder)
-
-                # Get directory information
-                fldr = gi.libraries.get_folders(lib['id'], name="/" + folder)[0]
+    # Only write a plan of the changes, if asked to - nothing in Galaxy is changed
+    if args.plan:
+        out = sys.stdout if args.plan == "-" else open(args.plan, "w")
+        plan = PlanWriter(out)
+        genus_pool = UploadPool(args.concurrent_genera)
+        for genus in genera:
+            lib_name, folders = getLibraryFolders(dirs, genus, species)
+            genus_pool.submit(genus, planLibrary, gi, libraries, lib_name, folders, refseq_dir, file_types,
+                              args.exclude, plan)
+        with metrics.phase('plan'):
+            genus_errors = genus_pool.join()
+        plan.close()
+        if out is not sys.stdout:
+            out.close()
+        if args.report or args.prometheus:
+            metrics.writeReport(args.report, args.prometheus, gi.stats.summary())
+
+        for genus, error in genus_errors:
+            printerr("ERROR: The plan for genus " + genus + " could not be made: " + str(error))
+        sys.exit(1 if failed or genus_errors else 0)
+
+    # Open the sync manifest, if we're using one
+    manifest = None
+    if args.manifest:
+        manifest = SyncManifest(args.manifest)
+
+    # The checksum processes are started before the upload threads, so they aren't forked from a threaded process
+    checksum_pool = ChecksumPool(manifest, args.checksum_processes) if args.checksum else None
+    duplicates = [] if args.skip_duplicates else None
+
+    # Uploads for all genera wait for room among the unfinished datasets, if we're limiting them
+    tracker = DatasetTracker(gi, args.max_pending, args.poll_interval) if args.max_pending else None
+
+    # Uploads for all genera are run by one pool of workers, folders are created before any of their files are queued
+    pool = UploadPool(args.workers)
+    genus_pool = UploadPool(args.concurrent_genera)
+
+    # Folders to record in the manifest once their uploads have finished
+    synced_folders = []
+
+    for genus in genera:
+        lib_name, folders = getLibraryFolders(dirs, genus, species)
+        genus_pool.submit(genus, syncLibrary, gi, libraries, lib_name, folders, refseq_dir, file_types, args.exclude,
+                          galaxy_url, pool, manifest, synced_folders, args.verbose, args.batch_size, args.batch_bytes,
+                          checksum_pool, duplicates, tracker, metrics)
+
+    # Wait for the genera, then the uploads, to finish
+    with metrics.phase('sync_libraries'):
+        genus_errors = genus_pool.join()
+    with metrics.phase('finish_uploads'):
+        errors = pool.join()
+    if checksum_pool:
+        checksum_pool.close()
+
+    # Wait for the uploaded datasets to finish, so any that failed can be listed
+    failed_datasets = []
+    if tracker:
+        if args.verbose: print("Waiting for " + str(len(tracker.pending)) + " dataset(s) to finish")
+        with metrics.phase('finish_datasets'):
+            failed_datasets = tracker.wait()
+
+    # Record the folders that were synced without errors. Failed datasets are forgotten, so they are added
+    # again once they have been deleted from the library. Folders with duplicates skipped in favour of a file
+    # that failed aren't recorded either, so the duplicates are looked at again
+    if manifest:
+        failed_files = set(file_path for file_paths, _ in errors for file_path in file_paths)
+        for file_path, _, _ in failed_datasets:
+            failed_files.add(file_path)
+            for lib_id in set(lib_id for _, _, lib_id in synced_folders):
+                manifest.forgetFile(file_path, lib_id)
+        failed_folders = set(os.path.dirname(file_path) for file_path in failed_files)
+        for file_path, duplicate in duplicates or []:
+            if duplicate in failed_files:
+                failed_folders.add(os.path.dirname(file_path))
+        for folder_path, folder_mtime, lib_id in synced_folders:
+            if folder_path not in failed_folders:
+                manifest.recordDirectory(folder_path, folder_mtime, lib_id)
+        manifest.close()
+
+    if args.verbose: print("Galaxy requests: " + str(gi.stats.summary()))
+    if args.report or args.prometheus:
+        metrics.writeReport(args.report, args.prometheus, gi.stats.summary())
+
+    # List the duplicate files that were skipped
+    if duplicates:
+        print(str(len(duplicates)) + " duplicate file(s) skipped:")
+        for file_path, duplicate in duplicates:
+            print("  " + file_path + " (same as " + duplicate + ")")
+
+    # Report any genera and uploads that failed
+    for genus, error in genus_errors:
+        printerr("ERROR: The library for genus " + genus + " could not be updated: " + str(error))
+    if errors:
+        printerr("ERROR: " + str(sum(len(file_paths) for file_paths, _ in errors)) + " file(s) could not be added to the library:")
+        for file_paths, error in errors:
+            for file_path in file_paths:
+                printerr("  " + file_path + ": " + str(error))
+    if failed_datasets:
+        printerr("ERROR: " + str(len(failed_datasets)) + " dataset(s) failed in Galaxy - delete them from the library and run again to retry:")
+        for file_path, dataset_id, state in failed_datasets:
+            printerr("  " + file_path + ": dataset " + dataset_id + " is " + state)
+    if failed or genus_errors or errors or failed_datasets:
+        sys.exit(1)
 
-            else:
-                if args.verbose: print("Adding directory to library - " + folder)
-                fldr = gi.libraries.create_folder(lib['id'], folder)[0]
-
-            for fna in getFilesToInclude(REFSEQ_DIR + folder, FILE_TYPES, args.exclude):
-
-                # If file doesn't exist, add it
-                if fna not in getFilesInLibraryFolder(gi.libraries.show_library(lib['id'], contents=True), folder):
-                    if args.verbose: print("Adding file - " + fna)
-
-                    if "127.0.0.1" in GALAXY_URL or "localhost" in GALAXY_URL:
-                        # Local Galaxy server - create a symbolic link instead of a copy
-                        gi.libraries.upload_from_galaxy_filesystem(
-                            library_id=lib['id'],
-                            filesystem_paths=REFSEQ_DIR + folder + "/" + fna,
-                            folder_id=fldr['id'],
-                            link_data_only="link_to_files")
-                    else:
-                        # Remote Galaxy server - copy files from local machine
-                        gi.libraries.upload_file_from_local_path(
-                            library_id=lib['id'],
-                            file_local_path=REFSEQ_DIR + folder + "/" + fna,
-                            folder_id=fldr['id'])
-                else:
-                    if args.verbose: print("File exists - " + fna)
+if __name__ == "__main__":
+    main()
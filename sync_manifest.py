@@ -0,0 +1,431 @@
+'''
+ On-disk record of the local files and directories that have been synced into Galaxy data libraries.
+
+ The manifest is a SQLite database. Each file added to a library is recorded with its size,
+ mtime and inode, and the library, folder and dataset it was added as. Each directory is
+ recorded with its mtime and subdirectories once all of its files have been synced.
+
+ A directory's mtime changes whenever an entry is added to, removed from or renamed in it,
+ so a directory with an unchanged mtime does not need to be listed again and its files do not
+ need to be checked against Galaxy. A file that is rewritten in place does not change its
+ directory's mtime, so it is only picked up once something else in the directory changes.
+
+ Records are kept per library, as the same local directory can be synced into several
+ libraries (e.g. a genus library and a species library).
+
+ The manifest also caches file checksums, keyed by path, size, mtime and inode, and records the
+ checksum each file was synced with, so changed and duplicate files can be found by content.
+'''
+
+import os
+import sqlite3
+import threading
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+
+# Number of writes between commits
+COMMIT_INTERVAL = 500
+
+
+class SyncManifest(object):
+    '''
+     SQLite manifest of synced files and directories. Safe to share between threads.
+
+    :param path: The path of the SQLite database file, created if it does not exist
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT, library_id TEXT, size INTEGER, mtime REAL, inode INTEGER,
+                folder_id TEXT, dataset_id TEXT, PRIMARY KEY (path, library_id));
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT, library_id TEXT, mtime REAL, subdirs TEXT, PRIMARY KEY (path, library_id));
+            CREATE TABLE IF NOT EXISTS options (
+                library_id TEXT PRIMARY KEY, options TEXT);
+            CREATE TABLE IF NOT EXISTS checksums (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, checksum TEXT);
+        ''')
+
+        # Manifests written before checksums were recorded don't have the column yet
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(files)')]
+        if 'checksum' not in columns:
+            self._db.execute('ALTER TABLE files ADD COLUMN checksum TEXT')
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_checksum ON files (library_id, checksum)')
+        self._db.commit()
+
+    def checkOptions(self, library_id, options):
+        '''
+         Forget the directories recorded for a library if the options it is synced with have changed
+         (e.g. a different list of file types), so that every directory is listed again.
+
+        :param library_id: The Galaxy ID of the library
+        :param options: A string describing the options that decide which files are synced
+        :return: True if the options are unchanged
+        '''
+
+        with self._lock:
+            row = self._db.execute('SELECT options FROM options WHERE library_id = ?', (library_id,)).fetchone()
+            if row is not None and row[0] == options:
+                return True
+
+            self._db.execute('DELETE FROM directories WHERE library_id = ?', (library_id,))
+            self._db.execute('INSERT OR REPLACE INTO options VALUES (?, ?)', (library_id, options))
+            self._db.commit()
+            return False
+
+    def isDirectoryUnchanged(self, path, mtime, library_id):
+        '''
+         Check whether a directory has been fully synced to a library and not changed since.
+
+        :param path: The local path of the directory
+        :param mtime: The current mtime of the directory
+        :param library_id: The Galaxy ID of the library
+        :return: True if the directory is recorded with the same mtime
+        '''
+
+        with self._lock:
+            row = self._db.execute('SELECT mtime FROM directories WHERE path = ? AND library_id = ?',
+                                   (normalisePath(path), library_id)).fetchone()
+        return row is not None and row[0] == mtime
+
+    def getSubdirectories(self, path, library_id):
+        '''
+         Get the subdirectories recorded for a directory.
+
+        :param path: The local path of the directory
+        :param library_id: The Galaxy ID of the library
+        :return: A list of local paths of the subdirectories
+        '''
+
+        with self._lock:
+            row = self._db.execute('SELECT subdirs FROM directories WHERE path = ? AND library_id = ?',
+                                   (normalisePath(path), library_id)).fetchone()
+        if not row or not row[0]:
+            return []
+        return [os.path.join(normalisePath(path), name) for name in row[0].split('/')]
+
+    def recordDirectory(self, path, mtime, library_id, subdirs=()):
+        '''
+         Record a directory whose files have all been synced to a library.
+
+        :param path: The local path of the directory
+        :param mtime: The mtime of the directory, taken before it was listed
+        :param library_id: The Galaxy ID of the library
+        :param subdirs: The names of the subdirectories of the directory
+        :return: None
+        '''
+
+        self._write('INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)',
+                    (normalisePath(path), library_id, mtime, '/'.join(subdirs)))
+
+    def forgetDirectory(self, path, library_id):
+        '''
+         Remove the record of a directory synced to a library, so it is listed again, e.g. because one of its
+         datasets failed in Galaxy after the directory was recorded.
+
+        :param path: The local path of the directory
+        :param library_id: The Galaxy ID of the library
+        :return: None
+        '''
+
+        self._write('DELETE FROM directories WHERE path = ? AND library_id = ?', (normalisePath(path), library_id))
+
+    def getFile(self, path, library_id):
+        '''
+         Get the record of a file synced to a library.
+
+        :param path: The local path of the file
+        :param library_id: The Galaxy ID of the library
+        :return: A dict with size, mtime, inode, folder_id, dataset_id and checksum keys, or None if the file is not recorded
+        '''
+
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime, inode, folder_id, dataset_id, checksum FROM files '
+                                   'WHERE path = ? AND library_id = ?',
+                                   (normalisePath(path), library_id)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('size', 'mtime', 'inode', 'folder_id', 'dataset_id', 'checksum'), row))
+
+    def findChecksum(self, checksum, library_id, exclude_path=None):
+        '''
+         Find a file that has been synced to a library with the given checksum.
+
+        :param checksum: The checksum of the file contents
+        :param library_id: The Galaxy ID of the library
+        :param exclude_path: A local path to ignore, e.g. the path of the file being checked
+        :return: The local path of a file synced with that checksum, or None
+        '''
+
+        exclude_path = normalisePath(exclude_path) if exclude_path else None
+        with self._lock:
+            row = self._db.execute('SELECT path FROM files WHERE library_id = ? AND checksum = ? AND path IS NOT ? '
+                                   'LIMIT 1', (library_id, checksum, exclude_path)).fetchone()
+        return row[0] if row else None
+
+    def isFileUnchanged(self, path, st, library_id):
+        '''
+         Check whether a file has been synced to a library and not changed since.
+
+        :param path: The local path of the file
+        :param st: The result of os.stat() on the file
+        :param library_id: The Galaxy ID of the library
+        :return: True if the file is recorded with the same size, mtime and inode
+        '''
+
+        record = self.getFile(path, library_id)
+        return (record is not None and record['size'] == st.st_size and record['mtime'] == st.st_mtime
+                and record['inode'] == st.st_ino)
+
+    def recordFile(self, path, st, library_id, folder_id, dataset_id, checksum=None):
+        '''
+         Record a file that has been synced to a library.
+
+        :param path: The local path of the file
+        :param st: The result of os.stat() on the file, taken before it was synced
+        :param library_id: The Galaxy ID of the library
+        :param folder_id: The Galaxy ID of the folder the file was added to
+        :param dataset_id: The Galaxy ID of the library dataset for the file
+        :param checksum: The checksum of the file contents, or None if it wasn't checksummed
+        :return: None
+        '''
+
+        self._write('INSERT OR REPLACE INTO files (path, library_id, size, mtime, inode, folder_id, dataset_id, checksum) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (normalisePath(path), library_id, st.st_size, st.st_mtime, st.st_ino, folder_id, dataset_id,
+                     checksum))
+
+    def forgetFile(self, path, library_id):
+        '''
+         Remove the record of a file synced to a library, e.g. because its dataset failed in Galaxy.
+
+        :param path: The local path of the file
+        :param library_id: The Galaxy ID of the library
+        :return: None
+        '''
+
+        self._write('DELETE FROM files WHERE path = ? AND library_id = ?', (normalisePath(path), library_id))
+
+    def getChecksum(self, path, st):
+        '''
+         Get the cached checksum of a file, if the file hasn't changed since it was checksummed.
+
+        :param path: The local path of the file
+        :param st: The result of os.stat() on the file
+        :return: The checksum, or None if it isn't cached or the file has changed
+        '''
+
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime, inode, checksum FROM checksums WHERE path = ?',
+                                   (normalisePath(path),)).fetchone()
+        if row is None or tuple(row[:3]) != (st.st_size, st.st_mtime, st.st_ino):
+            return None
+        return row[3]
+
+    def recordChecksum(self, path, st, checksum):
+        '''
+         Cache the checksum of a file.
+
+        :param path: The local path of the file
+        :param st: The result of os.stat() on the file, taken before it was checksummed
+        :param checksum: The checksum of the file contents
+        :return: None
+        '''
+
+        self._write('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)',
+                    (normalisePath(path), st.st_size, st.st_mtime, st.st_ino, checksum))
+
+    def walkChanged(self, root, library_id):
+        '''
+         Generator for walking a directory tree, only listing directories that have changed since they
+         were recorded. Unchanged directories are not listed, but their recorded subdirectories are still visited.
+
+        :param root: The local path of the top of the tree
+        :param library_id: The Galaxy ID of the library the tree is synced to
+        :return: A generator of (directory path, directory mtime, subdirectory names, file names) tuples
+        '''
+
+        stack = [normalisePath(root)]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+
+            if self.isDirectoryUnchanged(path, mtime, library_id):
+                stack.extend(reversed(self.getSubdirectories(path, library_id)))
+                continue
+
+            # Like os.walk, do not descend into symlinks to directories
+            subdirs = []
+            filenames = []
+            try:
+                for entry in scandir(path):
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                    else:
+                        filenames.append(entry.name)
+            except OSError:
+                # Like os.walk, skip directories that can't be read, or have gone (e.g. while a mirror is syncing)
+                continue
+
+            subdirs.sort()
+            yield path, mtime, subdirs, sorted(filenames)
+            stack.extend(reversed([os.path.join(path, name) for name in subdirs]))
+
+    def commit(self):
+        '''
+         Write any pending records to disk.
+
+        :return: None
+        '''
+
+        with self._lock:
+            self._db.commit()
+            self._writes = 0
+
+    def close(self):
+        '''
+         Write any pending records to disk and close the database.
+
+        :return: None
+        '''
+
+        self.commit()
+        self._db.close()
+
+    def _write(self, sql, params):
+        with self._lock:
+            self._db.execute(sql, params)
+            self._writes += 1
+            if self._writes >= COMMIT_INTERVAL:
+                self._db.commit()
+                self._writes = 0
+
+
+class DirectoryRecorder(object):
+    '''
+     Records directories in a sync manifest as soon as the uploads of their files have all finished without
+     errors, so a run doesn't have to hold every directory it walks until the end. A directory with a failed
+     upload isn't recorded, so it is listed again next time. Safe to share between threads.
+
+    :param manifest: The SyncManifest to record the directories in
+    :param library_id: The Galaxy ID of the library the directories are synced to
+    '''
+
+    def __init__(self, manifest, library_id):
+        self.manifest = manifest
+        self.library_id = library_id
+        # Directory path: [unfinished uploads and holds, mtime, subdirectory names, whether an upload failed]
+        self._pending = {}
+        # Directory path: directories waiting on it, for files skipped as duplicates of its files
+        self._followers = {}
+        # Directories that weren't recorded because an upload failed
+        self.failed = set()
+        self._lock = threading.Lock()
+
+    def start(self, path, mtime, subdirs):
+        '''
+         Start waiting to record a directory. It is held until finish() is called for it, so it isn't recorded
+         before all of its uploads have been queued.
+
+        :param path: The local path of the directory
+        :param mtime: The mtime of the directory, taken before it was listed
+        :param subdirs: The names of the subdirectories of the directory
+        :return: None
+        '''
+
+        with self._lock:
+            self._pending[normalisePath(path)] = [1, mtime, subdirs, False]
+
+    def wrap(self, path, func):
+        '''
+         Wrap an upload of some of a directory's files, so the directory is only recorded once it has finished.
+
+        :param path: The local path of the directory, already passed to start()
+        :param func: The function doing the upload
+        :return: A function taking the same arguments as func, to queue in its place
+        '''
+
+        path = normalisePath(path)
+        with self._lock:
+            self._pending[path][0] += 1
+
+        def upload(*args, **kwargs):
+            succeeded = False
+            try:
+                func(*args, **kwargs)
+                succeeded = True
+            finally:
+                self.finish(path, succeeded)
+        return upload
+
+    def follow(self, path, original_path):
+        '''
+         Make a directory wait for another one, because a file in it was skipped as a duplicate of a file being
+         added from the other. If the other directory's uploads fail, this one isn't recorded either, so the
+         skipped file is looked at again next time.
+
+        :param path: The local path of the directory with the skipped file, already passed to start()
+        :param original_path: The local path of the directory with the file being added
+        :return: None
+        '''
+
+        path = normalisePath(path)
+        original_path = normalisePath(original_path)
+        if path == original_path:
+            return
+        with self._lock:
+            if original_path in self._pending:
+                self._pending[path][0] += 1
+                self._followers.setdefault(original_path, []).append(path)
+            elif original_path in self.failed:
+                self._pending[path][3] = True
+
+    def finish(self, path, succeeded=True):
+        '''
+         Release the hold taken by start(), or one taken by an upload wrapped with wrap(). The directory is
+         recorded once nothing holds it, unless an upload failed.
+
+        :param path: The local path of the directory
+        :param succeeded: False if an upload of the directory's files failed
+        :return: None
+        '''
+
+        path = normalisePath(path)
+        with self._lock:
+            pending = self._pending[path]
+            pending[0] -= 1
+            pending[3] = pending[3] or not succeeded
+            if pending[0]:
+                return
+            del self._pending[path]
+            followers = self._followers.pop(path, [])
+            if pending[3]:
+                self.failed.add(path)
+        if not pending[3]:
+            self.manifest.recordDirectory(path, pending[1], self.library_id, pending[2])
+        for follower in followers:
+            self.finish(follower, not pending[3])
+
+
+def normalisePath(path):
+    '''
+     Function for turning a local path into the form it is recorded in the manifest.
+
+    :param path: A local file or directory path
+    :return: The absolute, normalised path
+    '''
+
+    return os.path.normpath(os.path.abspath(path))
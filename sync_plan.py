@@ -0,0 +1,129 @@
+'''
+ Dry-run plan of what syncing local files into a Galaxy data library would change.
+
+ A plan compares one snapshot of the library (a LibraryIndex, or nothing if the library
+ doesn't exist yet) with one scan of the local files, without making any changes to Galaxy.
+ It is written as newline-delimited JSON, one record per line:
+
+    {"library": "salmonella", "action": "create_library"}
+    {"library": "salmonella", "action": "create_folder", "folder": "/a"}
+    {"library": "salmonella", "action": "add_file", "path": "/a/x.fna", "local_path": "...", "bytes": 123}
+    {"library": "salmonella", "action": "file_present", "path": "/a/y.fna", "local_path": "...", "bytes": 45}
+    {"library": "salmonella", "action": "missing_locally", "path": "/b/z.fna", "dataset_id": "..."}
+    {"library": "salmonella", "action": "summary", "counts": {...}, "bytes": {...}}
+
+ followed by a final {"action": "total", ...} record summing up every library in the plan.
+'''
+
+import json
+import os
+import threading
+
+
+# The actions a plan can contain, in the order they are counted in summaries
+PLAN_ACTIONS = ('create_library', 'create_folder', 'add_file', 'file_present', 'missing_locally')
+
+
+class PlanWriter(object):
+    '''
+     Writer of sync plans as newline-delimited JSON. Safe to share between threads.
+
+    :param out: The file object to write the plan to
+    '''
+
+    def __init__(self, out):
+        self.out = out
+        self.libraries = 0
+        self.counts = dict((action, 0) for action in PLAN_ACTIONS)
+        self.bytes = dict((action, 0) for action in PLAN_ACTIONS)
+        self._lock = threading.Lock()
+
+    def writeLibrary(self, lib_name, index, local_files):
+        '''
+         Work out and write the plan for one library. The records for a library are written together.
+
+        :param lib_name: The name of the library
+        :param index: The LibraryIndex of the library, or None if the library doesn't exist
+        :param local_files: An iterable of (library folder path, file name, local file path) tuples
+        :return: The summary record of the library
+        '''
+
+        records = list(planLibrary(lib_name, index, local_files))
+
+        with self._lock:
+            for record in records:
+                self.out.write(json.dumps(record, sort_keys=True) + "\n")
+            self.out.flush()
+
+            summary = records[-1]
+            self.libraries += 1
+            for action in PLAN_ACTIONS:
+                self.counts[action] += summary['counts'][action]
+                self.bytes[action] += summary['bytes'][action]
+
+        return summary
+
+    def close(self):
+        '''
+         Write the total record for every library in the plan.
+
+        :return: None
+        '''
+
+        with self._lock:
+            self.out.write(json.dumps({'action': 'total', 'libraries': self.libraries,
+                                       'counts': self.counts, 'bytes': self.bytes}, sort_keys=True) + "\n")
+            self.out.flush()
+
+
+def planLibrary(lib_name, index, local_files):
+    '''
+     Generator for the plan records of one library, ending with a summary record.
+     Folders to create are listed before any of their subfolders.
+
+    :param lib_name: The name of the library
+    :param index: The LibraryIndex of the library, or None if the library doesn't exist
+    :param local_files: An iterable of (library folder path, file name, local file path) tuples
+    :return: A generator of plan records (dicts)
+    '''
+
+    folders = index.folders if index else {'/': None}
+    files = index.files if index else {}
+
+    counts = dict((action, 0) for action in PLAN_ACTIONS)
+    sizes = dict((action, 0) for action in PLAN_ACTIONS)
+
+    def record(action, size=0, **fields):
+        counts[action] += 1
+        sizes[action] += size
+        fields.update(library=lib_name, action=action)
+        return fields
+
+    if index is None:
+        yield record('create_library')
+
+    planned_folders = set()
+    local_keys = set()
+    for folder, name, local_path in local_files:
+        # Create every missing parent of the folder, shallowest first
+        parts = [part for part in folder.split("/") if part]
+        for depth in range(1, len(parts) + 1):
+            parent = "/" + "/".join(parts[:depth])
+            if parent not in folders and parent not in planned_folders:
+                planned_folders.add(parent)
+                yield record('create_folder', folder=parent)
+
+        local_keys.add((folder, name))
+        size = os.path.getsize(local_path)
+        path = folder.rstrip("/") + "/" + name
+        if (folder, name) in files:
+            yield record('file_present', size, path=path, local_path=local_path, bytes=size)
+        else:
+            yield record('add_file', size, path=path, local_path=local_path, bytes=size)
+
+    # Files in the library that weren't found locally. Their size isn't in the library contents listing.
+    for (folder, name), dataset_id in sorted(files.items()):
+        if (folder, name) not in local_keys:
+            yield record('missing_locally', path=folder.rstrip("/") + "/" + name, dataset_id=dataset_id)
+
+    yield {'library': lib_name, 'action': 'summary', 'counts': counts, 'bytes': sizes}
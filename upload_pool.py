@@ -0,0 +1,176 @@
+'''
+ Bounded pool of worker threads for running Galaxy upload calls concurrently.
+
+ Work is handed to the pool with submit() and run by a fixed number of worker threads.
+ The queue in front of the workers is bounded, so the caller blocks rather than building
+ up an unbounded backlog. A failing call does not stop the pool: the exception is recorded
+ against the name it was submitted with and returned from join() once all work is done.
+
+ batchFiles() groups files so that several of them can be sent in a single upload request,
+ and uploadFiles() sends one such batch to a library folder.
+'''
+
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class UploadPool(object):
+    '''
+     Fixed-size pool of worker threads with per-item error collection.
+
+    :param workers: The number of worker threads (and so the number of calls in flight at once)
+    '''
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+        self.errors = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=self.workers * 2)
+        self._threads = []
+
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, name, func, *args, **kwargs):
+        '''
+         Queue a call to be run by one of the workers. Blocks while the queue is full.
+
+        :param name: A name for the work item (e.g. the file path), used when reporting errors
+        :param func: The function to call
+        :param args: Positional arguments for func
+        :param kwargs: Keyword arguments for func
+        :return: None
+        '''
+
+        self._queue.put((name, func, args, kwargs))
+
+    def join(self):
+        '''
+         Wait for all queued work to finish and stop the workers.
+
+        :return: A list of (name, exception) tuples for every call that failed
+        '''
+
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        return self.errors
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            name, func, args, kwargs = item
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                with self._lock:
+                    self.errors.append((name, e))
+
+
+def batchFiles(file_paths, max_files=1, max_bytes=0):
+    '''
+     Function for splitting a list of files into batches, each of which can be sent as one upload request.
+     A file larger than max_bytes is put in a batch on its own.
+
+    :param file_paths: A list of local file paths
+    :param max_files: The maximum number of files in a batch
+    :param max_bytes: The maximum total size of the files in a batch, in bytes. 0 for no limit.
+    :return: A generator of lists of file paths
+    '''
+
+    batch = []
+    batch_bytes = 0
+    for file_path in file_paths:
+        size = os.path.getsize(file_path) if max_bytes else 0
+
+        # Start a new batch if adding this file would make the current one too big
+        if batch and (len(batch) >= max_files or (max_bytes and batch_bytes + size > max_bytes)):
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append(file_path)
+        batch_bytes += size
+
+    if batch:
+        yield batch
+
+
+def uploadFiles(gi, lib, index, lib_folder, folder_id, file_paths, galaxy_url, manifest=None, file_type='auto',
+                checksums=None, tracker=None, replaced=None):
+    '''
+     Function for adding files to a library folder, and recording them in the library index (and manifest).
+     If the Galaxy instance is local, it will make symlinks to all the files in a single request
+     instead of uploading them one at a time.
+     Library datasets being replaced by the files are only deleted once the files have been added, so a failed
+     upload leaves the old dataset in place.
+
+    :param gi: Galaxy instance object
+    :param lib: The Galaxy library object to add the files to
+    :param index: The LibraryIndex of the library
+    :param lib_folder: The library path of the folder to add the files to (e.g. '/Salmonella_enterica_XYZ')
+    :param folder_id: The Galaxy ID of that folder
+    :param file_paths: A list of local paths of the files
+    :param galaxy_url: The URL of the galaxy instance
+    :param manifest: The SyncManifest to record the files in, or None
+    :param file_type: The Galaxy datatype to link the files as, defaults to letting Galaxy detect it
+    :param checksums: A dict mapping file paths to checksums to record in the manifest, or None
+    :param tracker: The DatasetTracker to wait for room in and track the new datasets with, or None
+    :param replaced: A dict mapping file paths to the IDs of the library datasets they replace, or None
+    :return: None
+    '''
+
+    # Stat the files before they are added, so a change made during the upload is picked up next time
+    stats = [os.stat(file_path) for file_path in file_paths]
+
+    # Wait until Galaxy has finished enough earlier uploads to take on these ones
+    if tracker:
+        tracker.reserve(len(file_paths))
+
+    datasets = []
+    try:
+        if "127.0.0.1" in galaxy_url or "localhost" in galaxy_url:
+            # Local Galaxy server - create symbolic links instead of copies
+            datasets = gi.libraries.upload_from_galaxy_filesystem(
+                library_id=lib['id'],
+                filesystem_paths="\n".join(file_paths),
+                folder_id=folder_id,
+                file_type=file_type,
+                link_data_only="link_to_files")
+        else:
+            # Remote Galaxy server - copy files from local machine
+            for file_path in file_paths:
+                datasets += gi.libraries.upload_file_from_local_path(
+                    library_id=lib['id'],
+                    file_local_path=file_path,
+                    folder_id=folder_id)
+    finally:
+        # Track the datasets by the files they came from, including those made before an upload failed part way
+        dataset_ids = dict((d['name'], d['id']) for d in datasets or [])
+        if tracker:
+            tracker.track(folder_id, [(file_path, dataset_ids.get(os.path.basename(file_path)))
+                                      for file_path in file_paths], len(file_paths))
+
+    for file_path, st in zip(file_paths, stats):
+        name = os.path.basename(file_path)
+        index.addFile(lib_folder, name, dataset_ids.get(name))
+        if manifest:
+            manifest.recordFile(file_path, st, lib['id'], folder_id, dataset_ids.get(name),
+                                (checksums or {}).get(file_path))
+
+    # The new datasets are in place, so the ones they replace can go
+    for file_path in file_paths:
+        if replaced and file_path in replaced and dataset_ids.get(os.path.basename(file_path)):
+            gi.libraries.delete_library_dataset(lib['id'], replaced[file_path])